@@ -13,6 +13,10 @@ if 'master_get' not in st.session_state:
     st.session_state['master_get'] = None
 if 'all_ids' not in st.session_state:
     st.session_state['all_ids'] = None
+if 'id_leases' not in st.session_state:
+    st.session_state['id_leases'] = {}
+if 'upload_job' not in st.session_state:
+    st.session_state['upload_job'] = None
 
 app = MultiApp()
 st.markdown(""" 
@@ -10,8 +10,9 @@ try:
     sys.path.append('utils')
     from customcss import load_css
     from writeread import read_file, to_excel, get_studycode
-    from generategp2ids import master_keyv2
-    from qcutils import checkNull, TakeOneEntry, checkDup
+    import idsregistry
+    import qcengine
+    from qcutils import checkNull, TakeOneEntry, checkDup, show_report
     from plotting import aggridPlotter
 
 except Exception as e:
@@ -43,92 +44,51 @@ def app():
         if len(re.findall(r'-', st.session_state['keepcode']))>0:
             study_name = st.session_state['keepcode'].split('-')[0]
     
-    cols = ['study', 'sample_id', 'visit_month',
-            'mds_updrs_part_iii_summary_score',
-            'moca_total_score', 'hoehn_and_yahr_stage',
-            'mmse_total_score']
-
-    required_cols = ['study', 'sample_id', 'visit_month']
+    cols = qcengine.CLINICAL_COLS
 
     if data_file is not None:
         st.markdown('<p class="big-font">Clinical data QC </p>', unsafe_allow_html=True)
         jumptwice()
         df = read_file(data_file)
+        df.index = df.index + 2 # rows of the spreadsheet, for the QC report
 
-        # missing col check
-        missing_cols = np.setdiff1d(cols, df.columns)
-        if len(missing_cols)>0:
-            st.error(f'{missing_cols} are missing. Please use the template sheet')
-            st.stop()
-        else:
+        # All the checks of the file are run at once, and all its problems reported in one go
+        df, findings = qcengine.validate_clinical(df, collect_all=True)
+        if len(qcengine.errors(findings)) == 0:
             st.text('Check column names--> OK')
-            df_non_miss_check = df[required_cols].copy()
-
-
-        # required columns checks
-        if df_non_miss_check.isna().sum().sum()>0:
-            st.error('There are some missing entries in the required columns. Please fill the missing cells ')
-            st.text('First ~30 columns with missing data in any required fields')
-            st.write(df_non_miss_check[df_non_miss_check.isna().sum(1)>0].head(20))
-            st.stop()
-        else:
             st.text('Check missing data in the required fields --> OK')
-
-
-        # Make sure we get visit_month and sample_ids in the right format
-        try:
-            df['visit_month'] = df['visit_month'].astype(int)
-            stopapp=False
-        except:
-            st.error(f' We could not convert visit month to integer')
-            st.error(f' Please check visit month refers to numeric month from Baseline')
-            stopapp=True
-        if stopapp:
-            st.stop()
-        
-        df['sample_id'] = df['sample_id'].astype(str)
-
-
-        # Make sure clinical vars are integers as well as there are no negative values
-        for col in df.iloc[:, 3:].columns:
-            if not df[df[col] < 0].shape[0] == 0:
-                st.error(f' We have detected negative values on column {col}')
-                st.error(f' This is likely to be a mistake on the data. Please, go back to the sample manifest anc check')
-                st.stop()
-        st.text('Check there are no variables with negative values --> OK')
+            st.text('Check there are no variables with negative values --> OK')
 
 
         # Check that the sample IDs are already in the json file
-        if 'ids_tracker' not in st.session_state:
+        if 'ids_tracker' not in st.session_state and 'missing_columns' not in [found['check'] for found in findings]:
             st.text('Checking that the sample manifest is already on our system...')
-            studynames = list(df['study'].unique())
-            ids_tracker = master_keyv2(studies = studynames)
+            studynames = list(df['study'].dropna().unique())
+            registered = idsregistry.registered_studies(studynames)
             for study in studynames:
-                try:
-                    study_tracker = ids_tracker[study]
-                except:
-                    st.error(f'We could not find sample ids for study {study} in our system')
-                    st.error('Please make sure you have uploaded the sample manifest to the GP2 storage system before QC the clinical data')
-                    st.stop()
+                df_subset = df[df['study']==study]
+                if study not in registered:
+                    findings.append(qcengine.finding('study_not_registered', 'error',
+                                                     f'We could not find sample ids for study {study} in our system',
+                                                     rows=df_subset.index, columns=['study', 'sample_id'],
+                                                     hint='Please make sure you have uploaded the sample manifest to the GP2 storage system before QC the clinical data'))
+                    continue
 
-                df_subset = df[df['study']==study].copy()
-                df_ids_list = df_subset['sample_id'].to_list()
-                master_study_ids = list(study_tracker.keys())
+                df_ids_list = df_subset['sample_id'].dropna().to_list()
+                master_study_ids = idsregistry.registered_sample_ids(study, df_ids_list)
 
                 checkdiff = np.setdiff1d(df_ids_list, master_study_ids)
-
-                if len(checkdiff) == 0:
-                    continue
-                else:
-                    st.error(f'We have detected some sample ids for study {study} that are not on the system')
-                    st.error('Please, make sure the sample manifest have been QCed and uploaded to the system first')
-                    st.error('Printing the conflicting sample IDs....')
-                    st.error(checkdiff)
-                    st.stop()
+                if len(checkdiff) > 0:
+                    findings.append(qcengine.finding('sample_id_not_registered', 'error',
+                                                     f'We have detected some sample ids for study {study} that are not on the system',
+                                                     rows=df_subset.index[df_subset['sample_id'].isin(checkdiff)], columns=['study', 'sample_id'],
+                                                     hint='Please, make sure the sample manifest have been QCed and uploaded to the system first'))
+            show_report(df, findings, name=f'{data_file.name.rsplit(".", 1)[0]}_qc_report.csv')
             st.text('We managed to track your sample manifest... Thanks')
             st.session_state['ids_tracker'] = 'DONE'
             jumptwice()
         else:
+            show_report(df, findings, name=f'{data_file.name.rsplit(".", 1)[0]}_qc_report.csv')
             st.text('Checking that the sample manifest is already on our system...')
             st.text('We managed to track your sample manifest... Thanks')
             jumptwice()
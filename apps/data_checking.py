@@ -3,6 +3,8 @@ try:
     from streamlit.components.v1 import html
     import os
     import sys
+    import uuid
+    import hashlib
     import pandas as pd
     import numpy as np
     import matplotlib.pyplot as plt
@@ -10,9 +12,11 @@ try:
 
     sys.path.append('utils')
     import generategp2ids
+    import idsregistry
+    import qcengine
     from customcss import load_css
-    from writeread import read_file, to_excel, get_studycode, email_ellie
-    from qcutils import detect_multiple_clindups, sample_type_fix
+    from writeread import read_file, to_excel, get_studycode, email_text
+    from qcutils import show_report, qc_stage
     from plotting import aggridPlotter
 except Exception as e:
     print("Some modules are not installed {}".format(e))
@@ -24,6 +28,88 @@ def jumptwice():
     st.write("##")
     st.write("##")
 
+def show_findings(df, findings):
+    # Findings of the QC engine (see qcengine). Errors stop the QC until the manifest is fixed
+    for found in findings:
+        show = st.error if found['level'] == 'error' else st.warning
+        show(found['message'])
+        if found['hint'] is not None:
+            show(found['hint'])
+        if len(found['rows']) > 0:
+            st.text('First 30 entries affected')
+            st.dataframe(qcengine.finding_rows(df, found).head(30))
+    if len(qcengine.errors(findings)) > 0:
+        st.stop()
+
+# The QC of the tab is split in stages, cached with qc_stage so that a change on the
+# tab (e.g. a phenotype choice) only recomputes the stages after it
+def read_stage(data_file):
+    # The index is the spreadsheet row of each sample from here on, for the QC findings
+    # and to give the manifest back in its order (see qcengine.spreadsheet_order)
+    df = read_file(data_file)
+    df.index = df.index +2
+    return df
+
+def file_stage(df, site):
+    """Checks and fixes of the file, up to the GP2 IDs assignment. The rules are run
+    once (validate), the findings of each step are taken from that pass
+    """
+    checked, findings = qcengine.validate(df, site, collect_all=True)
+    report = [found for found in findings if found['check'] not in qcengine.MAPPING_CHECKS]
+    stage = {'report': report,
+             'checked': checked if len(qcengine.errors(report)) > 0 else None,
+             'columns': [found for found in findings if found['check'] in ['missing_columns', 'unexpected_columns']]}
+    if len(qcengine.errors(stage['columns'])) > 0:
+        return stage
+    steps = qcengine.by_step(findings)
+    for step in ['required', 'clinical_id', 'sample_id', 'sample_type', 'study_type']:
+        stage[step] = steps[step]
+
+    df = qcengine.prepare(df, site)
+    df = qcengine.ids_as_str(df)
+    stage['dup_ID_this'] = qcengine.duplicated_clinical_ids(df)
+    stage['sample_type_counts'] = df.sample_type.astype('str').value_counts()
+    df['sample_type'] = qcengine.fix_vocabulary(df, 'sample_type', qcengine.ALLOWED_SAMPLES)
+    stage['study_arm_counts'] = df.groupby(['study_arm', 'study_type']).size().rename('N')
+    stage['study_arm_xtab'] = df.pivot_table(index='study_arm', columns='study_type',
+                                             values='sample_id', aggfunc='count', margins=True)
+    df['study_type'] = qcengine.fix_vocabulary(df, 'study_type', qcengine.ALLOWED_STUDY_TYPE)
+    stage['df'] = df
+    return stage
+
+def ids_stage(df, dup_ID_this):
+    """Summaries of the manifest with GP2 IDs, shown before the mappings to the GP2 values"""
+    dup_ID_all = df.loc[df.SampleRepNo!='s1', 'clinical_id'].unique()
+    stage = {'dup_ID_previous': np.setdiff1d(dup_ID_all, dup_ID_this),
+             'SampleRepNo_counts': df['SampleRepNo'].value_counts(),
+             'study_arm_xtab': df.pivot_table(index='study_arm', columns='diagnosis', margins=True,
+                                              values='sample_id', aggfunc='count', fill_value=0)}
+    for col in qcengine.MAPPINGS:
+        values = df[col].fillna('Not Reported') if col in qcengine.NOT_REPORTED_COLS else df[col]
+        stage[col] = {'counts': values.astype('str').value_counts(),
+                      'values': df[col].dropna().unique(),
+                      'n_missing': int(df[col].isna().sum())}
+    # Samples missing the region are mapped to the region of the study site
+    stage['region']['values'] = df.region.fillna('Not Reported').unique()
+    return stage
+
+def mapping_stage(df, col, mapping, step, tables):
+    """The columns of the GP2 values of col, the tables showing the mapping and the findings of step"""
+    mapped = qcengine.map_column(df.copy(), col, mapping)
+    return {'columns': mapped[qcengine.mapped_columns(col)],
+            'tables': tables(mapped) if any(value is not None for value in mapping.values()) else [],
+            'findings': qcengine.check(mapped, step)}
+
+def final_stage(df):
+    dft = df.copy()
+    dft['Plate_name'] = dft.Plate_name.fillna('_Missing')
+    return {'plates_xtab': dft.pivot_table(index='Plate_name',
+                                           columns='diagnosis', margins=True,
+                                           values='sample_id', aggfunc='count', fill_value=0),
+            'plates': qcengine.check(df, 'plates'),
+            'numerics': qcengine.check(df, 'numerics'),
+            'monogenic': qcengine.check(df, 'monogenic')}
+
 def app():
     load_css("apps/css/css.css")
 
@@ -49,57 +135,13 @@ def app():
     race_conf = ''
     fh_conf = ''
 
-    # Columns 
-    cols = ['study_type', 'sample_id', 'family_index', 'family_index_relationship', 'sample_type',
-            'DNA_volume', 'DNA_conc', 'r260_280',
-            'Plate_name', 'Plate_position', 'clinical_id',
-            'study_arm', 'diagnosis', 'sex', 'race',
-            'age', 'age_of_onset', 'age_at_diagnosis', 'age_at_death', 'age_at_last_follow_up',
-            'region', 'comment', 'family_history_pd', 'family_history_other', 'family_history_details', 'alternative_id1', 'alternative_id2']
-    required_cols = ['study_type', 'sample_id', 'sample_type', 'clinical_id', 
-                     'study_arm', 'diagnosis', 'sex']
-    fulgent_cols = ['DNA_volume', 'DNA_conc', 'Plate_name', 'Plate_position']
-    #monogenic_cols = ['family_index', 'family_index_relationship', 'age_of_onset', 'family_history_pd', 'family_history_pd_details']
-    #monogenic_cols = ['age_of_onset', 'family_history_pd']
-
-    # Column values
-    gptwo_phenos = ['PD', 'Control', 'Prodromal',
-                    'PSP', 'CBD/CBS', 'MSA', 'DLB', 'AD', 'FTD', "VaD", "VaPD"
-                    'Population Control', 'Undetermined-MCI', 'Undetermined-Dementia', 'Mix', 'LBD', 'Other']
-    allowed_samples = ['Blood (EDTA)', 'Blood (ACD)', 'Blood', 'DNA', 'DNA from Brain',
-                        'DNA from blood', 'DNA from FFPE', 'RNA', 'Saliva',
-                        'Buccal Swab', 'T-25 Flasks (Amniotic)', 'FFPE Slide',
-                        'FFPE Block', 'Fresh tissue', 'Frozen tissue',
-                        'Bone Marrow Aspirate', 'Whole BMA', 'CD3+ BMA', 'Other']
-    allowed_studyType = ['Case(/Control)', 'Prodromal', 'Genetically Enriched', 'Population Cohort', 'Brain Bank', 'Monogenic']
-    allowed_sex = ['Male', 'Female', 'Other/Unknown/Not Reported']
-    allowed_race=['American Indian or Alaska Native', 'Asian', 'White', 'Black or African American',
-                  'Multi-racial', 'Native Hawaiian or Other Pacific Islander', 'Other', 'Unknown', 'Not Reported']
-    allowed_family_history = ['Yes', 'No', 'Not Reported']
-    allowed_region_codes=["ABW","AFG","AGO","AIA","ALA","ALB","AND","ARE","ARG","ARM","ASM","ATA","ATF","ATG","AUS","AUT","AZE",
-                          "BDI","BEL","BEN","BES","BFA","BGD","BGR","BHR","BHS","BIH","BLM","BLR","BLZ","BMU","BOL","BRA","BRB",
-                          "BRN","BTN","BVT","BWA","CAF","CAN","CCK","CHE","CHL","CHN","CIV","CMR","COD","COG","COK","COL","COM",
-                          "CPV","CRI","CUB","CUW","CXR","CYM","CYP","CZE","DEU","DJI","DMA","DNK","DOM","DZA","ECU","EGY","ERI",
-                          "ESH","ESP","EST","ETH","FIN","FJI","FLK","FRA","FRO","FSM","GAB","GBR","GEO","GGY","GHA","GIB","GIN",
-                          "GLP","GMB","GNB","GNQ","GRC","GRD","GRL","GTM","GUF","GUM","GUY","HKG","HMD","HND","HRV","HTI","HUN",
-                          "IDN","IMN","IND","IOT","IRL","IRN","IRQ","ISL","ISR","ITA","JAM","JEY","JOR","JPN","KAZ","KEN","KGZ",
-                          "KHM","KIR","KNA","KOR","KWT","LAO","LBN","LBR","LBY","LCA","LIE","LKA","LSO","LTU","LUX","LVA","MAC",
-                          "MAF","MAR","MCO","MDA","MDG","MDV","MEX","MHL","MKD","MLI","MLT","MMR","MNE","MNG","MNP","MOZ","MRT",
-                          "MSR","MTQ","MUS","MWI","MYS","MYT","NAM","NCL","NER","NFK","NGA","NIC","NIU","NLD","NOR","NPL","NRU",
-                          "NZL","OMN","PAK","PAN","PCN","PER","PHL","PLW","PNG","POL","PRI","PRK","PRT","PRY","PSE","PYF","QAT",
-                          "REU","ROU","RUS","RWA","SAU","SDN","SEN","SGP","SGS","SHN","SJM","SLB","SLE","SLV","SMR","SOM","SPM",
-                          "SRB","SSD","STP","SUR","SVK","SVN","SWE","SWZ","SXM","SYC","SYR","TCA","TCD","TGO","THA","TJK","TKL",
-                          "TKM","TLS","TON","TTO","TUN","TUR","TUV","TWN","TZA","UGA","UKR","UMI","URY","USA","UZB","VAT","VCT",
-                          "VEN","VGB","VIR","VNM","VUT","WLF","WSM","YEM","ZAF","ZMB","ZWE"]
-
     if data_file is not None:
         
         # Read the data
         jumptwice()
         st.markdown('<p class="big-font">Sample manifest QC </p>', unsafe_allow_html=True)
-        df = read_file(data_file)
-        df.index = df.index +2
-        original_order = df.sample_id.to_list()
+        stage_key = ('file', hashlib.sha1(data_file.getvalue()).hexdigest())
+        df = qc_stage(stage_key, lambda: read_stage(data_file))
         jumptwice()
               
         
@@ -114,104 +156,58 @@ def app():
         else:
             st.markdown("**Genotyping_site** successfully added to the sample manifest")
         
-        if choice in ['For Fulgent', 'For Psomagen', 'For CIDR']:
-            required_cols = required_cols + fulgent_cols
-        if choice=='For NIH':
-            required_cols = required_cols + ['Plate_name', 'Plate_position']
-        
+        site = choice.replace('For ', '')
 
-        # Check expected columns are present
-        missing_cols = np.setdiff1d(cols, df.columns)
-        if len(missing_cols)>0:
-            st.error(f'{missing_cols} are missing. Please use the template sheet')
-            st.stop()
-        elif df.shape[1] != len(cols):
-            st.error('We have detected more unexpected columns in the input sample manifest')
-            st.error(f'{not_required_cols} should not be in the file. Please use the template sheet')
-            st.error('Please, try and QC again once this has been sorted')
-            not_required_cols = np.setdiff1d(df.columns, cols)
-            st.stop()
-        else:
-            st.markdown('sample manifest **columns** check --> OK')
+        # Run all the checks of the file at once, so that all its problems are reported in one go.
+        # The choices made on the steps below (phenotype, sex... for QC) are checked on each step
+        stage_key = stage_key + ('site', site)
+        stage = qc_stage(stage_key, lambda: file_stage(df, site))
+        if len(qcengine.errors(stage['report'])) > 0:
+            show_report(stage['checked'], stage['report'], name=f'{data_file.name.rsplit(".", 1)[0]}_qc_report.csv')
 
 
-        # Create genotyping site variable
-        df['Genotyping_site'] = choice.replace('For ', '')
+        # Check expected columns are present
+        show_findings(df, stage['columns'])
+        st.markdown('sample manifest **columns** check --> OK')
 
 
-        # We do this to detect any weird NA. Then, we efficiently capture them in this block of code and raise error
-        df[['sample_id','clinical_id']] = df[['sample_id','clinical_id']].replace('nan', np.nan) # We should detect any weird nas now
-        # Check required cols have no na
-        df_non_miss_check = df[required_cols].copy()
-        if df_non_miss_check.isna().sum().sum()>0:
-            st.error('There are some missing entries in the required columns. Please fill the missing cells ')
-            st.text('First 30 entries with missing data in any required fields')
-            st.write(df_non_miss_check[df_non_miss_check.isna().sum(1)>0].head(30))
-            st.stop()
-        else:
-            st.text('Check no missing data in the required fields --> OK')
-        
-        # Check monogenic required cols have no na
-        if 'Monogenic' in df['study_type'].unique():
-            df_mono_non_miss_check = df[df['study_type'] == 'Monogenic'][['sample_id','clinical_id','family_history_pd']].copy()
-            if df_mono_non_miss_check.isna().sum().sum()>0:
-                st.error('There are some missing entries in the required columns for monogenic data. ')
-                st.error('Please fill family_history_pd columnd for all monogenic samples in the manifest')
-                st.text('First 30 entries with missing data in any required fields')
-                st.write(df_mono_non_miss_check[df_mono_non_miss_check.isna().sum(1)>0].head(30))
-                st.stop()
-            else:
-                 st.text('Check no missing data in the required fields for monogenic data --> OK')
-
-        # Transform data type of key columns
-        df[['sample_id', 'clinical_id']] = df[['sample_id','clinical_id']].astype(str)
+        # Create genotyping site variable. We also detect any weird NA in the ID columns,
+        # and transform data type of key columns
+        df = stage['df']
+        # Check required cols have no na (and the monogenic ones for monogenic samples)
+        show_findings(df, stage['required'])
+        st.text('Check no missing data in the required fields --> OK')
         
 
         # Check clinical_id data
         jumptwice()
-        if df.groupby(['clinical_id']).size().sort_values(ascending=False)[0] > 3:
-            detect_multiple_clindups(df)
-        dup_ID_this=df.loc[df.duplicated(subset=['clinical_id']), 'clinical_id'].unique()
-        if len(dup_ID_this)>0:            
-            st.warning(f'Duplicated clinical_id in the manifest: {dup_ID_this}')
-            st.warning(f'If this is not expected, please fix it and re upload your sample manifest')
-        else:
+        show_findings(df, stage['clinical_id'])
+        dup_ID_this = stage['dup_ID_this']
+        if len(dup_ID_this)==0:
             st.success('clinical_id in the manifest are all new. No duplication/replication.')
 
 
         # Chceck sample_id data
         jumptwice()
-        sample_id_dup = df.sample_id[df.sample_id.duplicated()].unique()
-        # sample dup check
-        if len(sample_id_dup)>0:
-            st.text(f'Duplicated sample_id:{sample_id_dup}')
-            st.error(f'Unique sample IDs are required (clinical IDs can be duplicated if replicated)')
-            st.stop()
-        else:
-            st.markdown(f'Check there are no **sample_id duplicates** --> OK')
-            st.markdown(f'**N** of sample_id (entries):{df.shape[0]}')
-            st.markdown(f'**N** of unique clinical_id : {len(df.clinical_id.unique())}')
+        show_findings(df, stage['sample_id'])
+        st.markdown(f'Check there are no **sample_id duplicates** --> OK')
+        st.markdown(f'**N** of sample_id (entries):{df.shape[0]}')
+        st.markdown(f'**N** of unique clinical_id : {len(df.clinical_id.unique())}')
 
 
-        # sample type check
+        # sample type check (undesired whitespaces are fixed)
         jumptwice()
         st.markdown("**sample_type** check")
-        st.write(df.sample_type.astype('str').value_counts())
-        not_allowed = np.setdiff1d(df.sample_type.unique(), allowed_samples)
-        if len(not_allowed)>0:
-            #sample_type_fix(df, allowed_samples)
-            sample_type_fix(df = df, allowed_samples = allowed_samples, col = 'sample_type')
+        st.write(stage['sample_type_counts'])
+        show_findings(df, stage['sample_type'])
 
 
         # Study_type check
         jumptwice()
         st.markdown("**study_type** and **study_arm** check")
-        st.write(df.groupby(['study_arm', 'study_type']).size().rename('N'))
-        st.write(df.pivot_table(index='study_arm', columns='study_type',
-                                 values='sample_id', aggfunc='count', margins=True))
-        not_allowed = np.setdiff1d(df.study_type.unique(), allowed_studyType)
-        if len(not_allowed)>0:
-            sample_type_fix(df = df, allowed_samples = allowed_studyType, col = 'study_type')
+        st.write(stage['study_arm_counts'])
+        st.write(stage['study_arm_xtab'])
+        show_findings(df, stage['study_type'])
 
 
         # Create study variable
@@ -271,66 +267,53 @@ def app():
         st.subheader('GP2 IDs assignment...')
         if st.session_state['master_get'] == None: # TO ONLY RUN ONCE
             studynames = list(df['study'].unique())
-            ids_tracker = generategp2ids.master_keyv2(studies = studynames)
-            
+            registered = idsregistry.registered_studies(studynames)
+
             # # Check if this is another QC run of a sample manifest
-            all_sids = []
-            for v in ids_tracker.values():
-                all_sids = all_sids + list(v.keys())
-            if len(np.setdiff1d(df['sample_id'].to_list(), all_sids)) == 0:
+            n_registered = sum([len(idsregistry.registered_sample_ids(study, df['sample_id'].to_list())) for study in registered])
+            if n_registered == df['sample_id'].nunique():
                 st.error("It seems that you are trying to QC the same sample manifest again")
-                st.error("Please, contact us on cohort@gp2.org and explain your situation")
+                st.error("If you want to QC it again, the GP2 IDs it was given will be withdrawn and new ones assigned")
+                st.error("Otherwise, please contact us on cohort@gp2.org and explain your situation")
+                if st.button("Start QC again"):
+                    # Revert only the commits (and keys) that registered this manifest
+                    entries, kept = generategp2ids.master_rollback(registered, df, scode=studycode)
+                    if len(kept) == 0:
+                        st.experimental_rerun()
+                    # Registered before the registry journal, these GP2 IDs can only be withdrawn by the team
+                    n_kept = sum(len(sample_ids) for sample_ids in kept.values())
+                    st.error(f"The GP2 IDs of {n_kept} samples of this manifest were registered before they could be withdrawn "
+                             f"from the app ({len(entries)} later submissions of its samples were withdrawn)")
+                    st.error("Please contact us on cohort@gp2.org to QC it again")
                 st.stop()
-            #     if st.button("Start QC again"):
-            #         ids_tracker = generategp2ids.master_remove(studynames, df)
-            #         st.experimental_rerun()
-            #     st.stop()
             study_subsets = []
             log_new = []
             df['GP2sampleID'] = None
             for study in studynames:
                 st.write(f"Getting GP2IDs for {study} samples")
                 df_subset = df[df.study==study].copy()
-                try:
-                    #study_tracker = st.session_state['store_tracker'][study]
-                    study_tracker = ids_tracker[study]
-                    study_tracker_df = pd.DataFrame.from_dict(study_tracker,
-                                                            orient='index',
-                                                            columns = ['master_GP2sampleID','clinical_id'])\
-                                                    .rename_axis('master_sample_id').reset_index()\
-                                                    .astype(str)
-
+                study_tracker = study in registered
+                if study_tracker:
                     # Check if any sample ID exists in df_subset.
-                    sample_id_unique = pd.merge(study_tracker_df, df_subset,
-                                                left_on=['master_sample_id'], right_on=['sample_id'], how='inner')
-                    if not sample_id_unique.empty:
+                    existing_sids = idsregistry.registered_sample_ids(study, df_subset['sample_id'].to_list())
+                    if len(existing_sids) > 0:
                         st.error('We have detected sample ids submitted on previous versions')
                         st.error('Please, correct these sample IDs so that they are unique and resubmit the sample manifest.')
                         st.error('If this is an attempt to re QC a sample manifest, please contact us on cohort@gp2.org')
-                        sample_id_unique = sample_id_unique.rename(columns={"clinical_id_y": "clinical_id"})
+                        sample_id_unique = df_subset[df_subset['sample_id'].isin(existing_sids)]
                         st.dataframe(
                         sample_id_unique[['study','sample_id','clinical_id']].style.set_properties(**{"background-color": "brown", "color": "lawngreen"})
                         )
-                        stopapp=True
-                    else:
-                        stopapp=False
-                except:
-                    study_tracker = None
-                    stopapp = False
-                if stopapp:
-                    st.stop()
-
-                if bool(study_tracker):
-                    # WORK ON DUPLICATED IDS
-                    df_subset = df_subset.reset_index()
-                    data_duplicated = pd.merge(df_subset, study_tracker_df, on=['clinical_id'], how='inner')
-                    df_subset = df_subset.set_index('index')
-                    df_subset.index.name = None
+                        st.stop()
+
+                    # Registry entries sharing a clinical id with the manifest
+                    study_tracker_df = pd.DataFrame(idsregistry.registered_clinical_matches(study, df_subset['clinical_id'].unique()),
+                                                    columns = ['master_sample_id', 'master_GP2sampleID', 'clinical_id'])
 
-                    if data_duplicated.shape[0]>0:
+                    # WORK ON DUPLICATED IDS
+                    if study_tracker_df.shape[0]>0:
                         new_clinicaldups = True
-                        newids_clinicaldups = data_duplicated.groupby('clinical_id')\
-                                                        .apply(lambda x: generategp2ids.assign_unique_gp2clinicalids(df_subset,x))
+                        newids_clinicaldups = generategp2ids.assign_replicate_gp2ids(df_subset, study_tracker_df)
 
                         if newids_clinicaldups.shape[0]>0:
                             newids_clinicaldups = newids_clinicaldups.reset_index(drop=True)[['study','clinical_id','sample_id','GP2sampleID']]
@@ -340,14 +323,14 @@ def app():
                         newids_clinicaldups = pd.DataFrame()
 
                     # GET GP2 IDs METADATA for new CLINICAL-SAMPLE ID pairs
-                    df_newids = df_subset[df_subset['GP2sampleID'].isnull()].reset_index(drop = True).copy()
+                    df_newids = df_subset[df_subset['GP2sampleID'].isnull()].copy()
                     if not df_newids.empty: # Get new GP2 IDs
-                        df_wids = df_subset[~df_subset['GP2sampleID'].isnull()].reset_index(drop = True).copy()
+                        df_wids = df_subset[~df_subset['GP2sampleID'].isnull()].copy()
                         df_wids['GP2ID'] = df_wids['GP2sampleID'].apply(lambda x: ("_").join(x.split("_")[:-1]))
                         df_wids['SampleRepNo'] = df_wids['GP2sampleID'].apply(lambda x: x.split("_")[-1])#.replace("s",""))
 
-                        n=int(max(study_tracker_df['master_GP2sampleID'].to_list()).split("_")[1])+1
-                        df_newids = generategp2ids.getgp2idsv2(df_newids, n, study)
+                        lease = st.session_state['id_leases'].setdefault(study, idsregistry.IdLease(study))
+                        df_newids = generategp2ids.getgp2idsv2(df_newids, lease, study)
                         df_subset = pd.concat([df_newids, df_wids], axis = 0)
                         study_subsets.append(df_subset)
                         log_new.append(df_newids[['study','clinical_id','sample_id','GP2sampleID']])
@@ -361,8 +344,8 @@ def app():
                 else:
                     study = study
                     new_clinicaldups = False # Duplicates from master key json are treated differently to brand new data
-                    n = 1
-                    df_newids = generategp2ids.getgp2idsv2(df_subset, n, study)
+                    lease = st.session_state['id_leases'].setdefault(study, idsregistry.IdLease(study))
+                    df_newids = generategp2ids.getgp2idsv2(df_subset, lease, study)
                     study_subsets.append(df_newids)
 
 
@@ -402,6 +385,7 @@ def app():
                 #allnew.style.set_properties(**{"background-color": "brown", "color": "lawngreen"})
                 )
             st.session_state['df_finalids'] = df
+            st.session_state['ids_key'] = uuid.uuid4().hex # key of the stages after the assignment
             st.session_state['master_get'] = 'DONE'
 
         else:
@@ -415,11 +399,12 @@ def app():
 
         # Plot the data
         aggridPlotter(df)
+        stage_key = stage_key + ('ids', st.session_state['ids_key'])
+        summary = qc_stage(stage_key, lambda: ids_stage(df, dup_ID_this))
         
 
         # Highlight clinical IDs that were submitted on previous sample manifest
-        dup_ID_all=df.loc[df.SampleRepNo!='s1', 'clinical_id'].unique()
-        dup_ID_previous = np.setdiff1d(dup_ID_all, dup_ID_this)
+        dup_ID_previous = summary['dup_ID_previous']
         if len(dup_ID_previous)>0:
             st.warning(f'clinical_id previously submitted: {dup_ID_previous}')
             st.warning('If this does not look right, please fix it in your sample manifest, and come back to the app')
@@ -429,7 +414,7 @@ def app():
         jumptwice()
         st.markdown('Count by **SampleRepNo**: if all clinical IDs are new, all s1')
         st.markdown('Please refer to the dictionary to understand what **SampleRepNo** stands for')
-        st.write(df['SampleRepNo'].value_counts())
+        st.write(summary['SampleRepNo_counts'])
 
 
 
@@ -440,17 +425,15 @@ def app():
         jumptwice()
         st.subheader('Create Phenotype columns')
         st.text('Show study arm versus diagnosis')
-        xtab = df.pivot_table(index='study_arm', columns='diagnosis', margins=True,
-                              values='sample_id', aggfunc='count', fill_value=0)
-        st.write(xtab)
+        st.write(summary['study_arm_xtab'])
 
         jumptwice()
         st.text('Count per diagnosis')
-        st.write(df.diagnosis.astype('str').value_counts())
+        st.write(summary['diagnosis']['counts'])
 
         # Do the user - gp2 standards mapping
         jumptwice()
-        diag = df.diagnosis.dropna().unique()
+        diag = summary['diagnosis']['values']
         n_diag = st.columns(len(diag))
         phenotypes={}
         count_widget = 0
@@ -458,45 +441,32 @@ def app():
             count_widget += 1
             with x:
                 mydiag = diag[i]
-                diag_index = gptwo_phenos.index(mydiag) if mydiag in gptwo_phenos else None
+                diag_index = qcengine.GP2_PHENOS.index(mydiag) if mydiag in qcengine.GP2_PHENOS else None
                 phenotypes[mydiag]=x.selectbox(f"[{mydiag}]: For QC, please pick the closest Phenotype",
-                                               options = gptwo_phenos,
+                                               options = qcengine.GP2_PHENOS,
                                                index = diag_index,
                                                key=count_widget)
                 
-        df['GP2_phenotype'] = df.diagnosis.map(phenotypes).fillna('Not Assigned') # diagnosis and phenotype relationships are 1:1
-        if any(value is not None for value in phenotypes.values()):
+        # diagnosis and phenotype relationships are 1:1
+        stage_key = stage_key + ('diagnosis', tuple(phenotypes.items()))
+        stage = qc_stage(stage_key, lambda: mapping_stage(df, 'diagnosis', phenotypes, 'phenotype', lambda mapped: [
+            mapped.pivot_table(index='diagnosis', columns='GP2_phenotype', margins=True,
+                               values='sample_id', aggfunc='count', fill_value=0),
+            mapped.groupby(['study_arm', 'study_type', 'diagnosis', 'GP2_phenotype']).size().rename('N').reset_index()]))
+        df[stage['columns'].columns] = stage['columns'].to_numpy()
+        if len(stage['tables']) > 0:
             st.text('===  diagnosis x GP2_phenotype ===')
-            xtab = df.pivot_table(index='diagnosis', columns='GP2_phenotype', margins=True,
-                                  values='sample_id', aggfunc='count', fill_value=0)
-            st.write(xtab)
+            st.write(stage['tables'][0])
             jumptwice()
             st.text('=== study_arm x study_type x diagnosis x GP2_phenotype===')
-            pheno_tab=df.groupby(['study_arm', 'study_type', 'diagnosis', 'GP2_phenotype']).size().rename('N').reset_index()
-            st.table(pheno_tab)
+            st.table(stage['tables'][1])
         
         # Confirm mapping looks good
         ph_conf = st.checkbox('Confirm Phenotype?')
         if ph_conf:
-            if 'Not Assigned' in df.GP2_phenotype.unique():
-                st.error('Please assign the phenotype for all the samples')
-                st.stop()
-            else:
-                # Check now if there as some controls with unexpected AAO   
-                df_control_aao = df[ (df['GP2_phenotype'].isin(['Control', 'Population Control'])) & (~df['age_of_onset'].isna()) ].copy()
-                if not df_control_aao.empty:
-                    st.error("We have detected some controls that have age of onset values. This is not possible. Please correct")
-                    aggridPlotter(df_control_aao[['study','study_type','sample_id','clinical_id', 'GP2_phenotype', 'age_of_onset']] )
-                    st.stop()
-                else:
-                    st.info('Thank you')
-
-        # Derive phenotype for QC variable
-        df['GP2_phenotype_for_qc'] = df['GP2_phenotype'].apply(lambda pheno: pheno if pheno in ['PD','Control'] else 'Other')
-        all_studytype = df['study_type'].unique().tolist()
-        if 'Genetically Enriched' in all_studytype:
-            matching_rows = df[df['study_type'] == 'Genetically Enriched']
-            df.loc[matching_rows.index, 'GP2_phenotype_for_qc'] = 'Other'            
+            # Also checks there are no controls with age of onset
+            show_findings(df, stage['findings'])
+            st.info('Thank you')
 
 
 
@@ -507,46 +477,38 @@ def app():
         jumptwice()
         st.subheader('Create "biological_sex_for_qc"')
         st.text('Count per sex group')
-        st.write(df.sex.astype('str').value_counts())
+        st.write(summary['sex']['counts'])
 
         # Do the user - GP2 standards mapping
         jumptwice()
-        sexes=df.sex.dropna().unique()
+        sexes=summary['sex']['values']
         n_sexes = st.columns(len(sexes))
         mapdic={}
         for i, x in enumerate(n_sexes):
             count_widget += 1
             with x:
                 sex = sexes[i]
-                sex_index = allowed_sex.index(sex) if sex in allowed_sex else None
+                sex_index = qcengine.ALLOWED_SEX.index(sex) if sex in qcengine.ALLOWED_SEX else None
                 mapdic[sex] = x.selectbox(f"[{sex}]: For QC, please pick a word below",
-                                        options=allowed_sex, 
+                                        options=qcengine.ALLOWED_SEX, 
                                         index=sex_index, 
                                         key=count_widget)
         
-        df['biological_sex_for_qc'] = df['sex'].map(mapdic).fillna('Not Assigned')
+        stage_key = stage_key + ('sex', tuple(mapdic.items()))
+        stage = qc_stage(stage_key, lambda: mapping_stage(df, 'sex', mapdic, 'sex', lambda mapped: [
+            mapped.pivot_table(index='biological_sex_for_qc', columns='sex', margins=True,
+                               values='sample_id', aggfunc='count', fill_value=0)]))
+        df[stage['columns'].columns] = stage['columns'].to_numpy()
 
         st.text('=== biological_sex_for_qc x sex ===')
-        if any(value is not None for value in mapdic.values()):
-            xtab = df.pivot_table(index='biological_sex_for_qc', columns='sex', margins=True,
-                                    values='sample_id', aggfunc='count', fill_value=0)
-            st.write(xtab)
+        if len(stage['tables']) > 0:
+            st.write(stage['tables'][0])
 
         # Confirm mapping looks good
         sex_conf = st.checkbox('Confirm biological_sex_for_qc?')
         if sex_conf:
-            if 'Other/Unknown/Not Reported' in df['biological_sex_for_qc'].unique():
-                sex_count = df['biological_sex_for_qc'].value_counts()
-                unknown_rate = sex_count['Other/Unknown/Not Reported'] / df.shape[0]
-                if unknown_rate > 0.01:
-                    st.error("The number of samples with \"Other/Unknown/Not Reported\" sex category is higher than 1% ")
-                    st.error("Please check that you selected the right sex values for your samples above ")
-                    st.stop()
-            elif 'Not Assigned' in df.biological_sex_for_qc.unique():
-                st.error('Please assign the sex for all the samples')
-                st.stop()
-            else:
-                st.info('Thank you')
+            show_findings(df, stage['findings'])
+            st.info('Thank you')
 
 
 
@@ -557,42 +519,39 @@ def app():
         jumptwice()
         st.subheader('Create "race_for_qc"')
         st.text('Count per race (Not Reported = missing)')
-        df['race_for_qc'] = df.race.fillna('Not Reported')
-        st.write(df.race.fillna('Not Reported').astype('str').value_counts())
+        st.write(summary['race']['counts'])
 
         # Do the user - GP2 standards mapping
         jumptwice()
-        races = df.race.dropna().unique()
-        nmiss = sum(pd.isna(df.race))
+        races = summary['race']['values']
+        nmiss = summary['race']['n_missing']
         if nmiss>0:
             st.text(f'{nmiss} entries missing race...')
         mapdic = {'Not Reported':'Not Reported'}
         for race in races:
             count_widget += 1
-            race_index=allowed_race.index(race) if race in allowed_race else None
+            race_index=qcengine.ALLOWED_RACE.index(race) if race in qcengine.ALLOWED_RACE else None
             mapdic[race]=st.selectbox(f"[{race}]: For QC purppose, select the best match from the followings",
-                                      options=allowed_race, 
+                                      options=qcengine.ALLOWED_RACE, 
                                       index=race_index, 
                                       key=count_widget)
         
-        df['race_for_qc'] = df.race_for_qc.map(mapdic).fillna('Not Assigned')
+        stage_key = stage_key + ('race', tuple(mapdic.items()))
+        stage = qc_stage(stage_key, lambda: mapping_stage(df, 'race', mapdic, 'race', lambda mapped: [
+            mapped.assign(race=mapped.race.fillna('Not Reported')).pivot_table(
+                index='race_for_qc', columns='race', margins=True,
+                values='sample_id', aggfunc='count', fill_value=0)]))
+        df[stage['columns'].columns] = stage['columns'].to_numpy()
 
         st.text('=== race_for_qc X race ===')
-        if any(value is not None for value in mapdic.values()):
-            dft = df.copy()
-            dft['race'] = dft.race.fillna('Not Reported')
-            xtab = dft.pivot_table(index='race_for_qc', columns='race', margins=True,
-                                values='sample_id', aggfunc='count', fill_value=0)
-            st.write(xtab)
+        if len(stage['tables']) > 0:
+            st.write(stage['tables'][0])
 
         # Confirm mapping looks good
         race_conf = st.checkbox('Confirm race_for_qc?')
         if race_conf:
-            if 'Not Assigned' in df.race_for_qc.unique():
-                st.error('Please assign the race for all the samples')
-                st.stop()
-            else:
-                st.info('Thank you')
+            show_findings(df, stage['findings'])
+            st.info('Thank you')
 
 
 
@@ -603,10 +562,9 @@ def app():
         jumptwice()
         st.subheader('Create "family_history_for_qc"')
         st.text('Count per family_history category (Not Reported = missing)')
-        df['family_history_for_qc'] = df.family_history_pd.fillna('Not Reported')
-        st.write(df.family_history_pd.fillna('Not Reported').astype('str').value_counts())
-        family_historys = df.family_history_pd.dropna().unique()
-        nmiss = sum(pd.isna(df.family_history_pd))
+        st.write(summary['family_history_pd']['counts'])
+        family_historys = summary['family_history_pd']['values']
+        nmiss = summary['family_history_pd']['n_missing']
 
         # Do the user - GP2 standards mapping
         jumptwice()
@@ -620,30 +578,28 @@ def app():
                 count_widget += 1
                 with x:
                     fh = family_historys[i]
-                    fh_index=allowed_family_history.index(fh) if fh in allowed_family_history else None
+                    fh_index=qcengine.ALLOWED_FAMILY_HISTORY.index(fh) if fh in qcengine.ALLOWED_FAMILY_HISTORY else None
                     mapdic[fh]=x.selectbox(f'[{fh}]: For QC, family history',
-                                           options=allowed_family_history, 
+                                           options=qcengine.ALLOWED_FAMILY_HISTORY, 
                                            index=fh_index,
                                            key=count_widget)
         
-        df['family_history_for_qc'] = df.family_history_for_qc.map(mapdic).fillna('Not Assigned')
+        stage_key = stage_key + ('family_history_pd', tuple(mapdic.items()))
+        stage = qc_stage(stage_key, lambda: mapping_stage(df, 'family_history_pd', mapdic, 'family_history', lambda mapped: [
+            mapped.assign(family_history_pd=mapped.family_history_pd.fillna('_Missing')).pivot_table(
+                index='family_history_for_qc', columns='family_history_pd', margins=True,
+                values='sample_id', aggfunc='count', fill_value=0)]))
+        df[stage['columns'].columns] = stage['columns'].to_numpy()
 
         st.text('=== family_history_for_qc X family_history ===')
-        if any(value is not None for value in mapdic.values()):
-            dft = df.copy()
-            dft['family_history_pd'] = dft.family_history_pd.fillna('_Missing')
-            xtab = dft.pivot_table(index='family_history_for_qc', columns='family_history_pd', margins=True,
-                                    values='sample_id', aggfunc='count', fill_value=0)
-            st.write(xtab)
+        if len(stage['tables']) > 0:
+            st.write(stage['tables'][0])
 
         # Confirm mapping looks good
         fh_conf = st.checkbox('Confirm family_history_for_qc?')
         if fh_conf:
-            if 'Not Assigned' in df.family_history_for_qc.unique():
-                st.error('Please assign the family for all the samples')
-                st.stop()
-            else:
-                st.info('Thank you')
+            show_findings(df, stage['findings'])
+            st.info('Thank you')
 
 
 
@@ -654,10 +610,9 @@ def app():
         jumptwice()
         st.subheader('Create "region_for_qc"')
         st.text('Count per region (Not Reported = missing)')
-        df['region_for_qc'] = df.region.fillna('Not Reported')
-        st.write(df.region_for_qc.astype('str').value_counts())
-        regions = df.region_for_qc.dropna().unique()
-        nmiss = sum(pd.isna(df.region))
+        st.write(summary['region']['counts'])
+        regions = summary['region']['values']
+        nmiss = summary['region']['n_missing']
 
         # Do the user - GP2 standards mapping
         jumptwice()
@@ -669,7 +624,7 @@ def app():
             st.text('if ISO 3166-3 is available for the region, please provide')
             st.write('https://en.wikipedia.org/wiki/ISO_3166-1_alpha-3')
 
-            if 'Not Reported' in df['region_for_qc'].values:
+            if nmiss>0:
                 st.warning("We have detectec missing values on region column")
                 st.warning("For the samples missing the region value, please select the ISO code that corresponds to your STUDY SITE from the URL above")
 
@@ -678,36 +633,28 @@ def app():
                 count_widget += 1
                 with x:
                     region = regions[i]
-                    region_index = allowed_region_codes.index(region) if region in allowed_region_codes else None
+                    region_index = qcengine.ALLOWED_REGION_CODES.index(region) if region in qcengine.ALLOWED_REGION_CODES else None
                     mapdic[region]=x.selectbox(f'[{region}]: For QC, region',
-                                           options=allowed_region_codes, 
+                                           options=qcengine.ALLOWED_REGION_CODES, 
                                            index=region_index,
                                            key=count_widget)
 
-        df['region_for_qc'] = df.region_for_qc.map(mapdic).fillna('Not Assigned')
+        stage_key = stage_key + ('region', tuple(mapdic.items()))
+        stage = qc_stage(stage_key, lambda: mapping_stage(df, 'region', mapdic, 'region', lambda mapped: [
+            mapped.assign(region=mapped.region.fillna('Not Reported')).pivot_table(
+                columns='region_for_qc', index='region', margins=True,
+                values='sample_id', aggfunc='count', fill_value=0)]))
+        df[stage['columns'].columns] = stage['columns'].to_numpy()
 
         st.text('=== region X  region_for_qc ===')
-        if any(value is not None for value in mapdic.values()):
-            dft = df.copy()
-            dft['region'] = dft.region.fillna('Not Reported')
-            xtab = dft.pivot_table(columns='region_for_qc', index='region', margins=True,
-                                    values='sample_id', aggfunc='count', fill_value=0)
-            st.table(xtab)
+        if len(stage['tables']) > 0:
+            st.table(stage['tables'][0])
 
         # Confirm mapping looks good
-        region_not_well_assigned = np.setdiff1d(df.region_for_qc.unique(), allowed_region_codes) # This should not be necessary anymore, but leave it here for now
         rg_conf = st.checkbox('Confirm region_for_qc?')
         if rg_conf:
-            if len(region_not_well_assigned)>0:
-                st.error('Please make sure all samples assigned a 3-digit region code. If not available,\
-                         please assign the 3-digit code for the principle research site.')
-                st.error(f'Need reviews: {region_not_well_assigned}')
-                st.stop()
-            elif 'Not Assigned' in df.region_for_qc.unique():
-                st.error('Please assign the region for all the samples')
-                st.stop()
-            else:
-                st.info('Thank you')
+            show_findings(df, stage['findings'])
+            st.info('Thank you')
 
 
 
@@ -716,27 +663,10 @@ def app():
         ##################
         jumptwice()
         st.subheader('Plate Info')
-        dft = df.copy()
-        dft['Plate_name'] = dft.Plate_name.fillna('_Missing')
-        xtab = dft.pivot_table(index='Plate_name',
-                            columns='diagnosis', margins=True,
-                            values='sample_id', aggfunc='count', fill_value=0)
-        st.write(xtab)
-
-        show_all_duppos = []
-        for plate in dft.Plate_name.unique():
-            df_plate = dft[dft.Plate_name==plate].copy()
-            df_plate_pos = df_plate.Plate_position
-            if plate!='_Missing':
-                if len(df_plate_pos)>96:
-                    st.error('Please make sure, N of samples on plate [{plate}] is =<96')
-                    st.stop()
-                dup_pos = df_plate_pos[df_plate_pos.duplicated()].unique()
-                if len(dup_pos)>0:
-                    st.error(f' !!!SERIOUS ERROR!!!  Plate position duplicated position {dup_pos} on plate [{plate}]')
-                    show_all_duppos.append((dup_pos, plate))
-        if len(show_all_duppos) > 0:
-            st.stop()
+        stage = qc_stage(stage_key + ('final',), lambda: final_stage(df))
+        st.write(stage['plates_xtab'])
+
+        show_findings(df, stage['plates'])
 
 
 
@@ -745,48 +675,13 @@ def app():
         ##########################
         jumptwice()
         st.subheader('Numeric Values')
-        numerics_cols = ['DNA_volume', 'DNA_conc', 'r260_280','age', 'age_of_onset', 'age_at_diagnosis', 'age_at_last_follow_up','age_at_death']
-        age_cols = ['age', 'age_of_onset', 'age_at_diagnosis']
-        check_cols_message = []
-        for v in numerics_cols:
-            if df.dtypes[v] not in ['float64', 'int64']:
-                st.error(f'{v} is not numeric')
-                st.text("Please, make sure expected numeric columns are stored on a numeric format")
-                st.text(f'Expected columns in numeric format - \n * {numerics_cols}')
-                st.stop()
-            if (df[v] < 0).any():
-                st.error(f'{v} has unexpected negative values.  Please correct the values we are showing above')
-                aggridPlotter(df[df[v] < 0][ ['study','study_type','sample_id','clinical_id'] + [v] ])
-                st.stop()
-            if v in age_cols:
-                if ((df[v] < 20) | (df[v] > 100)).any():
-                    #st.error(f'{v} has unexpected high or low values. If')
-                    #aggridPlotter(df[(df[v] < 20) | (df[v] > 100)][ ['study','study_type','sample_id','clinical_id'] + [v] ])
-                    #st.stop()
-                    check_cols_message.append(v)
-        
-        if len(check_cols_message)>0:
-            st.warning(f'{check_cols_message} has unexpected high (>100) or low (<20) values. ')
-            st.warning('Please check the data below. If these are errors, fix them, and come back and re-upload the sample manifest')
-            df_check = df[(df[check_cols_message] < 20).any(axis=1) | (df[check_cols_message] > 100).any(axis=1)][ ['sample_id','clinical_id'] + check_cols_message].copy()
-            aggridPlotter(df_check)
+        numerics_cols = qcengine.NUMERIC_COLS
+        show_findings(df, stage['numerics'])
         
         # Do one last check for monogenic samples and AAO.
-        # For Monogenic cases, we need to check AAO is not missing
         # We decide to do this at the very end, after we have derived a standard 'GP2_phenotype_for_qc' variable
-        if 'Monogenic' in df['study_type'].unique():
-            df_mono_aao_miss_check = df[(df['study_type'] == 'Monogenic') & (df['GP2_phenotype_for_qc'] == 'PD')][['sample_id','clinical_id','age_of_onset']].copy()
-            if df_mono_aao_miss_check.isna().sum().sum()>0:
-                st.text('Checking AAO for PD monogenic samples...')
-                st.error('There are some missing entries in the required columns for monogenic data. ')
-                st.error('Please fill age_of_onset column for all PD monogenic samples in the manifest')
-                st.text('First 30 entries with missing data in any required fields')
-                st.write(df_mono_aao_miss_check[df_mono_aao_miss_check.isna().sum(1)>0].head(30))
-                st.stop()
-            else:
-                st.text('Check no missing data in AAO for PD monogenic samples --> OK')
+        show_findings(df, stage['monogenic'])
             
-
         st.text('Numeric chek --> OK.')
         st.text('You can check the distribution with the button below')
         if st.button("Check Distribution"):
@@ -826,15 +721,15 @@ def app():
             else:
                 # Update json file with master IDs
                 #generategp2ids.update_masterids(ids_log, study_tracker)
-                for idslog_tracker in st.session_state['all_ids']:
-                   generategp2ids.update_masterids(idslog_tracker[0], idslog_tracker[1], studycode)
-
-                email_ellie(studycode = studycode, activity = 'qc')
+                # Registered in the background, the team is emailed once it is done (or if it fails).
+                # The GP2 ID numbers leased and not used are given back to the registry after the commit
+                subject, body = email_text(studycode = studycode, activity = 'qc')
+                generategp2ids.update_masterids_background([idslog_tracker[0] for idslog_tracker in st.session_state['all_ids']],
+                                                           studycode, notify = {'subject': subject, 'body': body},
+                                                           leases = st.session_state['id_leases'].values())
+                st.session_state['id_leases'] = {}
                     
-                df = df.reset_index(drop=True)
-                df['CustomOrder'] = df['sample_id'].apply(lambda x: original_order.index(x))
-                df = df.sort_values(by='CustomOrder')
-                df = df.drop(columns=['CustomOrder'])
+                df = qcengine.spreadsheet_order(df).reset_index(drop=True)
 
                 st.session_state['smqc'] = df
                 
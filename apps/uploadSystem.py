@@ -3,9 +3,12 @@ try:
     import streamlit as st
     import sys
     import re
+    import time
     sys.path.append('utils')
     from customcss import load_css
-    from writeread import upload_data, read_file, get_studycode, email_ellie
+    from writeread import read_file, get_studycode, email_ellie
+    import storagebackend
+    import uploadengine
     from plotting import aggridPlotter
 except Exception as e:
     print("Some modules are not installed {}".format(e))
@@ -73,14 +76,11 @@ def app():
             if checkdf:
                 if study_name:
                     if manifest_check == "Yes":
-                        bucket_name = "eu-samplemanifest"
+                        bucket_name = storagebackend.BUCKET_NAME
                         destination = os.path.join(study_name, file_name + file_extension)
                         data = source_file.getvalue()
-                        check = upload_data(bucket_name, data, destination)
-                        st.markdown(
-                            '<p class="medium-font"> {} !!</p>'.format(check),
-                            unsafe_allow_html=True)
-                        email_ellie(studycode = st.session_state['keepcode'], activity = 'upload')
+                        # The upload runs in the background, its progress is shown below
+                        st.session_state['upload_job'] = uploadengine.start_upload(bucket_name, data, destination)
                     else:
                         st.error("ERROR: Please confirm that the data looks correct on the checkbox above")
                 else:
@@ -89,3 +89,22 @@ def app():
                 st.error("THIS DATASET DOES NOT SEEM TO BE QC. WE HAVE BEEN UNABLE TO CONSIDER IT AS A QC SAMPLE MANIFEST")
                 st.error("PLEASE MOVE TO EITHER THE SAMPLE MANIFEST OR THE CLINICAL TAB AND TRY AGAIN AFTER QC")
                 st.stop()
+
+    # Progress of the upload started from this session
+    job = st.session_state['upload_job']
+    if job is not None:
+        if job.state == 'done':
+            st.markdown(
+                '<p class="medium-font"> File successfully uploaded to GP2 storage system !!</p>',
+                unsafe_allow_html=True)
+            if not job.notified:
+                job.notified = True
+                email_ellie(studycode = st.session_state['keepcode'], activity = 'upload')
+        elif job.state == 'failed':
+            st.error(f"ERROR: The upload of {job.destination} failed. Please, try again")
+            st.error(job.error)
+        else:
+            status = 'retrying after a network error' if job.state == 'retrying' else 'uploading'
+            st.progress(job.progress(), text = f'{job.destination}: {status} ({job.progress():.0%})')
+            time.sleep(1)
+            st.experimental_rerun()
@@ -0,0 +1,179 @@
+"""Check generategp2ids against the previous row by row implementations and time them
+on large synthetic manifests.
+
+    python utils/benchgp2ids.py --rows 1000000
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import generategp2ids
+
+
+def getgp2idsv2_loop(dfproc, n, study_code):
+    # Previous implementation of generategp2ids.getgp2idsv2, kept as the reference
+    dfproc = dfproc.sort_values('sample_id')
+    df_dups = dfproc[dfproc.duplicated(keep=False, subset=['clinical_id'])].sort_values('clinical_id').reset_index(drop = True).copy()
+
+    if df_dups.shape[0]>0:
+        dupids_mapper = dict(zip(df_dups.clinical_id.unique(),
+                            [num+n for num in range(len(df_dups.clinical_id.unique()))]))
+
+        df_dup_chunks = []
+        for clin_id, gp2id in dupids_mapper.items():
+            df_dups_subset = df_dups[df_dups.clinical_id==clin_id].copy()
+            df_dups_subset['GP2ID'] = [f'{study_code}_{gp2id:06}' for i in range(df_dups_subset.shape[0])]
+            df_dups_subset['SampleRepNo'] = ['s'+str(i+1) for i in range(df_dups_subset.shape[0])]
+            df_dups_subset['GP2sampleID'] = df_dups_subset['GP2ID'] + '_' + df_dups_subset['SampleRepNo']
+            df_dup_chunks.append(df_dups_subset)
+        df_dups_wids = pd.concat(df_dup_chunks)
+
+    df_nodups = dfproc[~dfproc.duplicated(keep=False, subset=['clinical_id'])].sort_values('clinical_id').reset_index(drop = True).copy()
+
+    if not df_nodups.empty:
+        if df_dups.shape[0]>0:
+            n =  len(list(dupids_mapper.values())) + n
+
+        uids = [str(id) for id in df_nodups['sample_id'].unique()]
+        mapid = {}
+        for uid in uids:
+            mapid[uid]= n
+            n += 1
+        df_nodups_wids = df_nodups.copy()
+        df_nodups_wids['uid_idx'] = df_nodups_wids['sample_id'].map(mapid)
+        df_nodups_wids['GP2ID'] = [f'{study_code}_{i:06}' for i in df_nodups_wids.uid_idx]
+        df_nodups_wids['uid_idx_cumcount'] = df_nodups_wids.groupby('GP2ID').cumcount() + 1
+        df_nodups_wids['GP2sampleID'] = df_nodups_wids.GP2ID + '_s' + df_nodups_wids.uid_idx_cumcount.astype('str')
+        df_nodups_wids['SampleRepNo'] = 's' + df_nodups_wids.uid_idx_cumcount.astype('str')
+        df_nodups_wids.drop(['uid_idx','uid_idx_cumcount'], axis = 1, inplace = True)
+
+        if df_dups.shape[0]>0:
+            df_newids = pd.concat([df_dups_wids, df_nodups_wids])
+        else:
+            df_newids = df_nodups_wids
+    else:
+        df_newids = df_dups_wids
+
+    return(df_newids)
+
+
+def assign_unique_gp2clinicalids_loop(df, clinicalid_subset):
+    # Previous per clinical_id implementation of generategp2ids.assign_replicate_gp2ids,
+    # run with data_duplicated.groupby('clinical_id').apply(...)
+    if isinstance(clinicalid_subset, pd.Series):
+        clinicalid_subset = clinicalid_subset.to_frame().T
+
+    sampleid = clinicalid_subset.sort_values(by=['master_GP2sampleID'])\
+                                .reset_index(drop = True)\
+                                .dropna(subset=['master_GP2sampleID'], axis = 0)
+    sampleid = sampleid.loc[sampleid.index[-1], 'master_GP2sampleID'].split("_")
+    getuniqueid = sampleid[0] + "_" + sampleid[1]
+    get_sidrepno = int(sampleid[2].replace("s","")) + 1
+
+    index_modify = clinicalid_subset['index'].unique()
+    assign_gp2sampleid = [getuniqueid + "_s" + str(get_sidrepno + i) for i in range(len(index_modify))]
+    df.loc[index_modify, 'GP2sampleID'] = assign_gp2sampleid
+    getnewidrows = df.loc[index_modify].copy()
+    return (getnewidrows)
+
+
+def replicate_assignment_loop(df_subset, study_tracker_df):
+    # How data_checking used assign_unique_gp2clinicalids
+    df_subset = df_subset.reset_index()
+    data_duplicated = pd.merge(df_subset, study_tracker_df, on=['clinical_id'], how='inner')
+    df_subset = df_subset.set_index('index')
+    df_subset.index.name = None
+    newids = data_duplicated.groupby('clinical_id')\
+                            .apply(lambda x: assign_unique_gp2clinicalids_loop(df_subset, x))
+    return df_subset, newids.reset_index(drop=True)[['study','clinical_id','sample_id','GP2sampleID']]
+
+
+def synthetic_resubmission(n_rows, n_registered, max_reps=8, seed=0):
+    """Manifest of n_rows new samples whose clinical ids are already registered with 1..max_reps samples.
+    max_reps stays below 9 for the comparison, as the previous implementation sorted 's10' before 's9'
+    """
+    rng = np.random.default_rng(seed)
+    registered_reps = rng.integers(1, max_reps + 1, size=n_registered)
+    registry = pd.DataFrame({'clinical_id': np.repeat([f'C{i:08d}' for i in range(n_registered)], registered_reps),
+                             'master_GP2sampleID': [f'BENCH_{i + 1:06}_s{r + 1}'
+                                                    for i, reps in enumerate(registered_reps) for r in range(reps)]})
+    registry['master_sample_id'] = [f'OLD{i:08d}' for i in range(registry.shape[0])]
+    registry = registry.sample(frac=1, random_state=seed)[['master_sample_id', 'master_GP2sampleID', 'clinical_id']]
+    df = pd.DataFrame({'study': 'BENCH',
+                       'sample_id': [f'S{i:08d}' for i in range(n_rows)],
+                       'clinical_id': [f'C{i:08d}' for i in rng.integers(0, n_registered, size=n_rows)],
+                       'GP2sampleID': None})
+    df.index = df.index + 2
+    return df, registry
+
+
+def synthetic_manifest(n_rows, dup_rate=0.1, seed=0):
+    """Manifest with unique sample ids where about dup_rate of the rows share their clinical_id (up to 3 samples)"""
+    rng = np.random.default_rng(seed)
+    clinical = np.arange(n_rows)
+    n_dups = int(n_rows * dup_rate)
+    dup_rows = rng.choice(n_rows, size=n_dups, replace=False)
+    clinical[dup_rows] = rng.choice(n_rows, size=n_dups) # reuse other clinical ids
+    df = pd.DataFrame({'study': 'BENCH',
+                       'sample_id': [f'S{i:08d}' for i in rng.permutation(n_rows)],
+                       'clinical_id': [f'C{i:08d}' for i in clinical],
+                       'GP2sampleID': None})
+    return df
+
+
+def check_equivalence(sizes=(1, 2, 10, 100, 1000), seeds=5):
+    for size in sizes:
+        for seed in range(seeds):
+            for dup_rate in (0, 0.3, 1):
+                df = synthetic_manifest(size, dup_rate=dup_rate, seed=seed)
+                for data in (df, df.drop(columns=['GP2sampleID'])):
+                    expected = getgp2idsv2_loop(data, 7, 'BENCH')
+                    result = generategp2ids.getgp2idsv2(data, 7, 'BENCH')
+                    # The reference renumbers the rows, getgp2idsv2 keeps their index
+                    assert (result['sample_id'] == data.loc[result.index, 'sample_id']).all()
+                    pd.testing.assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True),
+                                                  check_dtype=False)
+    print('getgp2idsv2 output identical to the reference implementation')
+
+    for size in sizes:
+        for seed in range(seeds):
+            df, registry = synthetic_resubmission(size, max(1, size // 3), seed=seed)
+            expected_df, expected = replicate_assignment_loop(df.copy(), registry)
+            result_df = df.copy()
+            result = generategp2ids.assign_replicate_gp2ids(result_df, registry)
+            result = result.reset_index(drop=True)[['study','clinical_id','sample_id','GP2sampleID']]
+            pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+            pd.testing.assert_frame_equal(result_df, expected_df, check_dtype=False)
+    print('assign_replicate_gp2ids output identical to the reference implementation')
+
+
+def bench(n_rows, reference_limit=100000):
+    df = synthetic_manifest(n_rows)
+    start = time.time()
+    generategp2ids.getgp2idsv2(df, 1, 'BENCH')
+    print(f'getgp2idsv2: {n_rows} rows in {time.time() - start:.2f}s')
+    if n_rows <= reference_limit:
+        start = time.time()
+        getgp2idsv2_loop(df, 1, 'BENCH')
+        print(f'reference: {n_rows} rows in {time.time() - start:.2f}s')
+
+    df, registry = synthetic_resubmission(n_rows, max(1, n_rows // 3))
+    start = time.time()
+    generategp2ids.assign_replicate_gp2ids(df.copy(), registry)
+    print(f'assign_replicate_gp2ids: {n_rows} replicate samples in {time.time() - start:.2f}s')
+    if n_rows <= reference_limit:
+        start = time.time()
+        replicate_assignment_loop(df.copy(), registry)
+        print(f'reference: {n_rows} replicate samples in {time.time() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+    check_equivalence()
+    bench(args.rows)
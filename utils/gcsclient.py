@@ -0,0 +1,101 @@
+import os
+import time
+import bisect
+import threading
+import requests
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage
+
+# One google.cloud.storage client per process, shared by every GCS call site of the app.
+# Its HTTP session keeps a pool of connections open, and bucket handles are built
+# without the metadata request of client.get_bucket(). Every request made through
+# the client is counted and timed, see stats().
+POOL_SIZE = int(os.environ.get('GP2_GCS_POOL_SIZE', 32))
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_lock = threading.Lock()
+_client = None
+_session = None
+_buckets = {}
+_stats = {}
+
+
+def _kind(method, url):
+    if '/upload/' in url:
+        return 'upload'
+    if '/download/' in url or 'alt=media' in url:
+        return 'download'
+    if method == 'GET':
+        return 'metadata'
+    return method.lower()
+
+
+def _record(kind, status, seconds):
+    ms = seconds * 1000
+    with _lock:
+        stat = _stats.setdefault(kind, {'requests': 0, 'errors': 0, 'total_ms': 0.0,
+                                        'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1)})
+        stat['requests'] += 1
+        stat['errors'] += status is None or status >= 400
+        stat['total_ms'] += ms
+        stat['histogram'][bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+
+
+class _TimedSession(AuthorizedSession):
+    def request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        status = None
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            _record(_kind(method, url), status, time.perf_counter() - start)
+
+
+def _init():
+    global _client, _session
+    with _lock:
+        if _client is None:
+            credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+            _session = _TimedSession(credentials)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount('https://', adapter)
+            _client = storage.Client(project=project, credentials=credentials, _http=_session)
+
+
+def get_client():
+    _init()
+    return _client
+
+
+def authorized_session():
+    """The authorized HTTP session of the client, for requests made outside of it
+    (see uploadengine). They share its connection pool and are counted in stats()
+    """
+    _init()
+    return _session
+
+
+def get_bucket(bucket_name):
+    """Handle of the bucket. No request is made until an object is read or written"""
+    client = get_client()
+    with _lock:
+        if bucket_name not in _buckets:
+            _buckets[bucket_name] = client.bucket(bucket_name)
+        return _buckets[bucket_name]
+
+
+def stats():
+    """{kind: {requests, errors, total_ms, histogram}} of the requests made so far, by kind
+    (metadata, download, upload, ...). histogram[i] counts the requests that took up to
+    LATENCY_BUCKETS_MS[i] ms, and the last slot the slower ones
+    """
+    with _lock:
+        return {kind: dict(stat, histogram=list(stat['histogram'])) for kind, stat in _stats.items()}
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
@@ -1,10 +1,8 @@
-import json
-import ijson
 import numpy as np
 import pandas as pd
-from google.cloud import storage
 import streamlit as st
-import datetime as dt
+import idsregistry
+import outbox
 
 #@st.cache(hash_funcs={'_json.Scanner': hash})
 #@st.experimental_memo()
@@ -13,158 +11,167 @@ import datetime as dt
 
 
 def update_masterids(ids_log, ids_dict, scode):
-    client = storage.Client()
-    bucket = client.get_bucket('eu-samplemanifest')
-    blob = bucket.blob('IDSTRACKER/GP2IDSMAPPER.json')
-    #blob = bucket.blob('IDSTRACKER/GP2IDSMAPPER_for_monogenic.json')
-    #blob = bucket.blob('IDSTRACKER/TESTS_GP2IDSMAPPER.json')
-    
-    today = dt.datetime.today()
-    version = f'{today.year}{today.month}{today.day}'
-    archive_blob = bucket.blob("IDSTRACKER/ARCHIVE/{v}_{s}_GP2IDSMAPPER.json".format(v = version, s = scode))
-
-    # Create security copy
-    with blob.open("r") as fp:
-        masterids = json.load(fp)
-    with archive_blob.open("w") as fp:
-        json.dump(masterids, fp)
-    if bool(ids_dict):
-        for study, newdata in ids_log.items():
-            masterids[study].update(newdata)
-    else:
-        for study, newdata in ids_log.items():
-            masterids[study] = newdata
-    
-    # Update MASTERJSON with new IDs
-    with blob.open("w") as fp:
-        json.dump(masterids, fp)
-    
+    # ids_dict is the study tracker the new IDs were generated from.
+    # New IDs are appended to the registry journal of each study (see idsregistry)
+    masterids = idsregistry.update_studies(ids_log, scode)
+    return(masterids)
+
+def update_masterids_batch(ids_logs, scode):
+    # Commit several pending ids_log at once, one journal entry per study.
+    # Raises idsregistry.RegistryClash if the IDs clash with a concurrent commit
+    masterids = idsregistry.commit_ids(ids_logs, scode)
     return(masterids)
 
+def _commit_job(payload):
+    # Registry commit run by the outbox worker, then the email about it
+    try:
+        idsregistry.commit_ids(payload['ids_logs'], payload['scode'])
+    except idsregistry.RegistryClash as e:
+        # Other RegistryConflicts (too many concurrent commits) are retried later
+        _commit_failed(payload, e)
+        return
+    _return_leases(payload)
+    if payload.get('notify') is not None:
+        outbox.enqueue('email', payload['notify'])
+
+
+def _return_leases(payload):
+    # The numbers leased and not handed out go back to the registry only once the IDs
+    # are committed (or given up), so that no other session is leased them before
+    for lease in payload.get('leases', []):
+        idsregistry.return_lease(lease['lease'], lease['used'])
+
+
+def _commit_failed(payload, error):
+    _return_leases(payload)
+    outbox.enqueue('email', {'subject': f"{payload['scode']}: the GP2 IDs of a QC'd sample manifest were not registered",
+                             'body': f"Hey team, \n The GP2 IDs of a sample manifest QC'd by {payload['scode']} "
+                                     f"could not be registered: \n {error}"})
+
+
+outbox.register('registry_commit', _commit_job, on_failure=_commit_failed)
+
+
+def update_masterids_background(ids_logs, scode, notify=None, leases=None):
+    # Commit the pending ids_log dicts in the background (see outbox), with retries.
+    # notify ({subject, body}) is emailed to the team once they are registered.
+    # leases (idsregistry.IdLease) are released after the commit
+    ids_logs = [{study: {sample_id: list(value) for sample_id, value in ids.items()} for study, ids in ids_log.items()}
+                for ids_log in ids_logs]
+    leases = [{'lease': lease.lease, 'used': lease.position} for lease in (leases or []) if lease.lease is not None]
+    return outbox.enqueue('registry_commit', {'ids_logs': ids_logs, 'scode': scode, 'notify': notify, 'leases': leases})
+
 #@st.cache
 def master_key(studies):
-    # ACCESS MASTERGP2IDS_JSON IN GP2 BUCKET
-    client = storage.Client()
-    bucket = client.get_bucket('eu-samplemanifest')
-    blob = bucket.blob('IDSTRACKER/GP2IDSMAPPER.json')
-    #blob = bucket.blob('IDSTRACKER/GP2IDSMAPPER_for_monogenic.json')
-    #blob = bucket.blob('IDSTRACKER/TESTS_GP2IDSMAPPER.json')
-
-    ids_tracker = {}
-    for cohort in studies:
-        with blob.open("r") as f:
-        #for cohort in studies:
-            for record in ijson.items(f, cohort):
-                ids_tracker.update({cohort : record})
-    
+    # ACCESS MASTERGP2IDS IN GP2 BUCKET
+    ids_tracker = idsregistry.read_studies(studies)
     return(ids_tracker)
 
 
 def master_keyv2(studies):
-    # ACCESS MASTERGP2IDS_JSON IN GP2 BUCKET
-    client = storage.Client()
-    bucket = client.get_bucket('eu-samplemanifest')
-    blob = bucket.blob('IDSTRACKER/GP2IDSMAPPER.json')
-    #blob = bucket.blob('IDSTRACKER/GP2IDSMAPPER_for_monogenic.json')
-    #blob = bucket.blob('IDSTRACKER/TESTS_GP2IDSMAPPER.json')
-    ids_tracker = {}
-    with blob.open("r") as f:
-        for k, v in ijson.kvitems(f, ''):
-            if k in studies:
-                ids_tracker.update({k:v})
+    # ACCESS MASTERGP2IDS IN GP2 BUCKET. Only the objects of the requested studies are read
+    ids_tracker = idsregistry.read_studies(studies)
     return(ids_tracker)
 
 
+def master_sync(studies):
+    # Refresh the local index of the registry (idscache) and return the studies
+    # already in the registry. Lookups are then indexed queries on idscache
+    registered = idsregistry.sync_studies(studies)
+    return(registered)
+
+
 def master_remove(studies, data):
-    client = storage.Client()
-    bucket = client.get_bucket('eu-samplemanifest')
-    #blob = bucket.blob('IDSTRACKER/TESTS_GP2IDSMAPPER.json')
-    #blob = bucket.blob('IDSTRACKER/GP2IDSMAPPER_for_monogenic.json')
-    blob = bucket.blob('IDSTRACKER/GP2IDSMAPPER.json')
-    
-    with blob.open("r") as fp:
-        masterids = json.load(fp)
-    
-    masterids_copy = masterids.copy()
-    for study in studies:
-        study_master = masterids_copy.pop(study)
-        if len(data['sample_id'].to_list()) == len(list(study_master.keys())):
-            removestudy = masterids.pop(study)
-        else:
-            ids_remove = list(set(data['sample_id'].to_list()) & set(list(study_master.keys())))
-            for k in ids_remove:
-                removeid = study_master.pop(k, None)
-    
-    with blob.open("w") as fp:
-        json.dump(masterids, fp) # Update the json file
-    
+    masterids = idsregistry.remove_ids(studies, data['sample_id'].to_list())
     return(masterids)
 
 
+def master_rollback(studies, data, scode=None):
+    # Revert the commits that registered the sample ids of a manifest, so that it can be QCed again.
+    # Only the manifest keys are reverted, other samples committed alongside are kept.
+    # Returns the new journal entries, and {study: sample ids still registered}: those registered
+    # before the journal (legacy mapper) have no commit to revert, the team has to withdraw them
+    sample_ids = data['sample_id'].to_list()
+    entries = []
+    kept = {}
+    for study in studies:
+        for seq in idsregistry.find_commits(study, sample_ids):
+            entry = idsregistry.rollback(study, seq, sample_ids=sample_ids, scode=scode)
+            if entry is not None:
+                entries.append(entry)
+        still_registered = idsregistry.registered_sample_ids(study, sample_ids)
+        if len(still_registered) > 0:
+            kept[study] = still_registered
+    return(entries, kept)
+
+
+def _format_gp2ids(study_code, numbers, repno):
+    # Vectorized f'{study_code}_{number:06}' and f's{repno}'
+    gp2id = study_code + '_' + pd.Series(numbers).astype(str).str.zfill(6)
+    samplerepno = 's' + pd.Series(repno).astype(str)
+    return gp2id.to_numpy(dtype=object), samplerepno.to_numpy(dtype=object)
+
+
 def getgp2idsv2(dfproc, n, study_code):
+    # n is the first new GP2 ID number, or an idsregistry.IdLease to take the numbers from.
+    # The rows keep their index (the spreadsheet row of the sample, see qcengine.spreadsheet_order)
     dfproc = dfproc.sort_values('sample_id')
-    df_dups = dfproc[dfproc.duplicated(keep=False, subset=['clinical_id'])].sort_values('clinical_id').reset_index(drop = True).copy()
-    
-    if df_dups.shape[0]>0:
-        dupids_mapper = dict(zip(df_dups.clinical_id.unique(),
-                            [num+n for num in range(len(df_dups.clinical_id.unique()))]))
-        
-        df_dup_chunks = []
-        for clin_id, gp2id in dupids_mapper.items():
-            df_dups_subset = df_dups[df_dups.clinical_id==clin_id].copy()
-            df_dups_subset['GP2ID'] = [f'{study_code}_{gp2id:06}' for i in range(df_dups_subset.shape[0])]
-            df_dups_subset['SampleRepNo'] = ['s'+str(i+1) for i in range(df_dups_subset.shape[0])]
-            df_dups_subset['GP2sampleID'] = df_dups_subset['GP2ID'] + '_' + df_dups_subset['SampleRepNo']
-            df_dup_chunks.append(df_dups_subset)
-        df_dups_wids = pd.concat(df_dup_chunks)
-
-    df_nodups = dfproc[~dfproc.duplicated(keep=False, subset=['clinical_id'])].sort_values('clinical_id').reset_index(drop = True).copy()
+    clinical_dups = dfproc.duplicated(keep=False, subset=['clinical_id'])
+    df_dups = dfproc[clinical_dups].sort_values('clinical_id').copy()
+    df_nodups = dfproc[~clinical_dups].sort_values('clinical_id').copy()
+
+    if isinstance(n, idsregistry.IdLease):
+        n = n.take(df_dups['clinical_id'].nunique() + df_nodups['sample_id'].nunique())
 
+    # Replicated clinical IDs share the GP2ID. One number per clinical_id in sorted order, s1..sN per sample
+    if df_dups.shape[0]>0:
+        codes, uniques = pd.factorize(df_dups['clinical_id'])
+        gp2id, samplerepno = _format_gp2ids(study_code, codes + n,
+                                            df_dups.groupby(codes).cumcount().to_numpy() + 1)
+        df_dups['GP2ID'] = gp2id
+        df_dups['SampleRepNo'] = samplerepno
+        df_dups['GP2sampleID'] = df_dups['GP2ID'] + '_' + df_dups['SampleRepNo']
+        n = n + len(uniques)
+
+    # One number per sample_id for the rest, following the clinical_id order
     if not df_nodups.empty:
-        if df_dups.shape[0]>0:
-            n =  len(list(dupids_mapper.values())) + n
-        else:
-            n = n
-
-        uids = [str(id) for id in df_nodups['sample_id'].unique()]
-        mapid = {}
-        for uid in uids:
-            mapid[uid]= n
-            n += 1
-        df_nodups_wids = df_nodups.copy()
-        df_nodups_wids['uid_idx'] = df_nodups_wids['sample_id'].map(mapid)
-        df_nodups_wids['GP2ID'] = [f'{study_code}_{i:06}' for i in df_nodups_wids.uid_idx]
-        df_nodups_wids['uid_idx_cumcount'] = df_nodups_wids.groupby('GP2ID').cumcount() + 1
-        df_nodups_wids['GP2sampleID'] = df_nodups_wids.GP2ID + '_s' + df_nodups_wids.uid_idx_cumcount.astype('str')
-        df_nodups_wids['SampleRepNo'] = 's' + df_nodups_wids.uid_idx_cumcount.astype('str')
-        df_nodups_wids.drop(['uid_idx','uid_idx_cumcount'], axis = 1, inplace = True)
+        codes, uniques = pd.factorize(df_nodups['sample_id'])
+        gp2id, samplerepno = _format_gp2ids(study_code, codes + n,
+                                            df_nodups.groupby(codes).cumcount().to_numpy() + 1)
+        df_nodups['GP2ID'] = gp2id
+        df_nodups['GP2sampleID'] = gp2id + '_' + samplerepno
+        df_nodups['SampleRepNo'] = samplerepno
 
         if df_dups.shape[0]>0:
-            df_newids = pd.concat([df_dups_wids, df_nodups_wids])
+            df_newids = pd.concat([df_dups, df_nodups])
         else:
-            df_newids = df_nodups_wids
+            df_newids = df_nodups
     else:
-        df_newids = df_dups_wids
+        df_newids = df_dups
     
     return(df_newids)
 
-def assign_unique_gp2clinicalids(df, clinicalid_subset):
-
-    if isinstance(clinicalid_subset, pd.Series):
-        clinicalid_subset = clinicalid_subset.to_frame().T
-
-    sampleid = clinicalid_subset.sort_values(by=['master_GP2sampleID'])\
-                                .reset_index(drop = True)\
-                                .dropna(subset=['master_GP2sampleID'], axis = 0)
-    sampleid = sampleid.loc[sampleid.index[-1], 'master_GP2sampleID'].split("_")
-    getuniqueid = sampleid[0] + "_" + sampleid[1]
-    get_sidrepno = int(sampleid[2].replace("s","")) + 1
-
-    index_modify = clinicalid_subset['index'].unique() #clinicalid_subset[clinicalid_subset['GP2sampleID'].isnull()] #.index
-    assign_gp2sampleid = [getuniqueid + "_s" + str(get_sidrepno + i) for i in range(len(index_modify))]
-    df.loc[index_modify, 'GP2sampleID'] = assign_gp2sampleid
-    getnewidrows = df.loc[index_modify].copy()
-    return (getnewidrows)
+def assign_replicate_gp2ids(df, registry_matches):
+    """
+    Give the next replicate number (_sN) to the samples in df whose clinical_id is already
+    in the registry. registry_matches has the registry entries of those clinical IDs
+    (master_sample_id, master_GP2sampleID, clinical_id). The GP2sampleID column of df is
+    updated in place and the updated rows are returned, ordered by clinical_id
+    """
+    registry_matches = registry_matches.dropna(subset=['master_GP2sampleID'])
+    gp2id_repno = registry_matches['master_GP2sampleID'].str.rsplit('_', n=1, expand=True)
+    registry_reps = pd.DataFrame({'clinical_id': registry_matches['clinical_id'].to_numpy(),
+                                  'GP2ID': gp2id_repno[0].to_numpy(),
+                                  'repno': gp2id_repno[1].str.replace('s', '').astype(int).to_numpy()})
+
+    # Highest replicate number already registered for each clinical_id
+    last_rep = registry_reps.loc[registry_reps.groupby('clinical_id')['repno'].idxmax()].set_index('clinical_id')
+
+    newrows = df[df['clinical_id'].isin(last_rep.index)].sort_values('clinical_id', kind='mergesort')
+    repno = last_rep['repno'].reindex(newrows['clinical_id']).to_numpy() + newrows.groupby('clinical_id').cumcount().to_numpy() + 1
+    gp2id = last_rep['GP2ID'].reindex(newrows['clinical_id']).to_numpy()
+    df.loc[newrows.index, 'GP2sampleID'] = gp2id + '_s' + pd.Series(repno).astype(str).to_numpy(dtype=object)
+    return (df.loc[newrows.index].copy())
 
 
 
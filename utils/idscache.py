@@ -0,0 +1,214 @@
+import os
+import json
+import sqlite3
+import tempfile
+from contextlib import closing
+
+# Local index of the GP2 IDs registry. Each study is stored together with the
+# generation of the registry object it was loaded from, so it is only refreshed
+# when the object in the bucket changes. Clinical ids are looked up as strings, those
+# that are not strings in the registry are also kept as they are (json) in clinical_id_raw,
+# so get_tracker gives back the registry values
+CACHE_PATH = os.environ.get('GP2_IDS_CACHE',
+                            os.path.join(tempfile.gettempdir(), 'gp2_idsregistry.sqlite'))
+
+_SCHEMA_VERSION = 3
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS studies (
+    study TEXT PRIMARY KEY,
+    generation TEXT NOT NULL,
+    next_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ids (
+    study TEXT NOT NULL,
+    sample_id TEXT NOT NULL,
+    gp2sampleid TEXT NOT NULL,
+    clinical_id TEXT NOT NULL,
+    id_number INTEGER,
+    rep_no INTEGER,
+    clinical_id_raw TEXT,
+    PRIMARY KEY (study, sample_id)
+);
+CREATE INDEX IF NOT EXISTS ids_clinical ON ids (study, clinical_id);
+CREATE INDEX IF NOT EXISTS ids_number ON ids (study, id_number);
+CREATE INDEX IF NOT EXISTS ids_gp2sampleid ON ids (study, gp2sampleid);
+"""
+
+
+def _connect():
+    conn = sqlite3.connect(CACHE_PATH, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    if conn.execute('PRAGMA user_version').fetchone()[0] != _SCHEMA_VERSION:
+        # New file, or written by another version of the app. It is only a cache,
+        # so start again. The version is checked again under the write lock, as
+        # other sessions may be creating it at the same time
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] != _SCHEMA_VERSION:
+                conn.execute('DROP TABLE IF EXISTS studies')
+                conn.execute('DROP TABLE IF EXISTS ids')
+                for statement in _SCHEMA.split(';'):
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+    return conn
+
+
+def split_gp2sampleid(gp2sampleid):
+    """'STUDY_000012_s2' -> (12, 2). None for IDs that do not follow the GP2 format"""
+    try:
+        _, number, rep = gp2sampleid.rsplit('_', 2)
+        return int(number), int(rep.replace('s', ''))
+    except (AttributeError, ValueError):
+        return None, None
+
+
+def cached_generation(study):
+    with closing(_connect()) as conn:
+        row = conn.execute('SELECT generation FROM studies WHERE study = ?', (study,)).fetchone()
+    return None if row is None else row[0]
+
+
+def _rows(study, tracker):
+    rows = []
+    for sample_id, (gp2sampleid, clinical_id) in tracker.items():
+        number, rep = split_gp2sampleid(gp2sampleid)
+        raw = None if isinstance(clinical_id, str) else json.dumps(clinical_id)
+        rows.append((study, sample_id, gp2sampleid, str(clinical_id), number, rep, raw))
+    return rows
+
+
+def next_id_from(tracker, next_id=None):
+    """Next free GP2 ID number after the IDs of tracker, and not lower than next_id"""
+    numbers = [split_gp2sampleid(value[0])[0] for value in tracker.values()]
+    return max([number + 1 for number in numbers if number is not None] + [next_id or 1])
+
+
+def refresh(study, generation, tracker, next_id=None):
+    """Replace the study content with tracker ({sample_id: [GP2sampleID, clinical_id]}).
+    next_id is the ID counter stored in the registry, if there is one
+    """
+    rows = _rows(study, tracker)
+    with closing(_connect()) as conn, conn:
+        conn.execute('DELETE FROM ids WHERE study = ?', (study,))
+        conn.executemany('INSERT OR REPLACE INTO ids VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        conn.execute('INSERT OR REPLACE INTO studies VALUES (?, ?, ?)',
+                     (study, str(generation), next_id_from(tracker, next_id)))
+
+
+def apply_delta(study, generation, added=None, removed=None, expected=None, next_id=None):
+    """Apply a registry journal entry to the study and set its new generation.
+    If expected is given, the entry is only applied when the study is at that generation
+    """
+    rows = _rows(study, added or {})
+    with closing(_connect()) as conn, conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if expected is not None:
+            row = conn.execute('SELECT generation FROM studies WHERE study = ?', (study,)).fetchone()
+            if row is None or row[0] != str(expected):
+                return False
+        conn.executemany('DELETE FROM ids WHERE study = ? AND sample_id = ?',
+                         [(study, sample_id) for sample_id in (removed or [])])
+        conn.executemany('INSERT OR REPLACE INTO ids VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        row = conn.execute('SELECT next_id FROM studies WHERE study = ?', (study,)).fetchone()
+        next_id = next_id_from(added or {}, max(next_id or 1, 1 if row is None else row[0]))
+        conn.execute('INSERT OR REPLACE INTO studies VALUES (?, ?, ?)', (study, str(generation), next_id))
+    return True
+
+
+def invalidate(study):
+    with closing(_connect()) as conn, conn:
+        conn.execute('DELETE FROM ids WHERE study = ?', (study,))
+        conn.execute('DELETE FROM studies WHERE study = ?', (study,))
+
+
+def get_tracker(study):
+    with closing(_connect()) as conn:
+        rows = conn.execute('SELECT sample_id, gp2sampleid, clinical_id, clinical_id_raw FROM ids WHERE study = ?',
+                            (study,)).fetchall()
+    return {sample_id: [gp2sampleid, clinical_id if raw is None else json.loads(raw)]
+            for sample_id, gp2sampleid, clinical_id, raw in rows}
+
+
+def _query_with(conn, values, query, params):
+    # Load the input values in a temporary table so that lookups use the indexes
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (value TEXT PRIMARY KEY)')
+    conn.execute('DELETE FROM lookup')
+    conn.executemany('INSERT OR IGNORE INTO lookup VALUES (?)', [(str(v),) for v in values])
+    return conn.execute(query, params).fetchall()
+
+
+def existing_sample_ids(study, sample_ids):
+    """Sample ids already registered for the study"""
+    with closing(_connect()) as conn:
+        rows = _query_with(conn, sample_ids,
+                           'SELECT ids.sample_id FROM lookup JOIN ids '
+                           'ON ids.study = ? AND ids.sample_id = lookup.value', (study,))
+    return [row[0] for row in rows]
+
+
+def sample_id_entries(study, sample_ids):
+    """Registry entries (sample_id, GP2sampleID, clinical_id) of the input sample ids"""
+    with closing(_connect()) as conn:
+        rows = _query_with(conn, sample_ids,
+                           'SELECT ids.sample_id, ids.gp2sampleid, ids.clinical_id FROM lookup JOIN ids '
+                           'ON ids.study = ? AND ids.sample_id = lookup.value', (study,))
+    return rows
+
+
+def gp2sampleid_entries(study, gp2sampleids):
+    """Registry entries (sample_id, GP2sampleID, clinical_id) already using the input GP2sampleIDs"""
+    with closing(_connect()) as conn:
+        rows = _query_with(conn, gp2sampleids,
+                           'SELECT ids.sample_id, ids.gp2sampleid, ids.clinical_id FROM lookup JOIN ids '
+                           'ON ids.study = ? AND ids.gp2sampleid = lookup.value', (study,))
+    return rows
+
+
+def clinical_id_matches(study, clinical_ids):
+    """Registry entries (sample_id, GP2sampleID, clinical_id) sharing a clinical id with the input"""
+    with closing(_connect()) as conn:
+        rows = _query_with(conn, clinical_ids,
+                           'SELECT ids.sample_id, ids.gp2sampleid, ids.clinical_id FROM lookup JOIN ids '
+                           'ON ids.study = ? AND ids.clinical_id = lookup.value', (study,))
+    return rows
+
+
+def next_id_number(study):
+    """Next free GP2 ID number of the study (1 for a study with no IDs). This is the
+    registry counter, so numbers of removed IDs are never handed out again
+    """
+    with closing(_connect()) as conn:
+        row = conn.execute('SELECT next_id FROM studies WHERE study = ?', (study,)).fetchone()
+    return 1 if row is None else row[0]
+
+
+def max_id_number(study, start, end):
+    """Highest GP2 ID number registered in start..end-1, None if there is none"""
+    with closing(_connect()) as conn:
+        row = conn.execute('SELECT MAX(id_number) FROM ids WHERE study = ? AND id_number >= ? AND id_number < ?',
+                           (study, start, end)).fetchone()
+    return row[0]
+
+
+def study_rows(study):
+    """All the IDs of the study as (sample_id, GP2sampleID, clinical_id, GP2ID, id_number, rep_no)
+    rows. GP2ID, id_number and rep_no are None for irregular GP2sampleIDs
+    """
+    with closing(_connect()) as conn:
+        return conn.execute('SELECT sample_id, gp2sampleid, clinical_id, '
+                            "CASE WHEN rep_no IS NULL THEN NULL ELSE substr(gp2sampleid, 1, length(gp2sampleid) - length(rep_no) - 2) END, "
+                            'id_number, rep_no FROM ids WHERE study = ?', (study,)).fetchall()
+
+
+def sample_id_conflicts(studies):
+    """Entries (study, sample_id, GP2sampleID, clinical_id) of the sample ids registered
+    with more than one clinical id across the studies
+    """
+    with closing(_connect()) as conn:
+        rows = _query_with(conn, studies,
+                           'WITH found AS (SELECT ids.study, ids.sample_id, ids.gp2sampleid, ids.clinical_id '
+                           'FROM lookup JOIN ids ON ids.study = lookup.value) '
+                           'SELECT * FROM found WHERE sample_id IN (SELECT sample_id FROM found '
+                           'GROUP BY sample_id HAVING COUNT(DISTINCT clinical_id) > 1) '
+                           'ORDER BY sample_id, study', ())
+    return rows
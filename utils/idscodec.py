@@ -0,0 +1,75 @@
+import io
+import re
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Columnar encoding of a study tracker {sample_id: [GP2sampleID, clinical_id]}.
+# GP2sampleIDs of the form <prefix>_<number:06>_s<rep> are stored as a dictionary
+# encoded prefix, an int32 number and an int16 replicate number. Values that do not
+# round trip through that form (and clinical ids that are not strings) are kept
+# as they are in the raw columns, so decoding always gives back the same tracker.
+_GP2SAMPLEID = re.compile(r'(.*)_(\d{6,10})_s(\d{1,5})')
+
+
+def _split(gp2sampleid):
+    """(prefix, number, rep) of a GP2sampleID that encodes without loss, else None"""
+    match = _GP2SAMPLEID.fullmatch(gp2sampleid) if isinstance(gp2sampleid, str) else None
+    if match is None:
+        return None
+    prefix, number, rep = match.group(1), int(match.group(2)), int(match.group(3))
+    if number >= 2 ** 31 or rep >= 2 ** 15 or f'{prefix}_{number:06}_s{rep}' != gp2sampleid:
+        return None
+    return prefix, number, rep
+
+
+def encode_tracker(tracker):
+    """Parquet bytes of the tracker"""
+    prefixes, numbers, reps, gp2sampleid_raw = [], [], [], []
+    clinical_ids, clinical_id_raw = [], []
+    for gp2sampleid, clinical_id in tracker.values():
+        parts = _split(gp2sampleid)
+        if parts is None:
+            parts = (None, None, None)
+            gp2sampleid_raw.append(json.dumps(gp2sampleid))
+        else:
+            gp2sampleid_raw.append(None)
+        prefixes.append(parts[0])
+        numbers.append(parts[1])
+        reps.append(parts[2])
+        if isinstance(clinical_id, str):
+            clinical_ids.append(clinical_id)
+            clinical_id_raw.append(None)
+        else:
+            clinical_ids.append(None)
+            clinical_id_raw.append(json.dumps(clinical_id))
+
+    table = pa.table({
+        'sample_id': pa.array(list(tracker.keys()), type=pa.string()),
+        'prefix': pa.array(prefixes, type=pa.string()).dictionary_encode(),
+        'number': pa.array(numbers, type=pa.int32()),
+        'rep': pa.array(reps, type=pa.int16()),
+        'gp2sampleid_raw': pa.array(gp2sampleid_raw, type=pa.string()),
+        'clinical_id': pa.array(clinical_ids, type=pa.string()).dictionary_encode(),
+        'clinical_id_raw': pa.array(clinical_id_raw, type=pa.string()),
+    })
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='zstd')
+    return buffer.getvalue()
+
+
+def decode_tracker(data):
+    """Tracker encoded by encode_tracker"""
+    frame = pq.read_table(io.BytesIO(data)).to_pandas()
+    columns = zip(frame['sample_id'].tolist(),
+                  frame['prefix'].astype(object).tolist(),
+                  frame['number'].fillna(0).astype('int64').tolist(),
+                  frame['rep'].fillna(0).astype('int64').tolist(),
+                  frame['gp2sampleid_raw'].tolist(),
+                  frame['clinical_id'].astype(object).tolist(),
+                  frame['clinical_id_raw'].tolist())
+    tracker = {}
+    for sample_id, prefix, number, rep, gp2sampleid_raw, clinical_id, clinical_id_raw in columns:
+        gp2sampleid = f'{prefix}_{number:06}_s{rep}' if gp2sampleid_raw is None else json.loads(gp2sampleid_raw)
+        tracker[sample_id] = [gp2sampleid, clinical_id if clinical_id_raw is None else json.loads(clinical_id_raw)]
+    return tracker
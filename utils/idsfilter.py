@@ -0,0 +1,82 @@
+import math
+import struct
+import hashlib
+import numpy as np
+
+# Bloom filters of the sample ids and clinical ids of a study, persisted next to
+# the registry (see idsregistry) so that new ids are ruled out without reading the
+# study. A filter can answer "maybe registered" for an id that is not, never the
+# opposite, so possible matches are always confirmed against the registry.
+_HEADER = struct.Struct('>QIQQ') # m bits, k hashes, n values added, capacity
+
+
+class BloomFilter:
+    def __init__(self, m, k, capacity, n=0, bits=None):
+        self.m = m
+        self.k = k
+        self.capacity = capacity
+        self.n = n
+        self.bits = np.zeros((m + 7) // 8, dtype=np.uint8) if bits is None else bits
+
+    @classmethod
+    def for_capacity(cls, capacity, fpr=0.01):
+        """Filter with a false positive rate of fpr up to capacity values"""
+        capacity = max(int(capacity), 1000)
+        m = int(math.ceil(-capacity * math.log(fpr) / math.log(2) ** 2))
+        k = max(1, int(round(m / capacity * math.log(2))))
+        return cls(m, k, capacity)
+
+    def _positions(self, values):
+        # Double hashing: position i of a value is h1 + i * h2 (mod m)
+        digests = b''.join(hashlib.blake2b(str(value).encode('utf-8'), digest_size=16).digest()
+                           for value in values)
+        hashes = np.frombuffer(digests, dtype='<u8').reshape(-1, 2)
+        steps = np.arange(self.k, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            return (hashes[:, :1] + steps * hashes[:, 1:]) % np.uint64(self.m)
+
+    def add(self, values):
+        values = list(values)
+        if len(values) == 0:
+            return
+        positions = self._positions(values).ravel()
+        np.bitwise_or.at(self.bits, (positions >> np.uint64(3)).astype(np.int64),
+                         (np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)))
+        self.n += len(values)
+
+    def contains(self, values):
+        """Boolean array, False for the values that were never added"""
+        values = list(values)
+        if len(values) == 0:
+            return np.zeros(0, dtype=bool)
+        positions = self._positions(values)
+        bits = self.bits[(positions >> np.uint64(3)).astype(np.int64)] >> (positions & np.uint64(7)).astype(np.uint8)
+        return (bits & 1).astype(bool).all(axis=1)
+
+    def full(self):
+        return self.n > self.capacity
+
+    def to_bytes(self):
+        return _HEADER.pack(self.m, self.k, self.n, self.capacity) + self.bits.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        m, k, n, capacity = _HEADER.unpack_from(data)
+        bits = np.frombuffer(data, dtype=np.uint8, count=(m + 7) // 8, offset=_HEADER.size).copy()
+        return cls(m, k, capacity, n=n, bits=bits)
+
+
+def dump_filters(filters):
+    """Pack a list of filters into one object"""
+    chunks = [filt.to_bytes() for filt in filters]
+    return b''.join(struct.pack('>Q', len(chunk)) + chunk for chunk in chunks)
+
+
+def load_filters(data):
+    filters = []
+    offset = 0
+    while offset < len(data):
+        size, = struct.unpack_from('>Q', data, offset)
+        filters.append(BloomFilter.from_bytes(data[offset + 8:offset + 8 + size]))
+        offset += 8 + size
+    return filters
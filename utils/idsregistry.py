@@ -0,0 +1,1053 @@
+import re
+import io
+import gzip
+import json
+import time
+import uuid
+import random
+import ijson
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from google.api_core.exceptions import PreconditionFailed
+import storagebackend
+import idscache
+import idsfilter
+import idscodec
+import singleflight
+
+# GP2 IDs registry layout in the bucket
+#   IDSTRACKER/GP2IDSMAPPER.json                     legacy monolithic mapper (read only once migrated)
+#   IDSTRACKER/REGISTRY/MAPPER_INDEX.json            byte range of each study in the legacy mapper
+#   IDSTRACKER/REGISTRY/MANIFEST.json                small index of the studies in the registry
+#   IDSTRACKER/REGISTRY/STUDIES/<study>.json         base snapshot of a study {sample_id: [GP2sampleID, clinical_id]},
+#                                                    Parquet encoded (see idscodec) when its 'encoding' metadata says so
+#   IDSTRACKER/REGISTRY/JOURNAL/<study>/<seq>.json   one entry per update of the study, never deleted
+#   IDSTRACKER/REGISTRY/LEASES/<study>.json          GP2 ID number ranges handed out to QC sessions
+#   IDSTRACKER/REGISTRY/FILTERS/<study>.bloom        Bloom filters of the sample and clinical ids of a study
+#   IDSTRACKER/REGISTRY/CATALOG/<study>.json         date, op and GP2 ID numbers of every journal entry of a study
+# A study is its base snapshot plus the journal entries after the 'journal_seq'
+# recorded in the snapshot metadata. The journal is the audit trail of the registry.
+# Each entry and snapshot also records 'next_id', the high-water mark of the study's
+# GP2 ID numbers, so new numbers are allocated without scanning the IDs and numbers
+# of removed IDs are never reused.
+#
+# The json objects written by the registry are gzip compressed, with Content-Encoding
+# gzip. They are downloaded raw and decompressed here, and objects written uncompressed
+# (such as the legacy mapper) are read as they are.
+#
+# Every write is conditional on the generation of the object that was read, so
+# concurrent sessions never overwrite each other: journal entries are create-only,
+# and the manifest and snapshots are re-read, merged and retried on conflict.
+BUCKET_NAME = storagebackend.BUCKET_NAME
+MAPPER_PATH = 'IDSTRACKER/GP2IDSMAPPER.json'
+REGISTRY_PREFIX = 'IDSTRACKER/REGISTRY'
+MANIFEST_PATH = f'{REGISTRY_PREFIX}/MANIFEST.json'
+MAPPER_INDEX_PATH = f'{REGISTRY_PREFIX}/MAPPER_INDEX.json'
+COMPACT_EVERY = 20 # journal entries folded into a new base snapshot
+MAX_ATTEMPTS = 10
+LEASE_SIZE = 1000 # GP2 ID numbers leased to a session at a time
+LEASE_TTL = dt.timedelta(days=2) # leases older than this are considered abandoned
+
+
+class RegistryConflict(Exception):
+    """The registry could not be updated because of concurrent commits"""
+
+
+class RegistryClash(RegistryConflict):
+    """IDs to commit are already registered with different values. Unlike other
+    conflicts, committing them again will not help
+    """
+
+
+def get_bucket():
+    return storagebackend.get_bucket(BUCKET_NAME)
+
+
+def study_path(study):
+    return f'{REGISTRY_PREFIX}/STUDIES/{quote(study, safe="")}.json'
+
+
+def journal_prefix(study):
+    return f'{REGISTRY_PREFIX}/JOURNAL/{quote(study, safe="")}/'
+
+
+def journal_path(study, seq):
+    return f'{journal_prefix(study)}{seq:08d}.json'
+
+
+def filter_path(study):
+    return f'{REGISTRY_PREFIX}/FILTERS/{quote(study, safe="")}.bloom'
+
+
+def lease_path(study):
+    return f'{REGISTRY_PREFIX}/LEASES/{quote(study, safe="")}.json'
+
+
+def catalog_path(study):
+    return f'{REGISTRY_PREFIX}/CATALOG/{quote(study, safe="")}.json'
+
+
+def _today():
+    today = dt.datetime.today()
+    return f'{today.year}{today.month}{today.day}'
+
+
+def _backoff(attempt):
+    time.sleep(random.uniform(0, 0.05 * 2 ** min(attempt, 5)))
+
+
+def _download(blob, **kwargs):
+    """Content of the blob, decompressed if it is stored gzip encoded"""
+    data = blob.download_as_bytes(raw_download=True, **kwargs)
+    return gzip.decompress(data) if blob.content_encoding == 'gzip' else data
+
+
+# Downloads shared by the sessions of the process (see singleflight), keyed by object
+# generation. Snapshots and journal entries are shared parsed, filters as bytes
+# since their readers add to them
+_snapshots = singleflight.SingleFlight(maxsize=8)
+_entries = singleflight.SingleFlight(maxsize=4096)
+_filters = singleflight.SingleFlight(maxsize=64)
+_refreshes = singleflight.SingleFlight(maxsize=0) # only coalesces the refreshes in flight
+
+
+def _read_shared(reads, blob, parse):
+    """parse(data) of the blob, downloaded once per generation by the process"""
+    return reads.get((blob.bucket.name, blob.name, blob.generation),
+                     lambda: parse(_download(blob, if_generation_match=blob.generation)))
+
+
+def _read_entry(blob):
+    return _read_shared(_entries, blob, json.loads)
+
+
+def _read_json(bucket, path):
+    """Return (content, generation) of a json object, (None, 0) if it does not exist"""
+    for attempt in range(MAX_ATTEMPTS):
+        blob = bucket.get_blob(path)
+        if blob is None:
+            return None, 0
+        try:
+            return json.loads(_download(blob, if_generation_match=blob.generation)), blob.generation
+        except PreconditionFailed: # Updated between the metadata and the download
+            _backoff(attempt)
+    raise RegistryConflict(f'Could not get a consistent read of {path}')
+
+
+def _write_object(bucket, path, data, content_type, metadata=None, if_generation_match=None, compress=False):
+    """Write an object and return its new generation. if_generation_match=0 only creates it"""
+    blob = bucket.blob(path)
+    blob.metadata = metadata
+    if compress:
+        data = gzip.compress(data.encode('utf-8') if isinstance(data, str) else data)
+        blob.content_encoding = 'gzip'
+    blob.upload_from_string(data, content_type=content_type, if_generation_match=if_generation_match)
+    return blob.generation
+
+
+def _write_json(bucket, path, obj, metadata=None, if_generation_match=None):
+    return _write_object(bucket, path, json.dumps(obj), 'application/json',
+                         metadata=metadata, if_generation_match=if_generation_match, compress=True)
+
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _Truncated(Exception):
+    pass
+
+
+def _scan_offsets(f, chunk_size=1 << 22):
+    """Byte range [start, end) of the value of each key of the top level object in the
+    binary file f. Values are skipped with the C JSON decoder one at a time, and the file
+    is decoded as latin-1 so that character offsets are byte offsets
+    """
+    offsets = {}
+    text = ''
+    position = 0 # offset of text[0] in the file
+    i = 0
+    eof = False
+    state = 'start'
+    while state != 'end':
+        try:
+            i = _WHITESPACE.match(text, i).end()
+            if i == len(text):
+                raise _Truncated
+            if state == 'start':
+                if text[i] != '{':
+                    raise ValueError('The mapper is not a JSON object')
+                i += 1
+                state = 'key'
+            elif state == 'key':
+                if text[i] == '}':
+                    state = 'end'
+                    continue
+                _, end = _DECODER.raw_decode(text, i)
+                key = json.loads(text[i:end].encode('latin-1'))
+                i = end
+                state = 'colon'
+            elif state == 'colon':
+                if text[i] != ':':
+                    raise ValueError('The mapper is not a valid JSON object')
+                i += 1
+                state = 'value'
+            elif state == 'value':
+                _, end = _DECODER.raw_decode(text, i)
+                if end == len(text) and not eof: # A number may go on in the next chunk
+                    raise _Truncated
+                offsets[key] = [position + i, position + end]
+                i = end
+                state = 'next'
+            elif state == 'next':
+                state = 'key' if text[i] == ',' else 'end'
+                i += 1
+        except (_Truncated, json.JSONDecodeError):
+            if eof:
+                raise ValueError('The mapper is not a valid JSON object')
+            chunk = f.read(max(chunk_size, len(text))) # at least double the text when a value is cut
+            eof = len(chunk) == 0
+            text = text[i:] + chunk.decode('latin-1')
+            position += i
+            i = 0
+    return offsets
+
+
+def _mapper_index(bucket):
+    """Byte range of each study in the monolithic mapper, from the sidecar index.
+    The index is rebuilt if the mapper changed since it was written
+    """
+    blob = bucket.get_blob(MAPPER_PATH)
+    if blob is None:
+        return {'generation': 0, 'studies': {}}
+    index, index_generation = _read_json(bucket, MAPPER_INDEX_PATH)
+    if index is not None and index['generation'] == blob.generation:
+        return index
+    if blob.content_encoding == 'gzip':
+        # Byte ranges do not apply to a compressed mapper, only its keys are listed
+        with gzip.GzipFile(fileobj=io.BytesIO(blob.download_as_bytes(raw_download=True))) as f:
+            index = {'source': MAPPER_PATH, 'generation': blob.generation, 'content_encoding': 'gzip',
+                     'studies': _scan_offsets(f)}
+    else:
+        with blob.open("rb") as f:
+            index = {'source': MAPPER_PATH, 'generation': blob.generation, 'studies': _scan_offsets(f)}
+    try:
+        _write_json(bucket, MAPPER_INDEX_PATH, index, if_generation_match=index_generation)
+    except PreconditionFailed: # Written by another session meanwhile
+        pass
+    return index
+
+
+def _legacy_studies(bucket):
+    """Top level keys of the monolithic mapper"""
+    return list(_mapper_index(bucket)['studies'].keys())
+
+
+def load_manifest(bucket):
+    """Get the registry manifest. The first time the sharded registry is used,
+    the manifest is created from the monolithic mapper. Legacy studies are moved
+    to their own object the first time they are read (see read_studies)
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        manifest, generation = _read_json(bucket, MANIFEST_PATH)
+        if manifest is not None:
+            return manifest
+        manifest = {'version': 1,
+                    'created': _today(),
+                    'legacy_source': MAPPER_PATH,
+                    'legacy_studies': _legacy_studies(bucket),
+                    'studies': {}}
+        try:
+            _write_json(bucket, MANIFEST_PATH, manifest, if_generation_match=0)
+            return manifest
+        except PreconditionFailed: # Created by another session
+            _backoff(attempt)
+    raise RegistryConflict('Could not create the registry manifest')
+
+
+def _update_manifest(bucket, studies, migrated=()):
+    """Add the studies ({study: manifest entry}) to the manifest, re-reading and
+    merging if another session updated it meanwhile
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        manifest, generation = _read_json(bucket, MANIFEST_PATH)
+        manifest['studies'].update(studies)
+        manifest['legacy_studies'] = [study for study in manifest['legacy_studies'] if study not in migrated]
+        try:
+            _write_json(bucket, MANIFEST_PATH, manifest, if_generation_match=generation)
+            return manifest
+        except PreconditionFailed:
+            _backoff(attempt)
+    raise RegistryConflict('Could not update the registry manifest')
+
+
+def _manifest_entry(study, tracker):
+    return {'path': study_path(study),
+            'n_ids': len(tracker), # as of the base snapshot
+            'updated': _today()}
+
+
+def _write_study(bucket, study, tracker, seq, if_generation_match, next_id=None):
+    """Write the base snapshot of the study, including the journal up to seq.
+    Returns False if the snapshot was updated by another session
+    """
+    next_id = idscache.next_id_from(tracker, next_id)
+    try:
+        generation = _write_object(bucket, study_path(study), idscodec.encode_tracker(tracker),
+                                   'application/vnd.apache.parquet',
+                                   metadata={'journal_seq': str(seq), 'next_id': str(next_id), 'encoding': 'parquet'},
+                                   if_generation_match=if_generation_match)
+    except PreconditionFailed:
+        return False
+    idscache.refresh(study, f'{generation}:{seq}', tracker, next_id)
+    return True
+
+
+def _read_legacy(bucket, studies):
+    """{study: tracker} of the given studies in the monolithic mapper. Only the
+    byte range of each study is downloaded, unless the mapper is compressed
+    """
+    index = _mapper_index(bucket)
+    blob = bucket.blob(MAPPER_PATH)
+    migrated = {}
+    if index.get('content_encoding') == 'gzip':
+        data = blob.download_as_bytes(raw_download=True, if_generation_match=index['generation'])
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+            for k, v in ijson.kvitems(f, ''):
+                if k in studies:
+                    migrated[k] = v
+                    if len(migrated) == len(studies):
+                        break
+    else:
+        for study in studies:
+            if study in index['studies']:
+                start, end = index['studies'][study]
+                migrated[study] = json.loads(blob.download_as_bytes(start=start, end=end - 1,
+                                                                    if_generation_match=index['generation']))
+    return migrated
+
+
+def _migrate_studies(bucket, studies):
+    """Copy the given legacy studies from the monolithic mapper into their own objects"""
+    migrated = _read_legacy(bucket, studies)
+    for study, tracker in migrated.items():
+        _write_study(bucket, study, tracker, 0, if_generation_match=0)
+    _update_manifest(bucket,
+                     {study: _manifest_entry(study, tracker) for study, tracker in migrated.items()},
+                     migrated=list(migrated.keys()))
+    return {study: _sync_study(bucket, study) for study in migrated}
+
+
+def _journal_blobs(bucket, study, after=0):
+    """Journal entries of the study with a seq greater than after, in order"""
+    blobs = bucket.list_blobs(prefix=journal_prefix(study),
+                              start_offset=journal_path(study, after + 1))
+    return sorted(blobs, key=lambda blob: blob.name)
+
+
+def _cached_seq(study):
+    cached = idscache.cached_generation(study)
+    return -1 if cached is None else int(cached.split(':')[1])
+
+
+def _cache_entry(study, entry):
+    cached = idscache.cached_generation(study)
+    if cached is None:
+        return False
+    base_generation = cached.split(':')[0]
+    generation = f"{base_generation}:{entry['seq']}"
+    expected = f"{base_generation}:{entry['seq'] - 1}"
+    next_id = entry.get('next_id') # missing in entries written before the counter existed
+    if entry['op'] == 'add':
+        return idscache.apply_delta(study, generation, added=entry['ids'], expected=expected, next_id=next_id)
+    elif entry['op'] == 'remove':
+        return idscache.apply_delta(study, generation, removed=entry['ids'], expected=expected, next_id=next_id)
+
+
+def _refresh_study(study, blob):
+    """Load the base snapshot in the blob into the local index"""
+    metadata = blob.metadata or {}
+    # Snapshots written before the Parquet encoding are json
+    decode = idscodec.decode_tracker if metadata.get('encoding') == 'parquet' else json.loads
+    tracker = _read_shared(_snapshots, blob, decode)
+    next_id = int(metadata['next_id']) if 'next_id' in metadata else None
+    idscache.refresh(study, f"{blob.generation}:{metadata.get('journal_seq', 0)}", tracker, next_id)
+
+
+def _sync_study(bucket, study):
+    """Make sure the local index holds the current version of the study and
+    return the seq of its last journal entry (None if the study is not in the registry).
+    The base snapshot is only downloaded when it changed, then only new entries are read
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        blob = bucket.get_blob(study_path(study))
+        if blob is None:
+            idscache.invalidate(study)
+            return None
+        metadata = blob.metadata or {}
+        base_seq = int(metadata.get('journal_seq', 0))
+        cached = (idscache.cached_generation(study) or ':-1').split(':')
+        if cached[0] == str(blob.generation):
+            seq = int(cached[1])
+        else:
+            try:
+                # Sessions syncing the study at the same time load the snapshot in the local index once
+                _refreshes.get((idscache.CACHE_PATH, study, blob.generation), lambda: _refresh_study(study, blob))
+            except PreconditionFailed: # Compacted by another session meanwhile
+                _backoff(attempt)
+                continue
+            seq = base_seq
+
+        in_sync = True
+        for entry_blob in _journal_blobs(bucket, study, after=seq):
+            entry = _read_entry(entry_blob)
+            if not _cache_entry(study, entry) and _cached_seq(study) < entry['seq']:
+                in_sync = False # The local index was changed by another session meanwhile
+                break
+            seq = entry['seq']
+        if in_sync:
+            return seq
+    raise RegistryConflict(f'Could not get a consistent read of {study}')
+
+
+def _sync_studies(bucket, manifest, studies):
+    heads = {}
+    legacy = []
+    for study in studies:
+        if study in manifest['legacy_studies']:
+            legacy.append(study)
+        else:
+            seq = _sync_study(bucket, study)
+            if seq is not None:
+                heads[study] = seq
+    if len(legacy) > 0:
+        heads.update(_migrate_studies(bucket, legacy))
+    return heads
+
+
+def _read_studies(bucket, manifest, studies):
+    heads = _sync_studies(bucket, manifest, studies)
+    return {study: idscache.get_tracker(study) for study in heads}
+
+
+def read_studies(studies, bucket=None):
+    """Return {study: {sample_id: [GP2sampleID, clinical_id]}} for the studies
+    already in the registry. Studies not in the registry are not returned
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    manifest = load_manifest(bucket)
+    return _read_studies(bucket, manifest, studies)
+
+
+def sync_studies(studies, bucket=None):
+    """Refresh the local index (see idscache) for the studies and return
+    the ones already in the registry
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    manifest = load_manifest(bucket)
+    return list(_sync_studies(bucket, manifest, studies).keys())
+
+
+def next_id_numbers(studies, bucket=None):
+    """Return {study: next free GP2 ID number} from the registry counters.
+    Studies not in the registry start at 1
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    manifest = load_manifest(bucket)
+    _sync_studies(bucket, manifest, studies)
+    return {study: idscache.next_id_number(study) for study in studies}
+
+
+def read_journal(study, bucket=None):
+    """All the journal entries of the study, oldest first"""
+    bucket = bucket if bucket is not None else get_bucket()
+    return [_read_entry(blob) for blob in _journal_blobs(bucket, study)]
+
+
+# Catalog of the journal. The catalog object of a study lists every journal entry
+# with its date, op and the runs of GP2 ID numbers it touched, up to 'journal_seq'.
+# It is brought up to date when it is read, so point-in-time queries and GP2 ID
+# lookups only download the journal entries they need.
+
+_GP2SAMPLEID = re.compile(r'(.+_\d+)_s\d+')
+
+
+def _number_runs(ids):
+    """[[first, last], ...] runs of the GP2 ID numbers of {sample_id: [GP2sampleID, clinical_id]}"""
+    numbers = sorted(set(idscache.split_gp2sampleid(value[0])[0] for value in ids.values()) - {None})
+    runs = []
+    for number in numbers:
+        if len(runs) > 0 and runs[-1][1] == number - 1:
+            runs[-1][1] = number
+        else:
+            runs.append([number, number])
+    return runs
+
+
+def _catalog_entry(entry):
+    ids = entry['ids'] if entry['op'] == 'add' else entry.get('removed', {})
+    return {'seq': entry['seq'],
+            'date': entry['date'],
+            'scode': entry['scode'],
+            'op': entry['op'],
+            'n_ids': len(entry['ids']),
+            'numbers': _number_runs(ids)}
+
+
+def study_catalog(study, bucket=None):
+    """Catalog of the journal of the study: {study, journal_seq, entries: [{seq, date,
+    scode, op, n_ids, numbers}]}. Only the entries written since it was last read are downloaded
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    for attempt in range(MAX_ATTEMPTS):
+        catalog, generation = _read_json(bucket, catalog_path(study))
+        if catalog is None:
+            catalog = {'study': study, 'journal_seq': 0, 'entries': []}
+        blobs = _journal_blobs(bucket, study, after=catalog['journal_seq'])
+        if len(blobs) == 0:
+            return catalog
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            entries = list(pool.map(_read_entry, blobs))
+        catalog['entries'] += [_catalog_entry(entry) for entry in entries]
+        catalog['journal_seq'] = entries[-1]['seq']
+        try:
+            _write_json(bucket, catalog_path(study), catalog, if_generation_match=generation)
+            return catalog
+        except PreconditionFailed: # Updated by another session meanwhile
+            _backoff(attempt)
+    return catalog # Up to date in memory, the next reader writes it
+
+
+def _as_of(date):
+    """Upper bound of the journal dates (isoformat) up to date: a date includes the whole day"""
+    if isinstance(date, str):
+        date = dt.date.fromisoformat(date) if len(date) == 10 else dt.datetime.fromisoformat(date)
+    if isinstance(date, dt.datetime):
+        return date.isoformat(timespec='seconds')
+    return f'{date.isoformat()}T23:59:59'
+
+
+def study_at(study, date, bucket=None):
+    """{sample_id: [GP2sampleID, clinical_id]} of the study as it was at date (a date,
+    datetime or isoformat string). The study is replayed from the legacy mapper, or
+    from empty, with the journal entries written up to date only
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    until = _as_of(date)
+    seqs = [entry['seq'] for entry in study_catalog(study, bucket)['entries'] if entry['date'] <= until]
+    tracker = _read_legacy(bucket, [study]).get(study, {})
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        entries = pool.map(lambda seq: _read_entry(bucket.get_blob(journal_path(study, seq))), seqs)
+        for entry in entries:
+            if entry['op'] == 'add':
+                tracker.update(entry['ids'])
+            else:
+                for sample_id in entry['ids']:
+                    tracker.pop(sample_id, None)
+    return tracker
+
+
+def gp2id_history(study, gp2id, bucket=None):
+    """Journal entries of the study that added or removed the GP2 ID ('STUDY_000012',
+    or a GP2sampleID), oldest first, with only the IDs of that GP2 ID. An ID in the
+    legacy mapper is reported as an entry with seq 0 and no date
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    match = _GP2SAMPLEID.fullmatch(gp2id)
+    gp2id = gp2id if match is None else match.group(1)
+    number = int(gp2id.rsplit('_', 1)[1])
+
+    def matching(ids):
+        return {sample_id: value for sample_id, value in ids.items() if value[0].rsplit('_', 1)[0] == gp2id}
+
+    history = []
+    legacy = matching(_read_legacy(bucket, [study]).get(study, {}))
+    if len(legacy) > 0:
+        history.append({'seq': 0, 'date': None, 'scode': None, 'op': 'add', 'ids': legacy})
+    seqs = [entry['seq'] for entry in study_catalog(study, bucket)['entries']
+            if any(first <= number <= last for first, last in entry['numbers'])]
+    for seq in seqs:
+        entry = _read_entry(bucket.get_blob(journal_path(study, seq)))
+        ids = matching(entry['ids'] if entry['op'] == 'add' else entry['removed'])
+        history.append({'seq': seq, 'date': entry['date'], 'scode': entry['scode'], 'op': entry['op'], 'ids': ids})
+    return history
+
+
+# Membership filters. The filters object of a study holds Bloom filters of its sample
+# ids and clinical ids up to the 'journal_seq' in its metadata. Commits bring it up
+# to the journal head, and readers add the entries written since in memory, so a
+# filter never misses a registered id. Removed ids stay in the filters until the
+# next compaction rebuilds them.
+
+def _read_filters(bucket, study):
+    """Return (filters, journal_seq, generation), (None, None, 0) if there are none yet"""
+    for attempt in range(MAX_ATTEMPTS):
+        blob = bucket.get_blob(filter_path(study))
+        if blob is None:
+            return None, None, 0
+        try:
+            data = _read_shared(_filters, blob, bytes)
+        except PreconditionFailed:
+            _backoff(attempt)
+            continue
+        return idsfilter.load_filters(data), int(blob.metadata['journal_seq']), blob.generation
+    raise RegistryConflict(f'Could not get a consistent read of {filter_path(study)}')
+
+
+def _add_to_filters(filters, ids):
+    filters[0].add(ids.keys())
+    filters[1].add(str(value[1]) for value in ids.values())
+
+
+def _catch_up_filters(bucket, study, filters, seq):
+    """Add the IDs of the journal entries after seq to the filters and return the new seq"""
+    for blob in _journal_blobs(bucket, study, after=seq):
+        entry = _read_entry(blob)
+        if entry['op'] == 'add':
+            _add_to_filters(filters, entry['ids'])
+        seq = entry['seq']
+    return seq
+
+
+def _build_filters(bucket, study):
+    """Filters of the study from a full read of the registry. None if it is not registered"""
+    seq = _sync_studies(bucket, load_manifest(bucket), [study]).get(study)
+    if seq is None:
+        return None, None
+    tracker = idscache.get_tracker(study)
+    filters = [idsfilter.BloomFilter.for_capacity(2 * len(tracker)) for _ in range(2)]
+    _add_to_filters(filters, tracker)
+    return filters, seq
+
+
+def _update_filters(bucket, study, rebuild=False):
+    """Bring the persisted filters of the study up to the journal head, rebuilding them
+    if asked to (after a compaction) or once they hold more ids than they were sized for.
+    Returns the filters, or None if the study is not registered
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        filters, seq, generation = _read_filters(bucket, study)
+        if filters is None or rebuild or any(filt.full() for filt in filters):
+            filters, seq = _build_filters(bucket, study)
+            if filters is None:
+                return None
+        else:
+            head = _catch_up_filters(bucket, study, filters, seq)
+            if head == seq:
+                return filters
+            seq = head
+        try:
+            _write_object(bucket, filter_path(study), idsfilter.dump_filters(filters), 'application/octet-stream',
+                          metadata={'journal_seq': str(seq)}, if_generation_match=generation)
+            return filters
+        except PreconditionFailed: # Updated by another session meanwhile
+            _backoff(attempt)
+    return filters # Up to date in memory, the next commit writes them
+
+
+def _current_filters(bucket, study):
+    filters, seq, _ = _read_filters(bucket, study)
+    if filters is None:
+        return _update_filters(bucket, study)
+    _catch_up_filters(bucket, study, filters, seq)
+    return filters
+
+
+def registered_studies(studies, bucket=None):
+    """The studies already in the registry, from the manifest only"""
+    bucket = bucket if bucket is not None else get_bucket()
+    manifest = load_manifest(bucket)
+    return [study for study in studies if study in manifest['studies'] or study in manifest['legacy_studies']]
+
+
+def registered_sample_ids(study, sample_ids, bucket=None):
+    """Sample ids already registered for the study. New sample ids are ruled out by the
+    study's Bloom filter, and only possible matches are looked up in the registry
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    sample_ids = [str(sample_id) for sample_id in sample_ids]
+    filters = _current_filters(bucket, study)
+    if filters is None:
+        return []
+    maybe = [sample_id for sample_id, hit in zip(sample_ids, filters[0].contains(sample_ids)) if hit]
+    if len(maybe) == 0:
+        return []
+    _sync_studies(bucket, load_manifest(bucket), [study])
+    return idscache.existing_sample_ids(study, maybe)
+
+
+def registered_clinical_matches(study, clinical_ids, bucket=None):
+    """Registry entries (sample_id, GP2sampleID, clinical_id) sharing a clinical id with
+    the input. The registry is only read if the Bloom filter finds possible matches
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    clinical_ids = [str(clinical_id) for clinical_id in clinical_ids]
+    filters = _current_filters(bucket, study)
+    if filters is None:
+        return []
+    maybe = [clinical_id for clinical_id, hit in zip(clinical_ids, filters[1].contains(clinical_ids)) if hit]
+    if len(maybe) == 0:
+        return []
+    _sync_studies(bucket, load_manifest(bucket), [study])
+    return idscache.clinical_id_matches(study, maybe)
+
+
+def _check_merge(study, ids):
+    """Check new IDs against the registry after another session committed.
+    Returns the IDs still to commit, and raises RegistryClash if a sample id
+    or a GP2sampleID is already registered with a different value
+    """
+    registered = {sample_id: [gp2sampleid, clinical_id]
+                  for sample_id, gp2sampleid, clinical_id in idscache.sample_id_entries(study, ids.keys())}
+    clashes = [sample_id for sample_id, value in ids.items()
+               if sample_id in registered and registered[sample_id] != [value[0], str(value[1])]]
+    owners = idscache.gp2sampleid_entries(study, [value[0] for value in ids.values()])
+    clashes += [sample_id for sample_id, gp2sampleid, _ in owners
+                if sample_id not in ids or ids[sample_id][0] != gp2sampleid]
+    if len(clashes) > 0:
+        raise RegistryClash(f'{study}: IDs committed by another session clash with {sorted(set(clashes))[:10]}')
+    return {sample_id: value for sample_id, value in ids.items() if sample_id not in registered}
+
+
+def _compact(bucket, study, seq, force=False):
+    """Fold the journal into a new base snapshot every COMPACT_EVERY entries"""
+    if seq % COMPACT_EVERY != 0 and not force:
+        return None
+    cached = idscache.cached_generation(study)
+    if cached is None: # Invalidated by another session meanwhile
+        return None
+    base_generation, cached_seq = cached.split(':')
+    if int(cached_seq) != seq: # The local index moved on, leave it to the next commit
+        return None
+    tracker = idscache.get_tracker(study)
+    if _write_study(bucket, study, tracker, seq, if_generation_match=int(base_generation),
+                    next_id=idscache.next_id_number(study)):
+        return _manifest_entry(study, tracker)
+    return None # Already compacted by another session
+
+
+def _commit_entry(bucket, study, op, ids, scode, reverts=None):
+    """Append an entry to the journal of the study. When another session takes the
+    same seq first, its entry is read and merged before trying the next seq.
+    Remove entries keep the values removed, so that they can be rolled back. When
+    ids is a dict for a removal, only the sample ids still registered with those
+    values are removed
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        seq = _sync_study(bucket, study)
+        if op == 'add':
+            ids = _check_merge(study, ids)
+        else:
+            removed = {sample_id: [gp2sampleid, clinical_id]
+                       for sample_id, gp2sampleid, clinical_id in idscache.sample_id_entries(study, ids)}
+            if isinstance(ids, dict):
+                removed = {sample_id: value for sample_id, value in removed.items()
+                           if value == [ids[sample_id][0], str(ids[sample_id][1])]}
+            ids = sorted(removed.keys())
+        if len(ids) == 0: # Nothing left to commit
+            return None
+        next_id = idscache.next_id_number(study)
+        if op == 'add':
+            next_id = idscache.next_id_from(ids, next_id)
+        entry = {'seq': seq + 1,
+                 'study': study,
+                 'scode': scode,
+                 'date': dt.datetime.now().isoformat(timespec='seconds'),
+                 'op': op,
+                 'ids': ids,
+                 'next_id': next_id}
+        if op == 'remove':
+            entry['removed'] = {sample_id: removed[sample_id] for sample_id in ids}
+        if reverts is not None:
+            entry['reverts'] = reverts
+        try:
+            _write_json(bucket, journal_path(study, seq + 1), entry, if_generation_match=0)
+        except PreconditionFailed:
+            _backoff(attempt)
+            continue
+        _cache_entry(study, entry)
+        return entry
+    raise RegistryConflict(f'Could not commit to {study} after {MAX_ATTEMPTS} attempts')
+
+
+def commit_ids(ids_logs, scode, bucket=None):
+    """Commit a batch of pending ids_log dicts ({study: {sample_id: [GP2sampleID, clinical_id]}})
+    to the registry, as one journal entry per study. Returns the entries written
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    manifest = load_manifest(bucket)
+
+    batch = {}
+    for ids_log in ids_logs:
+        for study, newdata in ids_log.items():
+            batch.setdefault(study, {}).update({sample_id: [value[0], value[1]]
+                                                for sample_id, value in newdata.items()})
+    heads = _sync_studies(bucket, manifest, list(batch.keys()))
+
+    entries = {}
+    manifest_update = {}
+    for study, newdata in batch.items():
+        if study not in heads:
+            # Brand new study. Start with an empty base snapshot, unless another session just did
+            _write_study(bucket, study, {}, 0, if_generation_match=0)
+            manifest_update[study] = _manifest_entry(study, {})
+        entry = _commit_entry(bucket, study, 'add', newdata, scode)
+        if entry is not None:
+            entries[study] = entry
+            compacted = _compact(bucket, study, entry['seq'])
+            if compacted is not None:
+                manifest_update[study] = compacted
+            _update_filters(bucket, study, rebuild=compacted is not None)
+    if len(manifest_update) > 0:
+        _update_manifest(bucket, manifest_update)
+    return entries
+
+
+def update_studies(ids_log, scode, bucket=None):
+    """Write the new IDs in ids_log ({study: {sample_id: [GP2sampleID, clinical_id]}})
+    to the registry as one journal entry per study. Returns the entries written
+    """
+    return commit_ids([ids_log], scode, bucket=bucket)
+
+
+def remove_ids(studies, sample_ids, scode=None, bucket=None):
+    """Remove sample ids from the studies. The study is kept in the registry
+    (with no IDs) when all its sample ids are removed, so its journal carries on
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    manifest = load_manifest(bucket)
+    heads = _sync_studies(bucket, manifest, studies)
+
+    entries = {}
+    manifest_update = {}
+    for study in heads:
+        entry = _commit_entry(bucket, study, 'remove', list(sample_ids), scode)
+        if entry is not None:
+            entries[study] = entry
+            compacted = _compact(bucket, study, entry['seq'])
+            if compacted is not None:
+                manifest_update[study] = compacted
+                _update_filters(bucket, study, rebuild=True)
+    if len(manifest_update) > 0:
+        _update_manifest(bucket, manifest_update)
+    return entries
+
+
+def rollback(study, seq, sample_ids=None, scode=None, bucket=None):
+    """Revert the journal entry seq of the study with a compensating entry: the
+    sample ids it added are removed, or the ids it removed are added back (only
+    those in sample_ids, if given). Only the ids still as the entry left them are
+    reverted, so changes committed since are kept, and rolling back twice is a no-op.
+    Returns the new entry, None if there was nothing left to revert. The GP2 ID
+    numbers of reverted additions are not reused
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    blob = bucket.get_blob(journal_path(study, seq))
+    if blob is None:
+        raise ValueError(f'{study} has no journal entry {seq}')
+    entry = _read_entry(blob)
+    if entry['op'] == 'remove' and 'removed' not in entry:
+        raise ValueError(f'{study} journal entry {seq} predates rollbacks of removals')
+    ids = entry['ids'] if entry['op'] == 'add' else entry['removed']
+    if sample_ids is not None:
+        keep = set(sample_ids)
+        ids = {sample_id: value for sample_id, value in ids.items() if sample_id in keep}
+    _sync_studies(bucket, load_manifest(bucket), [study])
+
+    reverted = _commit_entry(bucket, study, 'remove' if entry['op'] == 'add' else 'add', ids, scode, reverts=seq)
+    if reverted is None:
+        return None
+    compacted = _compact(bucket, study, reverted['seq'])
+    if compacted is not None:
+        _update_manifest(bucket, {study: compacted})
+    _update_filters(bucket, study, rebuild=compacted is not None)
+    return reverted
+
+
+def find_commits(study, sample_ids, bucket=None):
+    """Seqs of the journal entries that registered the sample ids currently in the
+    study, newest first. Reading stops once every sample id is accounted for. Sample
+    ids registered before the journal (in the legacy mapper) have no entry
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    _sync_studies(bucket, load_manifest(bucket), [study])
+    pending = set(idscache.existing_sample_ids(study, sample_ids))
+    seqs = []
+    for blob in reversed(_journal_blobs(bucket, study)):
+        if len(pending) == 0:
+            break
+        entry = _read_entry(blob)
+        # The last entry touching a registered sample id is the one that added it
+        found = pending.intersection(entry['ids']) if entry['op'] == 'add' else set()
+        if len(found) > 0:
+            pending -= found
+            seqs.append(entry['seq'])
+    return seqs
+
+
+def backfill_counters(studies=None, bucket=None):
+    """Write the next_id counter of studies whose base snapshot predates it, by
+    compacting them at their current journal head. Studies still in the legacy
+    mapper get their counter when they are migrated. Returns {study: next_id}
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    manifest = load_manifest(bucket)
+    if studies is None:
+        studies = list(manifest['studies'].keys()) + manifest['legacy_studies']
+    heads = _sync_studies(bucket, manifest, studies)
+
+    counters = {}
+    manifest_update = {}
+    for study, seq in heads.items():
+        blob = bucket.get_blob(study_path(study))
+        if 'next_id' not in (blob.metadata or {}):
+            for attempt in range(MAX_ATTEMPTS):
+                compacted = _compact(bucket, study, seq, force=True)
+                if compacted is not None:
+                    manifest_update[study] = compacted
+                    break
+                _backoff(attempt) # Committed or compacted by another session meanwhile
+                seq = _sync_study(bucket, study)
+            else:
+                raise RegistryConflict(f'Could not backfill the counter of {study}')
+        counters[study] = idscache.next_id_number(study)
+    if len(manifest_update) > 0:
+        _update_manifest(bucket, manifest_update)
+    return counters
+
+
+# GP2 ID number leases. Sessions mint new IDs from ranges of numbers leased in a
+# small object per study {next, free: [[start, end]], leases: {id: {start, end, scode, date}}},
+# so they neither scan the registry for the next number nor hand out the same
+# numbers as a concurrent session. Unused numbers are given back with return_lease,
+# or by reclaim_leases once the lease is older than LEASE_TTL.
+
+def _update_leases(bucket, study, change):
+    """Apply change(leases) to the lease object of the study and return its result,
+    re-reading and retrying if another session updated the object meanwhile
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        leases, generation = _read_json(bucket, lease_path(study))
+        if leases is None:
+            # First lease of the study, continue from the registry counter
+            _sync_studies(bucket, load_manifest(bucket), [study])
+            leases = {'study': study, 'next': idscache.next_id_number(study), 'free': [], 'leases': {}}
+        result = change(leases)
+        try:
+            _write_json(bucket, lease_path(study), leases, if_generation_match=generation)
+            return result
+        except PreconditionFailed:
+            _backoff(attempt)
+    raise RegistryConflict(f'Could not update the GP2 ID leases of {study}')
+
+
+def _free_range(leases, start, end):
+    """Give numbers start..end-1 back to the lease object"""
+    if start >= end:
+        return
+    free = sorted(leases['free'] + [[start, end]])
+    merged = [free[0]]
+    for start, end in free[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    if merged[-1][1] == leases['next']:
+        leases['next'] = merged.pop()[0]
+    leases['free'] = merged
+
+
+def lease_ids(study, count, scode=None, bucket=None):
+    """Lease a range of at least count consecutive GP2 ID numbers (LEASE_SIZE when
+    possible) for the study. Returns the lease {study, id, start, end}, end excluded
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+
+    def take(leases):
+        # The registry counter only moves past the leases, unless IDs were committed without one
+        leases['next'] = max(leases['next'], idscache.next_id_number(study))
+        fits = [i for i, (start, end) in enumerate(leases['free']) if end - start >= count]
+        if len(fits) > 0:
+            start, end = leases['free'][fits[0]]
+            end = min(end, start + max(count, LEASE_SIZE))
+            leases['free'][fits[0]][0] = end
+            leases['free'] = [r for r in leases['free'] if r[0] < r[1]]
+        else:
+            start = leases['next']
+            end = start + max(count, LEASE_SIZE)
+            leases['next'] = end
+        lease = {'study': study, 'id': uuid.uuid4().hex, 'start': start, 'end': end}
+        leases['leases'][lease['id']] = {'start': start, 'end': end, 'scode': scode,
+                                         'date': dt.datetime.now().isoformat(timespec='seconds')}
+        return lease
+
+    return _update_leases(bucket, study, take)
+
+
+def return_lease(lease, used, bucket=None):
+    """Close a lease, giving back its numbers from used (the first number not
+    handed out) to the end of the range
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+
+    def close(leases):
+        if leases['leases'].pop(lease['id'], None) is not None: # Not reclaimed meanwhile
+            _free_range(leases, max(used, lease['start']), lease['end'])
+
+    _update_leases(bucket, lease['study'], close)
+
+
+def reclaim_leases(studies=None, max_age=LEASE_TTL, bucket=None):
+    """Close the leases older than max_age, left behind by sessions that never
+    finished. Numbers above the last one registered in each lease are given back.
+    Returns {study: number of leases closed}
+    """
+    bucket = bucket if bucket is not None else get_bucket()
+    if studies is None:
+        studies = [_read_json(bucket, blob.name)[0]['study']
+                   for blob in bucket.list_blobs(prefix=f'{REGISTRY_PREFIX}/LEASES/')]
+    manifest = load_manifest(bucket)
+    _sync_studies(bucket, manifest, studies)
+    oldest = (dt.datetime.now() - max_age).isoformat(timespec='seconds')
+
+    def reclaim(leases):
+        expired = [lease_id for lease_id, lease in leases['leases'].items() if lease['date'] < oldest]
+        for lease_id in expired:
+            lease = leases['leases'].pop(lease_id)
+            last = idscache.max_id_number(leases['study'], lease['start'], lease['end'])
+            _free_range(leases, lease['start'] if last is None else last + 1, lease['end'])
+        return len(expired)
+
+    return {study: _update_leases(bucket, study, reclaim) for study in studies
+            if bucket.get_blob(lease_path(study)) is not None}
+
+
+class IdLease:
+    """GP2 ID numbers of a study handed out locally from ranges leased in the
+    registry. Keep one per session and study, and release it once the IDs are committed
+    (generategp2ids.update_masterids_background releases it after the commit)
+    """
+
+    def __init__(self, study, scode=None, bucket=None):
+        self.study = study
+        self.scode = scode
+        self.bucket = bucket
+        self.lease = None
+        self.position = None
+
+    def take(self, count):
+        """First of count consecutive new numbers"""
+        if self.lease is None or self.lease['end'] - self.position < count:
+            self.release()
+            self.lease = lease_ids(self.study, count, scode=self.scode, bucket=self.bucket)
+            self.position = self.lease['start']
+        start = self.position
+        self.position += count
+        return start
+
+    def release(self):
+        """Give the numbers not taken back to the registry"""
+        if self.lease is not None:
+            return_lease(self.lease, self.position, bucket=self.bucket)
+            self.lease = None
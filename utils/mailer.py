@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import smtplib
+import threading
+from email.mime.text import MIMEText
+import outbox
+
+# Notification emails of the app, sent by the outbox worker (see outbox) over one SMTP
+# session that is kept open between batches. The server is configurable so that a
+# local SMTP stand-in can be used for testing, e.g.
+#   GP2_SMTP_HOST=localhost GP2_SMTP_PORT=1025 GP2_SMTP_TLS=0
+# Without TLS there is no login. Sender, receivers and password are read from the
+# credentials file, so they are never written to the outbox.
+SMTP_HOST = os.environ.get('GP2_SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('GP2_SMTP_PORT', 587))
+SMTP_TLS = os.environ.get('GP2_SMTP_TLS', '1') == '1'
+IDLE_SECONDS = 60 # the session is closed after that long without emails
+
+_lock = threading.Lock()
+_server = None
+_last_used = 0
+
+
+def _secrets():
+    with open(os.environ["GOOGLE_APPLICATION_CREDENTIALS"]) as f:
+        return json.load(f)['email_data']['secrets']
+
+
+def _session(secrets):
+    global _server
+    if _server is not None and time.time() - _last_used > IDLE_SECONDS:
+        _close()
+    if _server is None:
+        # Only kept once it is logged in, a failed login does not leave a session behind
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+        try:
+            if SMTP_TLS:
+                server.starttls()
+                server.login(secrets['sender'], secrets['pwd'])
+        except BaseException:
+            server.close()
+            raise
+        _server = server
+    return _server
+
+
+def _close():
+    global _server
+    if _server is None:
+        return
+    try:
+        _server.quit()
+    except (smtplib.SMTPException, OSError):
+        pass
+    _server = None
+
+
+def send_batch(emails):
+    """Send [{subject, body}] to the team. Returns which ones were sent"""
+    global _last_used
+    secrets = _secrets()
+    sent = []
+    with _lock:
+        for email in emails:
+            msg = MIMEText(email['body'])
+            msg['From'] = secrets['sender']
+            msg['To'] = ", ".join(secrets['receiver'])
+            msg['Subject'] = email['subject']
+            # A session closed by the server is opened again once. An email refused by the
+            # server (sender, recipients, data) is reported as not sent, the others still go
+            ok = False
+            for attempt in range(2):
+                try:
+                    _session(secrets).sendmail(secrets['sender'], secrets['receiver'], msg.as_string())
+                    _last_used = time.time()
+                    ok = True
+                    break
+                except smtplib.SMTPServerDisconnected:
+                    _close()
+                except smtplib.SMTPException:
+                    break
+                except OSError:
+                    _close()
+            sent.append(ok)
+    return sent
+
+
+outbox.register('email', send_batch, batch=True)
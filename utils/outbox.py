@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing
+
+# Durable outbox of the side effects of the app (emails, registry commits). Jobs are
+# written to a local sqlite file and run by a background worker thread, so the
+# Streamlit script does not wait for them, and retried with backoff until they
+# succeed. Jobs left by a process that stopped are picked up when their lease runs out.
+OUTBOX_PATH = os.environ.get('GP2_OUTBOX', os.path.join(tempfile.gettempdir(), 'gp2_outbox.sqlite'))
+MAX_ATTEMPTS = 8
+LEASE_SECONDS = 300 # a running job not finished by then is run again
+POLL_SECONDS = 30
+
+_log = logging.getLogger(__name__)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT,
+    payload TEXT,
+    state TEXT, -- pending, running, done or failed
+    attempts INTEGER,
+    next_try REAL,
+    lease_until REAL,
+    error TEXT,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, next_try);
+'''
+
+_handlers = {}
+_wake = threading.Event()
+_lock = threading.Lock()
+_worker = None
+
+
+def _connect():
+    conn = sqlite3.connect(OUTBOX_PATH, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def register(kind, handler, batch=False, on_failure=None):
+    """Run the jobs of kind with handler(payload). A batch handler gets the list of the
+    payloads due and returns the list of the ones that succeeded (True/False). on_failure(payload,
+    error) is called when a job is given up after MAX_ATTEMPTS
+    """
+    _handlers[kind] = {'handler': handler, 'batch': batch, 'on_failure': on_failure}
+
+
+def enqueue(kind, payload):
+    """Add a job and return its id. payload must be json serializable"""
+    now = time.time()
+    with closing(_connect()) as conn, conn:
+        job_id = conn.execute('INSERT INTO jobs (kind, payload, state, attempts, next_try, lease_until, error, created) '
+                              'VALUES (?, ?, ?, 0, ?, 0, NULL, ?)',
+                              (kind, json.dumps(payload), 'pending', now, now)).lastrowid
+    start()
+    _wake.set()
+    return job_id
+
+
+def pending(kind=None):
+    """Number of jobs (of kind) not done yet"""
+    with closing(_connect()) as conn:
+        query = "SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'running')"
+        if kind is None:
+            return conn.execute(query).fetchone()[0]
+        return conn.execute(query + ' AND kind = ?', (kind,)).fetchone()[0]
+
+
+def _claim():
+    """Jobs due, of the kinds with a handler, marked as running"""
+    now = time.time()
+    kinds = list(_handlers.keys())
+    if len(kinds) == 0:
+        return []
+    with closing(_connect()) as conn, conn:
+        conn.execute('BEGIN IMMEDIATE')
+        rows = conn.execute(f"SELECT id, kind, payload, attempts FROM jobs WHERE kind IN ({','.join('?' * len(kinds))}) "
+                            "AND ((state = 'pending' AND next_try <= ?) OR (state = 'running' AND lease_until < ?)) "
+                            'ORDER BY id', kinds + [now, now]).fetchall()
+        conn.executemany("UPDATE jobs SET state = 'running', lease_until = ? WHERE id = ?",
+                         [(now + LEASE_SECONDS, row[0]) for row in rows])
+    return [{'id': row[0], 'kind': row[1], 'payload': json.loads(row[2]), 'attempts': row[3]} for row in rows]
+
+
+def _finish(job, error=None):
+    with closing(_connect()) as conn, conn:
+        if error is None:
+            conn.execute("UPDATE jobs SET state = 'done', error = NULL WHERE id = ?", (job['id'],))
+            return
+        attempts = job['attempts'] + 1
+        state = 'failed' if attempts >= MAX_ATTEMPTS else 'pending'
+        conn.execute('UPDATE jobs SET state = ?, attempts = ?, next_try = ?, error = ? WHERE id = ?',
+                     (state, attempts, time.time() + min(2 ** attempts, 600), repr(error), job['id']))
+    on_failure = _handlers[job['kind']]['on_failure']
+    if state == 'failed' and on_failure is not None:
+        try:
+            on_failure(job['payload'], error)
+        except Exception as e: # kept with the job, it is failed either way
+            with closing(_connect()) as conn, conn:
+                conn.execute('UPDATE jobs SET error = ? WHERE id = ?',
+                             (f'{error!r}; on_failure: {e!r}', job['id']))
+
+
+def run_due():
+    """Run the jobs due once. Returns the number of jobs run"""
+    jobs = _claim()
+    by_kind = {}
+    for job in jobs:
+        by_kind.setdefault(job['kind'], []).append(job)
+    for kind, kind_jobs in by_kind.items():
+        handler = _handlers[kind]
+        if handler['batch']:
+            try:
+                results = handler['handler']([job['payload'] for job in kind_jobs])
+                errors = [None if ok else RuntimeError(f'{kind} job not run') for ok in results]
+            except Exception as e:
+                errors = [e] * len(kind_jobs)
+            for job, error in zip(kind_jobs, errors):
+                _finish(job, error)
+        else:
+            for job in kind_jobs:
+                try:
+                    handler['handler'](job['payload'])
+                    _finish(job)
+                except Exception as e:
+                    _finish(job, e)
+    return len(jobs)
+
+
+def _next_due():
+    with closing(_connect()) as conn:
+        row = conn.execute("SELECT MIN(next_try) FROM jobs WHERE state = 'pending'").fetchone()
+    return row[0]
+
+
+def _run_forever():
+    while True:
+        _wake.clear()
+        try:
+            run_due()
+            next_due = _next_due()
+        except Exception: # keep the worker alive, the jobs are retried on the next round
+            _log.exception('outbox worker round failed')
+            next_due = None
+        timeout = POLL_SECONDS if next_due is None else min(max(next_due - time.time(), 0.05), POLL_SECONDS)
+        _wake.wait(timeout)
+
+
+def start():
+    """Start the background worker of the process, if it is not running"""
+    global _worker
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run_forever, name='gp2-outbox', daemon=True)
+            _worker.start()
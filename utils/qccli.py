@@ -0,0 +1,114 @@
+"""Validate a batch of GP2 sample manifests, one worker process per manifest.
+
+    python utils/qccli.py MANIFEST_DIR [--site Fulgent] [--mappings mappings.json] [--workers N] [--report qc_report.json] [--collect-all]
+
+Manifests are the csv/xlsx files of MANIFEST_DIR (or files given one by one). They
+are checked as the sample manifest tab does (see qcengine), without assigning GP2
+IDs. The genotyping site is read from the Genotyping_site column of QC'd manifests,
+and --site is used for the rest. Mappings of the user values to the GP2 standard
+ones ({column: {value: GP2 value}}) default to the ones of QC'd manifests, or to
+the values themselves when allowed. With --collect-all, every check is run on each
+manifest instead of stopping at the first step with errors.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import qcengine
+
+EXTENSIONS = ('.csv', '.xlsx')
+
+
+def read_manifest(path):
+    # Same as writeread.read_file, from a path. Rows are numbered as in the spreadsheet
+    if path.endswith('.csv'):
+        df = pd.read_csv(path, dtype={'clinical_id':'str', 'sample_id':'str'})
+    else:
+        df = pd.read_excel(path, sheet_name=0, dtype={'clinical_id':'str', 'sample_id':'str'})
+    df.index = df.index + 2
+    return df
+
+
+def validate_file(path, site=None, mappings=None, collect_all=False):
+    """Findings of the manifest at path, as a json serializable dict"""
+    start = time.time()
+    try:
+        df = read_manifest(path)
+        if 'Genotyping_site' in df.columns and df['Genotyping_site'].notna().any():
+            site = df['Genotyping_site'].dropna().iloc[0]
+        if site is None:
+            findings = [qcengine.finding('site', 'error', 'No genotyping site, use --site')]
+        else:
+            df, findings = qcengine.validate(df, site, mappings, collect_all=collect_all)
+        n_rows = df.shape[0]
+    except Exception as e: # Unreadable file, reported with the rest
+        findings = [qcengine.finding('read', 'error', repr(e))]
+        n_rows = 0
+    return {'file': path,
+            'site': site,
+            'rows': n_rows,
+            'errors': len(qcengine.errors(findings)),
+            'warnings': len(findings) - len(qcengine.errors(findings)),
+            'findings': findings,
+            'seconds': round(time.time() - start, 3)}
+
+
+def manifest_paths(paths):
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.endswith(EXTENSIONS) and not name.startswith('~$'))
+        else:
+            found.append(path)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('paths', nargs='+', help='manifest files or directories of manifests')
+    parser.add_argument('--site', choices=qcengine.SITES, default=None,
+                        help='genotyping site of the manifests without a Genotyping_site column')
+    parser.add_argument('--mappings', default=None, help='json file of {column: {value: GP2 value}}')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, one per cpu by default')
+    parser.add_argument('--report', default='qc_report.json', help='path of the report')
+    parser.add_argument('--collect-all', action='store_true', help='run every check, not only up to the first step with errors')
+    args = parser.parse_args()
+
+    mappings = None
+    if args.mappings is not None:
+        with open(args.mappings) as f:
+            mappings = json.load(f)
+    paths = manifest_paths(args.paths)
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(validate_file, paths, [args.site] * len(paths), [mappings] * len(paths),
+                                    [args.collect_all] * len(paths),
+                                    chunksize=max(1, len(paths) // (4 * (args.workers or os.cpu_count() or 1)))))
+    report = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'n_manifests': len(results),
+              'n_failed': sum(result['errors'] > 0 for result in results),
+              'seconds': round(time.time() - start, 1),
+              'manifests': results}
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    for result in results:
+        status = 'FAILED' if result['errors'] > 0 else 'OK'
+        print(f"{result['file']}: {status} ({result['errors']} errors, {result['warnings']} warnings)")
+        for found in qcengine.report(result['findings']).to_dict('records'):
+            rows = f" (rows {found['rows']})" if found['n_rows'] > 0 else ''
+            print(f"    {found['level']} {found['check']}: {found['message']}{rows}")
+    print(f"{report['n_manifests']} manifests validated in {report['seconds']}s: {report['n_failed']} failed. "
+          f"Report written to {args.report}")
+    sys.exit(1 if report['n_failed'] > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
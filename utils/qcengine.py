@@ -0,0 +1,373 @@
+"""Checks of the GP2 sample manifest and clinical data, without Streamlit.
+
+The checks are the rules of SAMPLE_MANIFEST and CLINICAL (see qcrules), grouped in
+the steps of the tabs. check returns the findings of a step of a DataFrame. A
+finding is a dict with the check name, its level (error or warning), a message, the
+rows of the file involved (index labels, the spreadsheet rows of the file read) and
+the columns worth showing with them. The sample manifest tab shows the findings of
+each step (see apps/data_checking.py), and validate runs all of them at once on a
+manifest, e.g. for the batch validation of qccli.py. With collect_all, validate does
+not stop at the first step with errors: every check is run, so that all the problems
+of a manifest are reported at once (see report). validate_clinical does the same
+for the clinical data tab.
+"""
+import numpy as np
+import pandas as pd
+import qcrules
+from qcrules import finding
+
+COLS = ['study_type', 'sample_id', 'family_index', 'family_index_relationship', 'sample_type',
+        'DNA_volume', 'DNA_conc', 'r260_280',
+        'Plate_name', 'Plate_position', 'clinical_id',
+        'study_arm', 'diagnosis', 'sex', 'race',
+        'age', 'age_of_onset', 'age_at_diagnosis', 'age_at_death', 'age_at_last_follow_up',
+        'region', 'comment', 'family_history_pd', 'family_history_other', 'family_history_details', 'alternative_id1', 'alternative_id2']
+REQUIRED_COLS = ['study_type', 'sample_id', 'sample_type', 'clinical_id',
+                 'study_arm', 'diagnosis', 'sex']
+FULGENT_COLS = ['DNA_volume', 'DNA_conc', 'Plate_name', 'Plate_position']
+# Columns added by the QC. They are dropped when a QC'd manifest is validated again
+DERIVED_COLS = ['GP2sampleID', 'GP2ID', 'SampleRepNo', 'Genotyping_site', 'study', 'manifest_id',
+                'GP2_phenotype', 'GP2_phenotype_for_qc', 'biological_sex_for_qc', 'race_for_qc',
+                'family_history_for_qc', 'region_for_qc']
+
+SITES = ['Fulgent', 'Psomagen', 'NIH', 'LGC', 'UCL', 'DZNE', 'CIDR']
+
+GP2_PHENOS = ['PD', 'Control', 'Prodromal',
+              'PSP', 'CBD/CBS', 'MSA', 'DLB', 'AD', 'FTD', "VaD", "VaPD"
+              'Population Control', 'Undetermined-MCI', 'Undetermined-Dementia', 'Mix', 'LBD', 'Other']
+ALLOWED_SAMPLES = ['Blood (EDTA)', 'Blood (ACD)', 'Blood', 'DNA', 'DNA from Brain',
+                   'DNA from blood', 'DNA from FFPE', 'RNA', 'Saliva',
+                   'Buccal Swab', 'T-25 Flasks (Amniotic)', 'FFPE Slide',
+                   'FFPE Block', 'Fresh tissue', 'Frozen tissue',
+                   'Bone Marrow Aspirate', 'Whole BMA', 'CD3+ BMA', 'Other']
+ALLOWED_STUDY_TYPE = ['Case(/Control)', 'Prodromal', 'Genetically Enriched', 'Population Cohort', 'Brain Bank', 'Monogenic']
+ALLOWED_SEX = ['Male', 'Female', 'Other/Unknown/Not Reported']
+ALLOWED_RACE = ['American Indian or Alaska Native', 'Asian', 'White', 'Black or African American',
+                'Multi-racial', 'Native Hawaiian or Other Pacific Islander', 'Other', 'Unknown', 'Not Reported']
+ALLOWED_FAMILY_HISTORY = ['Yes', 'No', 'Not Reported']
+ALLOWED_REGION_CODES = ["ABW","AFG","AGO","AIA","ALA","ALB","AND","ARE","ARG","ARM","ASM","ATA","ATF","ATG","AUS","AUT","AZE",
+                        "BDI","BEL","BEN","BES","BFA","BGD","BGR","BHR","BHS","BIH","BLM","BLR","BLZ","BMU","BOL","BRA","BRB",
+                        "BRN","BTN","BVT","BWA","CAF","CAN","CCK","CHE","CHL","CHN","CIV","CMR","COD","COG","COK","COL","COM",
+                        "CPV","CRI","CUB","CUW","CXR","CYM","CYP","CZE","DEU","DJI","DMA","DNK","DOM","DZA","ECU","EGY","ERI",
+                        "ESH","ESP","EST","ETH","FIN","FJI","FLK","FRA","FRO","FSM","GAB","GBR","GEO","GGY","GHA","GIB","GIN",
+                        "GLP","GMB","GNB","GNQ","GRC","GRD","GRL","GTM","GUF","GUM","GUY","HKG","HMD","HND","HRV","HTI","HUN",
+                        "IDN","IMN","IND","IOT","IRL","IRN","IRQ","ISL","ISR","ITA","JAM","JEY","JOR","JPN","KAZ","KEN","KGZ",
+                        "KHM","KIR","KNA","KOR","KWT","LAO","LBN","LBR","LBY","LCA","LIE","LKA","LSO","LTU","LUX","LVA","MAC",
+                        "MAF","MAR","MCO","MDA","MDG","MDV","MEX","MHL","MKD","MLI","MLT","MMR","MNE","MNG","MNP","MOZ","MRT",
+                        "MSR","MTQ","MUS","MWI","MYS","MYT","NAM","NCL","NER","NFK","NGA","NIC","NIU","NLD","NOR","NPL","NRU",
+                        "NZL","OMN","PAK","PAN","PCN","PER","PHL","PLW","PNG","POL","PRI","PRK","PRT","PRY","PSE","PYF","QAT",
+                        "REU","ROU","RUS","RWA","SAU","SDN","SEN","SGP","SGS","SHN","SJM","SLB","SLE","SLV","SMR","SOM","SPM",
+                        "SRB","SSD","STP","SUR","SVK","SVN","SWE","SWZ","SXM","SYC","SYR","TCA","TCD","TGO","THA","TJK","TKL",
+                        "TKM","TLS","TON","TTO","TUN","TUR","TUV","TWN","TZA","UGA","UKR","UMI","URY","USA","UZB","VAT","VCT",
+                        "VEN","VGB","VIR","VNM","VUT","WLF","WSM","YEM","ZAF","ZMB","ZWE"]
+
+NUMERIC_COLS = ['DNA_volume', 'DNA_conc', 'r260_280','age', 'age_of_onset', 'age_at_diagnosis', 'age_at_last_follow_up','age_at_death']
+AGE_COLS = ['age', 'age_of_onset', 'age_at_diagnosis']
+
+# User values -> GP2 standard values, one mapping per column: (column created, allowed values).
+# Missing values of the Not Reported columns are mapped as 'Not Reported'
+MAPPINGS = {'diagnosis': ('GP2_phenotype', GP2_PHENOS),
+            'sex': ('biological_sex_for_qc', ALLOWED_SEX),
+            'race': ('race_for_qc', ALLOWED_RACE),
+            'family_history_pd': ('family_history_for_qc', ALLOWED_FAMILY_HISTORY),
+            'region': ('region_for_qc', ALLOWED_REGION_CODES)}
+NOT_REPORTED_COLS = ['race', 'family_history_pd', 'region']
+CLINICAL_COLS = ['study', 'sample_id', 'visit_month',
+                 'mds_updrs_part_iii_summary_score',
+                 'moca_total_score', 'hoehn_and_yahr_stage',
+                 'mmse_total_score']
+CLINICAL_REQUIRED_COLS = ['study', 'sample_id', 'visit_month']
+
+# Rules of the sample manifest, by step of the tab. The manifest has the Genotyping_site
+# column (see prepare) and the GP2 standard columns (see map_column) when they are checked
+SAMPLE_MANIFEST = qcrules.RuleSet([
+    {'name': 'required', 'step': 'required', 'kind': 'required', 'columns': REQUIRED_COLS, 'show': REQUIRED_COLS,
+     'message': 'There are some missing entries in the required columns. Please fill the missing cells'},
+    {'name': 'required_fulgent', 'step': 'required', 'kind': 'required', 'columns': FULGENT_COLS,
+     'when': {'Genotyping_site': ['Fulgent', 'Psomagen', 'CIDR']},
+     'message': 'There are some missing entries in the columns required by the genotyping site. Please fill the missing cells'},
+    {'name': 'required_nih', 'step': 'required', 'kind': 'required', 'columns': ['Plate_name', 'Plate_position'],
+     'when': {'Genotyping_site': ['NIH']},
+     'message': 'There are some missing entries in the columns required by the genotyping site. Please fill the missing cells'},
+    {'name': 'required_monogenic', 'step': 'required', 'kind': 'required', 'columns': ['sample_id', 'clinical_id', 'family_history_pd'],
+     'when': {'study_type': ['Monogenic']},
+     'message': 'There are some missing entries in the required columns for monogenic data',
+     'hint': 'Please fill family_history_pd columnd for all monogenic samples in the manifest'},
+
+    {'name': 'clinical_id_repetitions', 'step': 'clinical_id', 'kind': 'max_count', 'columns': ['clinical_id'], 'max': 3,
+     'message': 'We have detected more than 3 repetitions for the clinical id codes {values}',
+     'show': ['study', 'sample_id', 'clinical_id']},
+    {'name': 'clinical_id_duplicates', 'step': 'clinical_id', 'kind': 'unique', 'columns': ['clinical_id'], 'level': 'warning',
+     'message': 'Duplicated clinical_id in the manifest: {values}',
+     'hint': 'If this is not expected, please fix it and re upload your sample manifest'},
+    {'name': 'sample_id_duplicates', 'step': 'sample_id', 'kind': 'unique', 'columns': ['sample_id'],
+     'message': 'Duplicated sample_id:{values}', 'show': ['sample_id', 'clinical_id'],
+     'hint': 'Unique sample IDs are required (clinical IDs can be duplicated if replicated)'},
+
+    {'name': 'sample_type_values', 'step': 'sample_type', 'kind': 'allowed', 'columns': ['sample_type'], 'values': ALLOWED_SAMPLES,
+     'message': 'We could not find the following codes {values}',
+     'hint': f'Printing the list of allowed sample_type values for reference {ALLOWED_SAMPLES}'},
+    {'name': 'study_type_values', 'step': 'study_type', 'kind': 'allowed', 'columns': ['study_type'], 'values': ALLOWED_STUDY_TYPE,
+     'message': 'We could not find the following codes {values}',
+     'hint': f'Printing the list of allowed study_type values for reference {ALLOWED_STUDY_TYPE}'},
+
+    {'name': 'GP2_phenotype_not_assigned', 'step': 'phenotype', 'kind': 'allowed', 'columns': ['GP2_phenotype'], 'values': GP2_PHENOS,
+     'message': 'Please assign the phenotype for all the samples', 'show': ['sample_id', 'diagnosis', 'GP2_phenotype']},
+    {'name': 'control_age_of_onset', 'step': 'phenotype', 'kind': 'empty', 'columns': ['age_of_onset'],
+     'when': {'GP2_phenotype': ['Control', 'Population Control']},
+     'message': 'We have detected some controls that have age of onset values. This is not possible. Please correct',
+     'show': ['study', 'study_type', 'sample_id', 'clinical_id', 'GP2_phenotype', 'age_of_onset']},
+    {'name': 'biological_sex_for_qc_not_assigned', 'step': 'sex', 'kind': 'allowed', 'columns': ['biological_sex_for_qc'], 'values': ALLOWED_SEX,
+     'message': 'Please assign the sex for all the samples', 'show': ['sample_id', 'sex', 'biological_sex_for_qc']},
+    {'name': 'unknown_sex_rate', 'step': 'sex', 'kind': 'max_rate', 'columns': ['biological_sex_for_qc'],
+     'value': 'Other/Unknown/Not Reported', 'max': 0.01,
+     'message': 'The number of samples with "Other/Unknown/Not Reported" sex category is higher than 1%',
+     'hint': 'Please check that you selected the right sex values for your samples above', 'show': ['sample_id', 'sex', 'biological_sex_for_qc']},
+    {'name': 'race_for_qc_not_assigned', 'step': 'race', 'kind': 'allowed', 'columns': ['race_for_qc'], 'values': ALLOWED_RACE,
+     'message': 'Please assign the race for all the samples', 'show': ['sample_id', 'race', 'race_for_qc']},
+    {'name': 'family_history_for_qc_not_assigned', 'step': 'family_history', 'kind': 'allowed', 'columns': ['family_history_for_qc'],
+     'values': ALLOWED_FAMILY_HISTORY,
+     'message': 'Please assign the family for all the samples', 'show': ['sample_id', 'family_history_pd', 'family_history_for_qc']},
+    {'name': 'region_for_qc_values', 'step': 'region', 'kind': 'allowed', 'columns': ['region_for_qc'], 'values': ALLOWED_REGION_CODES,
+     'message': 'Please make sure all samples assigned a 3-digit region code. If not available, '
+                'please assign the 3-digit code for the principle research site.',
+     'hint': 'Need reviews: {values}', 'show': ['sample_id', 'region', 'region_for_qc']},
+
+    {'name': 'plate_size', 'step': 'plates', 'kind': 'max_count', 'columns': ['Plate_name'], 'max': 96,
+     'message': 'Please make sure, N of samples on plates {values} is =<96', 'show': ['sample_id', 'Plate_name', 'Plate_position']},
+    {'name': 'plate_position_duplicates', 'step': 'plates', 'kind': 'unique', 'columns': ['Plate_name', 'Plate_position'],
+     'message': ' !!!SERIOUS ERROR!!!  Plate position duplicated on plates {values}'},
+    ] + [
+    {'name': f'{col}_not_numeric', 'step': 'numerics', 'kind': 'numeric', 'columns': [col],
+     'message': f'{col} is not numeric',
+     'hint': f'Please, make sure expected numeric columns are stored on a numeric format: {NUMERIC_COLS}'}
+    for col in NUMERIC_COLS] + [
+    {'name': f'{col}_negative', 'step': 'numerics', 'kind': 'range', 'columns': [col], 'min': 0,
+     'message': f'{col} has unexpected negative values. Please correct them',
+     'show': ['study', 'study_type', 'sample_id', 'clinical_id', col]}
+    for col in NUMERIC_COLS] + [
+    {'name': 'age_range', 'step': 'numerics', 'kind': 'range', 'columns': AGE_COLS, 'min': 20, 'max': 100, 'level': 'warning',
+     'message': f'{AGE_COLS} have unexpected high (>100) or low (<20) values.', 'show': ['sample_id', 'clinical_id'] + AGE_COLS,
+     'hint': 'Please check the data below. If these are errors, fix them, and come back and re-upload the sample manifest'},
+
+    # For Monogenic cases, we need to check AAO is not missing. This needs the 'GP2_phenotype_for_qc' variable
+    {'name': 'monogenic_age_of_onset', 'step': 'monogenic', 'kind': 'required', 'columns': ['age_of_onset'],
+     'when': {'study_type': ['Monogenic'], 'GP2_phenotype_for_qc': ['PD']},
+     'message': 'There are some missing entries in the required columns for monogenic data',
+     'hint': 'Please fill age_of_onset column for all PD monogenic samples in the manifest', 'show': ['sample_id', 'clinical_id', 'age_of_onset']},
+    ], columns=COLS, strict=True)
+
+# Checks of the choices made on the tab rather than of the file: the rules on, or only
+# for some values of, the GP2 standard columns
+MAPPED_COLS = [target for target, _ in MAPPINGS.values()] + ['GP2_phenotype_for_qc']
+MAPPING_CHECKS = [rule['name'] for rule in SAMPLE_MANIFEST.rules
+                  if set(rule['columns']).union(rule.get('when', {})) & set(MAPPED_COLS)]
+
+CLINICAL = qcrules.RuleSet([
+    {'name': 'required', 'step': 'required', 'kind': 'required', 'columns': CLINICAL_REQUIRED_COLS, 'show': CLINICAL_REQUIRED_COLS,
+     'message': 'There are some missing entries in the required columns. Please fill the missing cells'},
+    {'name': 'visit_month', 'step': 'visit_month', 'kind': 'integer', 'columns': ['visit_month'], 'show': CLINICAL_REQUIRED_COLS,
+     'message': 'We could not convert visit month to integer',
+     'hint': 'Please check visit month refers to numeric month from Baseline'},
+    ] + [
+    {'name': f'{col}_negative', 'step': 'negatives', 'kind': 'range', 'columns': [col], 'min': 0,
+     'message': f'We have detected negative values on column {col}', 'show': CLINICAL_REQUIRED_COLS + [col],
+     'hint': 'This is likely to be a mistake on the data. Please, go back to the sample manifest anc check'}
+    for col in CLINICAL_COLS[3:]], columns=CLINICAL_COLS)
+
+
+def errors(findings):
+    return [found for found in findings if found['level'] == 'error']
+
+
+def row_ranges(rows):
+    """Spreadsheet rows as text, e.g. 2-5, 9"""
+    rows = sorted(set(rows))
+    ranges = []
+    for row in rows:
+        if len(ranges) > 0 and ranges[-1][1] == row - 1:
+            ranges[-1][1] = row
+        else:
+            ranges.append([row, row])
+    return ', '.join(str(start) if start == end else f'{start}-{end}' for start, end in ranges)
+
+
+def report(findings):
+    """One line per finding, errors first and grouped by check, with the spreadsheet rows"""
+    lines = pd.DataFrame([{'level': found['level'], 'check': found['check'], 'message': found['message'],
+                           'hint': found['hint'], 'n_rows': len(found['rows']), 'rows': row_ranges(found['rows'])}
+                          for found in findings],
+                         columns=['level', 'check', 'message', 'hint', 'n_rows', 'rows'])
+    order = {'error': 0, 'warning': 1}
+    return lines.sort_values(['level', 'check'], key=lambda col: col.map(order) if col.name == 'level' else col,
+                             kind='stable').reset_index(drop=True)
+
+
+def finding_rows(df, found):
+    """The rows of the manifest involved in a finding, with the columns worth showing"""
+    rows = df[df.index.isin(found['rows'])]
+    if found['columns'] is not None:
+        rows = rows[[col for col in found['columns'] if col in rows.columns]]
+    return rows
+
+
+def spreadsheet_order(df):
+    """df with its rows back in the order of the spreadsheet. The index is the spreadsheet
+    row of each sample, set when the file is read and kept by the GP2 IDs assignment
+    """
+    rows = df.index.to_numpy()
+    if not df.index.is_unique or len(df) > 0 and rows.max() - rows.min() + 1 != len(df):
+        raise ValueError('The index of the manifest is not its spreadsheet rows')
+    positions = np.empty(len(df), dtype=np.intp)
+    positions[rows - rows.min()] = np.arange(len(df))
+    return df.take(positions)
+
+
+def check(df, step, rules=SAMPLE_MANIFEST):
+    """Findings of the rules of a step of the tab"""
+    return rules.findings(df, [step])
+
+
+def check_columns(df):
+    return SAMPLE_MANIFEST.check_columns(df)
+
+
+def prepare(df, site):
+    """Copy of the manifest with the Genotyping_site column, the weird NA of the
+    ID columns as missing values, and the numeric columns stored as text (e.g. '12.5')
+    as numbers. Columns with values that are not numbers are left as they are, for
+    the numeric rules to report them
+    """
+    df = df.copy()
+    df['Genotyping_site'] = site
+    df[['sample_id','clinical_id']] = df[['sample_id','clinical_id']].replace('nan', np.nan)
+    for col in NUMERIC_COLS:
+        if col in df.columns and not pd.api.types.is_numeric_dtype(df[col]):
+            values = pd.to_numeric(df[col], errors='coerce')
+            if not (values.isna() & df[col].notna()).any():
+                df[col] = values
+    return df
+
+
+def ids_as_str(df):
+    # Missing IDs are left missing, they are reported by the required rules
+    for col in ['sample_id', 'clinical_id']:
+        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def duplicated_clinical_ids(df):
+    return df.loc[df.duplicated(subset=['clinical_id']) & df['clinical_id'].notna(), 'clinical_id'].unique()
+
+
+def fix_vocabulary(df, col, allowed):
+    """Values of col with the whitespaces of the allowed values fixed. The values
+    still not allowed are reported by the rules of the step
+    """
+    allowed_strp = {value.strip().replace(" ", ""): value for value in allowed}
+    stripped = df[col].astype(str).str.replace(" ", "").map(allowed_strp)
+    return stripped.fillna(df[col])
+
+
+def default_mapping(df, col):
+    """GP2 standard value proposed for each value of col: the one given when the
+    manifest was QC'd before, or the value itself if allowed
+    """
+    target, allowed = MAPPINGS[col]
+    values = df[col].fillna('Not Reported') if col in NOT_REPORTED_COLS else df[col]
+    mapping = {value: (value if value in allowed else None) for value in values.dropna().unique()}
+    if target in df.columns:
+        mapping.update(dict(zip(values, df[target])))
+    return mapping
+
+
+def map_column(df, col, mapping):
+    """Add the GP2 standard column of col (see MAPPINGS), 'Not Assigned' where the mapping
+    has no value. Missing values are left missing, they are reported by the required rules
+    """
+    target, _ = MAPPINGS[col]
+    values = df[col]
+    if col in NOT_REPORTED_COLS:
+        values = values.fillna('Not Reported')
+        mapping = {'Not Reported': 'Not Reported', **mapping}
+    mapped = values.map(mapping)
+    df[target] = mapped.where(mapped.notna() | values.isna(), 'Not Assigned')
+    if col == 'diagnosis':
+        # Derive phenotype for QC variable
+        df['GP2_phenotype_for_qc'] = df['GP2_phenotype'].where(df['GP2_phenotype'].isin(['PD', 'Control']), 'Other')
+        df.loc[df['study_type'] == 'Genetically Enriched', 'GP2_phenotype_for_qc'] = 'Other'
+    return df
+
+
+def mapped_columns(col):
+    """The columns map_column adds for col"""
+    target, _ = MAPPINGS[col]
+    return [target, 'GP2_phenotype_for_qc'] if col == 'diagnosis' else [target]
+
+
+def _prepare_all(df, site, mappings):
+    # The changes the tab makes to the manifest up to the last step, in order
+    ids_as_str(df)
+    for col, allowed in [('sample_type', ALLOWED_SAMPLES), ('study_type', ALLOWED_STUDY_TYPE)]:
+        df[col] = fix_vocabulary(df, col, allowed)
+    for col in MAPPINGS.keys():
+        map_column(df, col, mappings[col] if col in mappings else default_mapping(df, col))
+    return df
+
+
+def by_step(findings, rules=SAMPLE_MANIFEST):
+    """{step: findings of its rules}, in rule order. Findings that are not of a rule
+    (e.g. the columns checks) are left out
+    """
+    step_of = {rule['name']: rule['step'] for rule in rules.rules}
+    steps = {step: [] for step in rules.steps}
+    for found in findings:
+        if found['check'] in step_of:
+            steps[step_of[found['check']]].append(found)
+    return steps
+
+
+def _run(rules, df, collect_all):
+    # One pass of all the rules. Without collect_all, the findings up to the first step with errors
+    found = rules.findings(df)
+    if collect_all:
+        return found
+    findings = []
+    for step, step_found in by_step(found, rules).items():
+        findings += step_found
+        if len(errors(step_found)) > 0:
+            break
+    return findings
+
+
+def validate(df, site, mappings=None, collect_all=False):
+    """Run the checks of the sample manifest tab on df, up to the first step with
+    errors, or all of them with collect_all. GP2 IDs are not assigned. mappings is
+    {column: {value: GP2 value}} for the columns of MAPPINGS, default_mapping by
+    default. Returns (df, findings)
+    """
+    raw = df.drop(columns=[col for col in DERIVED_COLS if col in df.columns])
+    findings = check_columns(raw)
+    if len(findings) > 0:
+        # Unexpected columns do not stop the other checks, missing ones do
+        if not collect_all or findings[0]['check'] == 'missing_columns':
+            return df, findings
+        df = df[[col for col in df.columns if col in COLS or col in DERIVED_COLS]]
+    df = _prepare_all(prepare(df, site), site, {} if mappings is None else mappings)
+    return df, findings + _run(SAMPLE_MANIFEST, df, collect_all)
+
+
+def validate_clinical(df, collect_all=False):
+    """Run the checks of the clinical data tab on df (but the sample ids being
+    registered, see idsregistry). visit_month is converted to int if it can be.
+    Returns (df, findings)
+    """
+    findings = CLINICAL.check_columns(df)
+    if len(findings) > 0:
+        return df, findings
+    df = df.copy()
+    findings += _run(CLINICAL, df, collect_all)
+    if 'visit_month' not in [found['check'] for found in findings] and df['visit_month'].notna().all():
+        df['visit_month'] = pd.to_numeric(df['visit_month']).astype(int)
+    df['sample_id'] = df['sample_id'].where(df['sample_id'].isna(), df['sample_id'].astype(str))
+    return df, findings
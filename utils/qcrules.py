@@ -0,0 +1,155 @@
+"""Declarative QC rules, compiled into one vectorized pass over a DataFrame.
+
+A rule is a dict:
+
+    {'name': 'sample_id_duplicates',   # check name of its findings, unique in a RuleSet
+     'step': 'sample_id',              # step of the tab it belongs to
+     'kind': 'unique',                 # see below
+     'columns': ['sample_id'],
+     'when': {'study_type': ['Monogenic']},  # optional, only rows with these values
+     'level': 'error',                 # or warning
+     'message': 'Duplicated sample_id:{values}',  # {values}: values of the rows found
+     'hint': None,
+     'show': ['sample_id', 'clinical_id']}   # columns shown with the rows, optional
+
+Kinds, and the rows they flag (missing values are only flagged by required):
+    required   a missing value in any of the columns
+    empty      a value in any of the columns
+    allowed    a value not in rule['values']
+    numeric    a value that is not a number
+    integer    a value that is not a whole number
+    range      a number below rule['min'] or above rule['max'] (either is optional)
+    unique     the same values of the columns as another row
+    max_count  a value found on more than rule['max'] rows
+    max_rate   rule['value'], if found on more than rule['max'] of the rows
+
+RuleSet.matrix returns the boolean violation matrix (one column per rule) of a
+DataFrame. The missing values, numbers and conditions the rules need are computed
+once for all of them, so adding a rule does not add another scan of the data.
+"""
+import numpy as np
+import pandas as pd
+
+MAX_VALUES = 20 # values listed in a message, the rows have all of them
+
+
+def finding(check, level, message, rows=None, columns=None, hint=None):
+    return {'check': check, 'level': level, 'message': message,
+            'rows': [] if rows is None else [int(row) for row in rows],
+            'columns': columns, 'hint': hint}
+
+
+def list_values(values):
+    values = list(values)
+    if len(values) > MAX_VALUES:
+        return f'{values[:MAX_VALUES]} and {len(values) - MAX_VALUES} more'
+    return f'{values}'
+
+
+class RuleSet:
+    def __init__(self, rules, columns=None, strict=False):
+        """rules are checked in order. columns are the columns a file must have, and
+        only them if strict
+        """
+        names = [rule['name'] for rule in rules]
+        if len(set(names)) != len(names):
+            raise ValueError(f'Rule names are not unique: {sorted(set(name for name in names if names.count(name) > 1))}')
+        self.rules = rules
+        self.columns = columns
+        self.strict = strict
+        self.steps = list(dict.fromkeys(rule['step'] for rule in rules))
+
+    def check_columns(self, df):
+        missing_cols = np.setdiff1d(self.columns, df.columns)
+        if len(missing_cols) > 0:
+            return [finding('missing_columns', 'error', f'{list(missing_cols)} are missing. Please use the template sheet')]
+        not_required_cols = np.setdiff1d(df.columns, self.columns)
+        if self.strict and len(not_required_cols) > 0:
+            return [finding('unexpected_columns', 'error', 'We have detected more unexpected columns in the input file',
+                            hint=f'{list(not_required_cols)} should not be in the file. Please use the template sheet')]
+        return []
+
+    def select(self, steps=None):
+        return [rule for rule in self.rules if steps is None or rule['step'] in steps]
+
+    def matrix(self, df, rules=None):
+        """Boolean DataFrame of the rows (index of df) x rules (names) they break"""
+        rules = self.rules if rules is None else rules
+        used = list(dict.fromkeys(col for rule in rules for col in rule['columns']))
+        missing = df[used].isna().to_numpy()
+        col_index = {col: i for i, col in enumerate(used)}
+        numbers = {}
+        masks = {}
+
+        def number(col):
+            if col not in numbers:
+                numbers[col] = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float)
+            return numbers[col]
+
+        def when(rule):
+            key = tuple((col, tuple(values)) for col, values in sorted(rule.get('when', {}).items()))
+            if key not in masks:
+                mask = np.ones(len(df), dtype=bool)
+                for col, values in key:
+                    mask &= df[col].isin(values).to_numpy()
+                masks[key] = mask
+            return masks[key]
+
+        out = {}
+        for rule in rules:
+            cols = rule['columns']
+            isna = missing[:, [col_index[col] for col in cols]]
+            kind = rule['kind']
+            if kind == 'required':
+                found = isna.any(axis=1)
+            elif kind == 'empty':
+                found = ~isna.all(axis=1)
+            elif kind == 'allowed':
+                found = np.zeros(len(df), dtype=bool)
+                for i, col in enumerate(cols):
+                    found |= ~isna[:, i] & ~df[col].isin(rule['values']).to_numpy()
+            elif kind in ['numeric', 'integer', 'range']:
+                found = np.zeros(len(df), dtype=bool)
+                for i, col in enumerate(cols):
+                    values = number(col)
+                    with np.errstate(invalid='ignore'):
+                        if kind == 'numeric':
+                            found |= ~isna[:, i] & np.isnan(values)
+                        elif kind == 'integer':
+                            found |= ~isna[:, i] & (np.isnan(values) | (values % 1 != 0))
+                        else:
+                            if rule.get('min') is not None:
+                                found |= values < rule['min']
+                            if rule.get('max') is not None:
+                                found |= values > rule['max']
+            elif kind == 'unique':
+                found = df.duplicated(subset=cols, keep=False).to_numpy() & ~isna.any(axis=1)
+            elif kind == 'max_count':
+                counts = df.groupby(cols[0])[cols[0]].transform('size').to_numpy(dtype=float)
+                found = ~isna[:, 0] & (counts > rule['max'])
+            elif kind == 'max_rate':
+                found = (df[cols[0]] == rule['value']).to_numpy()
+                if found.mean() <= rule['max']:
+                    found = np.zeros(len(df), dtype=bool)
+            else:
+                raise ValueError(f'Unknown rule kind {kind} of {rule["name"]}')
+            if 'when' in rule:
+                found &= when(rule)
+            out[rule['name']] = found
+        return pd.DataFrame(out, index=df.index, columns=[rule['name'] for rule in rules])
+
+    def findings(self, df, steps=None, matrix=None):
+        """Findings of the rules of steps (all by default), in rule order"""
+        rules = self.select(steps)
+        matrix = self.matrix(df, rules) if matrix is None else matrix
+        findings = []
+        for rule in rules:
+            found = matrix[rule['name']].to_numpy()
+            if not found.any():
+                continue
+            values = list_values(df.loc[found, rule['columns'][0]].dropna().unique())
+            show = rule.get('show', ['sample_id'] + [col for col in rule['columns'] if col != 'sample_id'])
+            findings.append(finding(rule['name'], rule.get('level', 'error'), rule['message'].format(values=values),
+                                    rows=df.index[found], columns=show,
+                                    hint=None if rule.get('hint') is None else rule['hint'].format(values=values)))
+        return findings
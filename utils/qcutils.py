@@ -1,6 +1,7 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import qcengine
 
 def checkNull(df, voi):
     """
@@ -70,6 +71,52 @@ def data_naproc(df):
   return(df[cleancols], cleancols)
 
 
+@st.cache_data(max_entries=64, ttl=3600, show_spinner=False)
+def _cached_stage(key, _compute):
+  return _compute()
+
+
+def qc_stage(key, compute):
+  """
+  Result of compute(), cached across reruns by key. The key must hold everything the
+  stage is computed from: the hash of the file, the choices of the user, and the key of
+  the stage it follows, so that a change only recomputes the stages after it.
+  The results are copies, they can be changed
+  """
+  return _cached_stage(key, compute)
+
+
+def show_report(df, findings, name='qc_report.csv'):
+  """
+  Show all the findings of a collect_all QC pass (see qcengine) grouped by level
+  and check, with the spreadsheet rows to fix. Stops the app if there are errors
+  """
+  if len(findings) == 0:
+    return
+  lines = qcengine.report(findings)
+  n_errors = (lines['level'] == 'error').sum()
+  if n_errors > 0:
+    st.error(f'We have found {n_errors} problems in the file. Please fix all of them and upload it again')
+  for level, show in [('error', st.error), ('warning', st.warning)]:
+    level_findings = [found for found in findings if found['level'] == level]
+    if len(level_findings) == 0:
+      continue
+    st.markdown(f'**{level.capitalize()}s**')
+    for found in sorted(level_findings, key=lambda found: found['check']):
+      rows = f" (rows {qcengine.row_ranges(found['rows'])})" if len(found['rows']) > 0 else ''
+      with st.expander(f"{found['check']}: {len(found['rows'])} rows" if len(found['rows']) > 0 else found['check']):
+        show(found['message'] + rows)
+        if found['hint'] is not None:
+          st.text(found['hint'])
+        if len(found['rows']) > 0:
+          st.dataframe(qcengine.finding_rows(df, found))
+  st.download_button(label='📥 Download the QC report',
+                     data = lines.to_csv(index=False).encode('utf-8'),
+                     file_name = name)
+  if n_errors > 0:
+    st.stop()
+
+
 def detect_multiple_clindups(df):
   st.error(f'There seems to be a problem with this sample manifest')
   groupids = df.groupby(['clinical_id']).size().sort_values(ascending=False)
@@ -0,0 +1,131 @@
+"""Audit the GP2 IDs registry: every study is checked in a separate worker process
+and the findings are written to a json report.
+
+    python utils/registrycli.py audit --report registry_audit.json
+"""
+import os
+import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import idscache
+import idsregistry
+
+MAX_EXAMPLES = 20 # examples kept in the report for each finding
+
+# Findings that mean the registry is inconsistent. The rest are reported as warnings
+ERRORS = ['duplicate_gp2sampleid', 'gp2id_with_several_clinical_ids', 'clinical_id_with_several_gp2ids',
+          'counter_behind_ids', 'lease_overlaps_ids', 'sample_id_with_several_clinical_ids']
+WARNINGS = ['irregular_gp2sampleid', 'replicate_gaps', 'id_number_gaps']
+
+
+def _finding(examples):
+    return {'count': len(examples), 'examples': examples[:MAX_EXAMPLES]}
+
+
+def _ranges(numbers):
+    """[[start, end], ...] runs of consecutive numbers in the sorted array"""
+    breaks = np.flatnonzero(np.diff(numbers) != 1) + 1
+    starts = np.concatenate([numbers[:1], numbers[breaks]])
+    ends = np.concatenate([numbers[breaks - 1], numbers[-1:]])
+    return [[int(start), int(end)] for start, end in zip(starts, ends)]
+
+
+def _several(df, key, column):
+    """(key, sorted unique values) of the keys with more than one value in column"""
+    counts = df.groupby(key)[column].nunique()
+    found = df[df[key].isin(counts.index[counts > 1])]
+    return [(value, sorted(set(values), key=str)) for value, values in found.groupby(key)[column].agg(list).items()]
+
+
+def audit_study(study, cache_path, next_id, leases=None):
+    """Check the IDs of the study in the local index at cache_path. leases is the
+    lease object of the study, if any. Returns {finding: {count, examples}}
+    """
+    idscache.CACHE_PATH = cache_path
+    df = pd.DataFrame(idscache.study_rows(study),
+                      columns=['sample_id', 'GP2sampleID', 'clinical_id', 'GP2ID', 'id_number', 'rep_no'])
+    findings = {}
+
+    dups = df[df.duplicated('GP2sampleID', keep=False)]
+    findings['duplicate_gp2sampleid'] = _finding(
+        [{'GP2sampleID': gp2, 'sample_ids': sample_ids} for gp2, sample_ids in dups.groupby('GP2sampleID')['sample_id'].agg(list).items()])
+
+    irregular = df[df['id_number'].isna() | df['rep_no'].isna()]
+    findings['irregular_gp2sampleid'] = _finding(irregular[['sample_id', 'GP2sampleID']].to_dict('records'))
+
+    df = df.drop(irregular.index)
+    findings['gp2id_with_several_clinical_ids'] = _finding(
+        [{'GP2ID': gp2id, 'clinical_ids': clinical_ids} for gp2id, clinical_ids in _several(df, 'GP2ID', 'clinical_id')])
+    findings['clinical_id_with_several_gp2ids'] = _finding(
+        [{'clinical_id': clinical_id, 'GP2IDs': gp2ids} for clinical_id, gp2ids in _several(df, 'clinical_id', 'GP2ID')])
+
+    # Replicates of a GP2ID are numbered s1..sN
+    reps = df.groupby('GP2ID')['rep_no'].agg(['max', 'nunique'])
+    gaps = df[df['GP2ID'].isin(reps.index[reps['max'] != reps['nunique']])]
+    findings['replicate_gaps'] = _finding(
+        [{'GP2ID': gp2id, 'replicates': sorted(int(rep) for rep in rep_nos)} for gp2id, rep_nos in gaps.groupby('GP2ID')['rep_no'].agg(list).items()])
+
+    # ID numbers against the counter and the numbers leased to QC sessions
+    numbers = sorted(df['id_number'].astype(int).unique().tolist())
+    findings['counter_behind_ids'] = _finding([{'next_id': next_id, 'highest_id_number': numbers[-1]}]
+                                              if len(numbers) > 0 and numbers[-1] >= next_id else [])
+    overlaps = []
+    if leases is not None and len(numbers) > 0:
+        if leases['next'] <= numbers[-1]:
+            overlaps.append({'lease_next': leases['next'], 'highest_id_number': numbers[-1]})
+        for start, end in leases['free']:
+            used = df.loc[(df['id_number'] >= start) & (df['id_number'] < end), 'id_number']
+            if len(used) > 0:
+                overlaps.append({'free_range': [start, end], 'used_numbers': sorted(used.astype(int).unique().tolist())[:10]})
+    findings['lease_overlaps_ids'] = _finding(overlaps)
+    missing = np.setdiff1d(np.arange(1, numbers[-1] + 1), numbers) if len(numbers) > 0 else np.zeros(0, dtype=int)
+    findings['id_number_gaps'] = _finding(_ranges(missing))
+
+    return study, len(df) + len(irregular), findings
+
+
+def _sample_id_conflicts(cache_path, studies):
+    """Sample ids registered in several studies with different clinical ids"""
+    idscache.CACHE_PATH = cache_path
+    df = pd.DataFrame(idscache.sample_id_conflicts(studies), columns=['study', 'sample_id', 'GP2sampleID', 'clinical_id'])
+    return _finding([{'sample_id': sample_id, 'entries': group[['study', 'GP2sampleID', 'clinical_id']].to_dict('records')}
+                     for sample_id, group in df.groupby('sample_id', sort=False)])
+
+
+def audit_registry(studies=None, workers=None, bucket=None):
+    """Sync the studies (all the registry by default) to the local index and
+    audit them in parallel. Returns the report
+    """
+    bucket = bucket if bucket is not None else idsregistry.get_bucket()
+    manifest = idsregistry.load_manifest(bucket)
+    if studies is None:
+        studies = list(manifest['studies'].keys()) + manifest['legacy_studies']
+    start = dt.datetime.now()
+
+    # Reading the registry is network bound, checking it is cpu bound
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        registered = list(pool.map(lambda study: idsregistry.sync_studies([study], bucket=bucket), studies))
+        studies = [study for study, found in zip(studies, registered) if len(found) > 0]
+        leases = list(pool.map(lambda study: idsregistry._read_json(bucket, idsregistry.lease_path(study))[0], studies))
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.submit(audit_study, study, idscache.CACHE_PATH, idscache.next_id_number(study), lease)
+                   for study, lease in zip(studies, leases)]
+        cross_study = pool.submit(_sample_id_conflicts, idscache.CACHE_PATH, studies)
+        results = [future.result() for future in futures]
+
+    report = {'date': start.isoformat(timespec='seconds'),
+              'seconds': round((dt.datetime.now() - start).total_seconds(), 2),
+              'n_studies': len(studies),
+              'n_ids': sum(n_ids for _, n_ids, _ in results),
+              'errors': 0,
+              'warnings': 0,
+              'sample_id_with_several_clinical_ids': cross_study.result(),
+              'studies': {}}
+    report['errors'] += report['sample_id_with_several_clinical_ids']['count']
+    for study, n_ids, findings in results:
+        report['studies'][study] = {'n_ids': n_ids, 'findings': {k: v for k, v in findings.items() if v['count'] > 0}}
+        report['errors'] += sum(findings[k]['count'] for k in ERRORS if k in findings)
+        report['warnings'] += sum(findings[k]['count'] for k in WARNINGS if k in findings)
+    return report
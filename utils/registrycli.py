@@ -0,0 +1,128 @@
+"""Maintenance commands for the GP2 IDs registry.
+
+    python utils/registrycli.py backfill-counters [--studies STUDY ...]
+    python utils/registrycli.py reclaim-leases [--studies STUDY ...] [--hours 48]
+    python utils/registrycli.py audit [--studies STUDY ...] [--workers N] [--report registry_audit.json]
+    python utils/registrycli.py journal STUDY
+    python utils/registrycli.py rollback STUDY SEQ [--sample-ids ID ...] [--scode CODE]
+    python utils/registrycli.py history STUDY GP2ID
+    python utils/registrycli.py snapshot STUDY DATE [--out study.json]
+"""
+import os
+import sys
+import json
+import argparse
+import datetime as dt
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import gcsclient
+import idsregistry
+import registryaudit
+
+
+def backfill_counters(args):
+    counters = idsregistry.backfill_counters(studies=args.studies)
+    for study, next_id in sorted(counters.items()):
+        print(f'{study}: next_id {next_id}')
+
+
+def reclaim_leases(args):
+    closed = idsregistry.reclaim_leases(studies=args.studies, max_age=dt.timedelta(hours=args.hours))
+    for study, n in sorted(closed.items()):
+        print(f'{study}: {n} abandoned leases closed')
+
+
+def audit(args):
+    report = registryaudit.audit_registry(studies=args.studies, workers=args.workers)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=1)
+    for study, result in sorted(report['studies'].items()):
+        for finding, found in result['findings'].items():
+            print(f'{study}: {found["count"]} {finding}')
+    print(f'{report["n_ids"]} IDs of {report["n_studies"]} studies audited in {report["seconds"]}s: '
+          f'{report["errors"]} errors, {report["warnings"]} warnings. Report written to {args.report}')
+    sys.exit(1 if report['errors'] > 0 else 0)
+
+
+def journal(args):
+    for entry in idsregistry.read_journal(args.study):
+        reverts = f" reverts {entry['reverts']}" if 'reverts' in entry else ''
+        print(f"{entry['seq']}\t{entry['date']}\t{entry['scode']}\t{entry['op']} {len(entry['ids'])} IDs{reverts}")
+
+
+def rollback(args):
+    entry = idsregistry.rollback(args.study, args.seq, sample_ids=args.sample_ids, scode=args.scode)
+    if entry is None:
+        print(f'{args.study}: nothing left to revert in journal entry {args.seq}')
+    else:
+        print(f"{args.study}: journal entry {args.seq} reverted by entry {entry['seq']} ({entry['op']} {len(entry['ids'])} IDs)")
+
+
+def history(args):
+    for entry in idsregistry.gp2id_history(args.study, args.gp2id):
+        date = entry['date'] or 'legacy mapper'
+        for sample_id, (gp2sampleid, clinical_id) in entry['ids'].items():
+            print(f"{entry['seq']}\t{date}\t{entry['scode']}\t{entry['op']}\t{sample_id}\t{gp2sampleid}\t{clinical_id}")
+
+
+def snapshot(args):
+    tracker = idsregistry.study_at(args.study, args.date)
+    out = args.out or f'{args.study}_{args.date}.json'
+    with open(out, 'w') as f:
+        json.dump(tracker, f)
+    print(f'{args.study}: {len(tracker)} IDs as of {args.date} written to {out}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--stats', action='store_true', help='print the GCS requests made and their latency')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    backfill = commands.add_parser('backfill-counters',
+                                   help='store the next GP2 ID number of studies registered before the counter existed')
+    backfill.add_argument('--studies', nargs='+', default=None, help='all the registry studies by default')
+    backfill.set_defaults(func=backfill_counters)
+
+    reclaim = commands.add_parser('reclaim-leases',
+                                  help='give back the GP2 ID numbers leased by sessions that never finished')
+    reclaim.add_argument('--studies', nargs='+', default=None, help='all the studies with leases by default')
+    reclaim.add_argument('--hours', type=float, default=idsregistry.LEASE_TTL.total_seconds() / 3600,
+                         help='age of the leases to close')
+    reclaim.set_defaults(func=reclaim_leases)
+
+    check = commands.add_parser('audit', help='check the integrity of the registry and write a json report')
+    check.add_argument('--studies', nargs='+', default=None, help='all the registry studies by default')
+    check.add_argument('--workers', type=int, default=None, help='worker processes, one per cpu by default')
+    check.add_argument('--report', default='registry_audit.json', help='path of the report')
+    check.set_defaults(func=audit)
+
+    journal_cmd = commands.add_parser('journal', help='list the journal entries of a study')
+    journal_cmd.add_argument('study')
+    journal_cmd.set_defaults(func=journal)
+
+    revert = commands.add_parser('rollback', help='revert a journal entry of a study with a compensating entry')
+    revert.add_argument('study')
+    revert.add_argument('seq', type=int, help='journal entry to revert, see the journal command')
+    revert.add_argument('--sample-ids', nargs='+', default=None, help='only revert these sample ids')
+    revert.add_argument('--scode', default=None, help='study code recorded in the new entry')
+    revert.set_defaults(func=rollback)
+
+    lookup = commands.add_parser('history', help='when the samples of a GP2 ID were added or removed')
+    lookup.add_argument('study')
+    lookup.add_argument('gp2id', help='GP2ID or GP2sampleID')
+    lookup.set_defaults(func=history)
+
+    past = commands.add_parser('snapshot', help='the IDs of a study as they were at a date')
+    past.add_argument('study')
+    past.add_argument('date', help='YYYY-MM-DD (end of the day) or YYYY-MM-DDTHH:MM:SS')
+    past.add_argument('--out', default=None, help='json file to write, STUDY_DATE.json by default')
+    past.set_defaults(func=snapshot)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    finally:
+        if args.stats:
+            for kind, stat in sorted(gcsclient.stats().items()):
+                print(f"GCS {kind}: {stat['requests']} requests, {stat['errors']} errors, "
+                      f"{stat['total_ms'] / stat['requests']:.0f} ms on average", file=sys.stderr)
@@ -0,0 +1,153 @@
+"""Simulate N sessions committing new GP2 IDs to the registry at the same time,
+against the in-memory (or a local directory) storage backend, and check that no commit is lost.
+With --cli, every registrycli command is then run on the simulated registry.
+
+    python utils/registrysim.py --committers 16 --studies 2 --commits 3 [--local /tmp/registry] [--cli]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import idscache
+import idsregistry
+from storagebackend import MemoryBucket, LocalBucket
+
+
+def simulate(n_committers=8, n_studies=2, n_commits=3, ids_per_commit=50,
+             clashes=0, latency=0.002, compact_every=5, local=None):
+    """Every committer commits n_commits batches of new IDs to a random study.
+    clashes adds pairs of committers registering the same sample ids with different
+    GP2 IDs: exactly one of each pair must fail with RegistryConflict. With local,
+    the registry is written to that directory (see storagebackend.LocalBucket)
+    """
+    idscache.CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'sim_idsregistry.sqlite')
+    idsregistry.COMPACT_EVERY = compact_every
+    bucket = MemoryBucket(latency=latency) if local is None else LocalBucket(local, latency=latency)
+    studies = [f'SIM{i}' for i in range(n_studies)]
+
+    numbers = iter(range(1, 10**7))
+    numbers_lock = threading.Lock()
+    committed = {study: {} for study in studies}
+    conflicts = []
+    failed = []
+    results_lock = threading.Lock()
+
+    def new_ids(study, prefix):
+        with numbers_lock:
+            return {f'{prefix}_{i}': [f'{study}_{next(numbers):06}_s1', f'{prefix}_c{i}']
+                    for i in range(ids_per_commit)}
+
+    def committer(c):
+        for k in range(n_commits):
+            study = studies[(c + k) % n_studies]
+            ids_log = {study: new_ids(study, f'c{c}k{k}')}
+            try:
+                idsregistry.commit_ids([ids_log], scode=study, bucket=bucket)
+            except idsregistry.RegistryConflict:
+                with results_lock:
+                    failed.append((c, k))
+                continue
+            with results_lock:
+                committed[study].update(ids_log[study])
+
+    def clasher(pair, side):
+        study = studies[pair % n_studies]
+        ids_log = {study: new_ids(study, f'clash{pair}')}
+        try:
+            idsregistry.commit_ids([ids_log], scode=study, bucket=bucket)
+            with results_lock:
+                committed[study].update(ids_log[study])
+        except idsregistry.RegistryConflict:
+            with results_lock:
+                conflicts.append((pair, side))
+
+    threads = [threading.Thread(target=committer, args=(c,)) for c in range(n_committers)]
+    threads += [threading.Thread(target=clasher, args=(pair, side))
+                for pair in range(clashes) for side in range(2)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - start
+
+    # Read everything back with an empty local index
+    idscache.CACHE_PATH = os.path.join(tempfile.mkdtemp(), 'sim_check.sqlite')
+    registry = idsregistry.read_studies(studies, bucket=bucket)
+    missing = sum(len(set(ids) - set(registry.get(study, {}))) for study, ids in committed.items())
+    wrong = sum(registry[study][sample_id] != value for study, ids in committed.items()
+                for sample_id, value in ids.items() if sample_id in registry.get(study, {}))
+    extra = sum(len(set(registry.get(study, {})) - set(ids)) for study, ids in committed.items())
+    return {'committers': n_committers + 2 * clashes,
+            'committed_ids': sum(len(ids) for ids in committed.values()),
+            'registry_ids': sum(len(ids) for ids in registry.values()),
+            'missing': missing,
+            'wrong': wrong,
+            'extra': extra,
+            'failed_commits': len(failed),
+            'conflicts': len(conflicts),
+            'expected_conflicts': clashes,
+            'requests': bucket.requests,
+            'seconds': round(seconds, 2)}
+
+
+def check_cli(local, study='SIM0'):
+    """Run every registrycli command on the registry of the local directory (see
+    simulate). Returns the commands that failed, with their output
+    """
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ, GP2_STORAGE='local', GP2_STORAGE_ROOT=os.path.dirname(os.path.abspath(local)),
+               GP2_BUCKET=os.path.basename(os.path.abspath(local)),
+               GP2_IDS_CACHE=os.path.join(tmp, 'cli_idsregistry.sqlite'))
+    idscache.CACHE_PATH = os.path.join(tmp, 'cli_check.sqlite')
+    tracker = idsregistry.read_studies([study], bucket=LocalBucket(local))[study]
+    sample_id, (gp2sampleid, _) = next(iter(tracker.items()))
+    commands = [['backfill-counters', '--studies', study],
+                ['reclaim-leases', '--studies', study],
+                ['audit', '--studies', study, '--workers', '1', '--report', os.path.join(tmp, 'audit.json')],
+                ['journal', study],
+                ['history', study, gp2sampleid],
+                ['snapshot', study, time.strftime('%Y-%m-%d'), '--out', os.path.join(tmp, 'snapshot.json')],
+                ['rollback', study, '1', '--sample-ids', sample_id]]
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'registrycli.py')
+    failed = {}
+    for command in commands:
+        run = subprocess.run([sys.executable, cli] + command, env=env, capture_output=True, text=True)
+        if run.returncode != 0:
+            failed[command[0]] = (run.stdout + run.stderr).strip()[-2000:]
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--committers', type=int, default=8)
+    parser.add_argument('--studies', type=int, default=2)
+    parser.add_argument('--commits', type=int, default=3)
+    parser.add_argument('--ids', type=int, default=50)
+    parser.add_argument('--clashes', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.002)
+    parser.add_argument('--local', default=None, help='directory to keep the registry in, in memory by default')
+    parser.add_argument('--cli', action='store_true', help='then run every registrycli command on the registry '
+                                                          '(kept in a temporary directory without --local)')
+    args = parser.parse_args()
+    if args.cli and args.local is None:
+        args.local = os.path.join(tempfile.mkdtemp(), 'registry')
+
+    report = simulate(n_committers=args.committers, n_studies=args.studies, n_commits=args.commits,
+                      ids_per_commit=args.ids, clashes=args.clashes, latency=args.latency,
+                      local=args.local)
+    failed_cli = check_cli(args.local) if args.cli else {}
+    report['failed_cli'] = sorted(failed_cli)
+    for k, v in report.items():
+        print(f'{k}: {v}')
+    for command, output in failed_cli.items():
+        print(f'registrycli {command} failed:\n{output}')
+    ok = (report['failed_commits'] == 0 and report['missing'] == 0 and report['wrong'] == 0 and report['extra'] == 0
+          and report['conflicts'] == report['expected_conflicts'] and len(failed_cli) == 0)
+    print('OK' if ok else 'FAILED')
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+
+# Process-wide coalescing of reads. Streamlit runs the sessions of the app as threads
+# of one process, so sessions reading the same object generation at the same time
+# share one download, and the result is kept in a bounded LRU for the next ones.
+# Keys include the object generation: a new generation is a new key, and results are
+# never stale. Results are shared between callers, who must not modify them.
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0 # served from the LRU
+        self.shared = 0 # waited for a load in flight
+        self.loads = 0
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._calls = {}
+
+    def get(self, key, load):
+        """Result of load() for key. Only one load per key runs at a time: concurrent
+        callers wait for it and get its result, or its exception
+        """
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+            call = self._calls.get(key)
+            owner = call is None
+            if owner:
+                call = self._calls[key] = _Call()
+                self.loads += 1
+            else:
+                self.shared += 1
+        if not owner:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = load()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None:
+                    self._results[key] = call.result
+                    while len(self._results) > self.maxsize:
+                        self._results.popitem(last=False)
+            call.done.set()
+        return call.result
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
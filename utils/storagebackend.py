@@ -0,0 +1,267 @@
+import io
+import os
+import json
+import gzip
+import time
+import fcntl
+import random
+import itertools
+import tempfile
+import threading
+from google.api_core.exceptions import NotFound, PreconditionFailed
+import gcsclient
+
+# Storage backends of the app. The registry and the uploads use the part of the
+# google.cloud.storage Bucket/Blob API implemented here: get_blob, blob, list_blobs,
+# ranged and conditional downloads, conditional uploads with metadata and
+# content encoding, and object generations. GP2_STORAGE selects the backend:
+#   gcs     the GCS buckets (default)
+#   local   a directory per bucket under GP2_STORAGE_ROOT, shared by processes
+#   memory  process-wide in-memory buckets
+# so registry and upload code can be run and benchmarked with no network.
+BACKEND = os.environ.get('GP2_STORAGE', 'gcs')
+STORAGE_ROOT = os.environ.get('GP2_STORAGE_ROOT', os.path.join(tempfile.gettempdir(), 'gp2_storage'))
+BUCKET_NAME = os.environ.get('GP2_BUCKET', 'eu-samplemanifest')
+
+_memory_buckets = {}
+_generations = itertools.count(1) # unique across the memory buckets of the process, like GCS generations
+_memory_lock = threading.Lock()
+
+
+def get_bucket(bucket_name=None):
+    """Bucket handle of the configured backend"""
+    bucket_name = bucket_name or BUCKET_NAME
+    if BACKEND == 'gcs':
+        return gcsclient.get_bucket(bucket_name)
+    if BACKEND == 'local':
+        return LocalBucket(os.path.join(STORAGE_ROOT, bucket_name), name=bucket_name)
+    if BACKEND == 'memory':
+        with _memory_lock:
+            return _memory_buckets.setdefault(bucket_name, MemoryBucket(name=bucket_name))
+    raise ValueError(f'Unknown storage backend {BACKEND}, GP2_STORAGE should be gcs, local or memory')
+
+
+class Blob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.content_type = None
+        self.content_encoding = None
+        self.generation = None
+        self.size = None
+
+    def _load(self, stored):
+        self.metadata = dict(stored['metadata']) if stored['metadata'] else None
+        self.content_type = stored['content_type']
+        self.content_encoding = stored['content_encoding']
+        self.generation = stored['generation']
+        self.size = stored['size'] if 'size' in stored else len(stored['data'])
+        return self
+
+    def exists(self):
+        return self.bucket._get(self.name) is not None
+
+    def reload(self):
+        stored = self.bucket._get(self.name)
+        if stored is None:
+            raise NotFound(self.name)
+        self._load(stored)
+
+    def download_as_bytes(self, start=None, end=None, if_generation_match=None, raw_download=False, **kwargs):
+        stored = self.bucket._get(self.name)
+        if stored is None:
+            raise NotFound(self.name)
+        if if_generation_match is not None and stored['generation'] != if_generation_match:
+            raise PreconditionFailed(self.name)
+        data = stored['data']
+        if stored['content_encoding'] == 'gzip' and not raw_download:
+            # GCS decompressive transcoding: served decompressed, ranges do not apply
+            return gzip.decompress(data)
+        if start is not None or end is not None:
+            # Same semantics as GCS ranged downloads: end is inclusive
+            data = data[start or 0:None if end is None else end + 1]
+        return data
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None, **kwargs):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        stored = self.bucket._put(self.name, data, content_type, self.content_encoding, self.metadata,
+                                  if_generation_match)
+        self._load(stored)
+
+    def open(self, mode="r", **kwargs):
+        if 'r' in mode:
+            stream = io.BytesIO(self.download_as_bytes())
+            return stream if 'b' in mode else io.TextIOWrapper(stream, encoding='utf-8')
+        return _Writer(self, binary='b' in mode)
+
+    def delete(self, if_generation_match=None):
+        self.bucket._delete(self.name, if_generation_match)
+
+
+class _Writer(io.BytesIO):
+    def __init__(self, blob, binary):
+        super().__init__()
+        self.blob = blob
+        self.binary = binary
+
+    def write(self, data):
+        return super().write(data if self.binary else data.encode('utf-8'))
+
+    def close(self):
+        if not self.closed:
+            self.blob.upload_from_string(self.getvalue())
+        super().close()
+
+
+class _Bucket:
+    """Bucket API on top of the _get, _put, _delete and _list of a backend.
+    latency adds a random delay (in seconds) to each request to shuffle concurrent sessions
+    """
+
+    def __init__(self, name, latency=0):
+        self.name = name
+        self.latency = latency
+        self.requests = 0
+
+    def _wait(self):
+        self.requests += 1
+        if self.latency > 0:
+            time.sleep(random.uniform(0, self.latency))
+
+    def blob(self, name):
+        return Blob(self, name)
+
+    def get_blob(self, name):
+        stored = self._get(name)
+        return None if stored is None else Blob(self, name)._load(stored)
+
+    def list_blobs(self, prefix='', start_offset=None, end_offset=None, **kwargs):
+        return [Blob(self, name)._load(stored) for name, stored in sorted(self._list(prefix).items())
+                if (start_offset is None or name >= start_offset) and (end_offset is None or name < end_offset)]
+
+
+class MemoryBucket(_Bucket):
+    def __init__(self, name='memory', latency=0):
+        super().__init__(name, latency)
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name):
+        self._wait()
+        with self._lock:
+            return self._objects.get(name)
+
+    def _put(self, name, data, content_type, content_encoding, metadata, if_generation_match):
+        self._wait()
+        with self._lock:
+            current = self._objects.get(name)
+            current_generation = 0 if current is None else current['generation']
+            if if_generation_match is not None and if_generation_match != current_generation:
+                raise PreconditionFailed(name)
+            stored = {'data': bytes(data),
+                      'content_type': content_type,
+                      'content_encoding': content_encoding,
+                      'metadata': dict(metadata) if metadata else None,
+                      'generation': next(_generations)}
+            self._objects[name] = stored
+            return stored
+
+    def _delete(self, name, if_generation_match):
+        self._wait()
+        with self._lock:
+            current = self._objects.get(name)
+            if current is None:
+                raise NotFound(name)
+            if if_generation_match is not None and if_generation_match != current['generation']:
+                raise PreconditionFailed(name)
+            del self._objects[name]
+
+    def _list(self, prefix):
+        self._wait()
+        with self._lock:
+            return {name: stored for name, stored in self._objects.items() if name.startswith(prefix)}
+
+
+class LocalBucket(_Bucket):
+    """Objects stored as files under root, with their generation and metadata in a
+    json file next to them under root/.meta. Requests are serialized with a lock file,
+    so several processes can share the bucket. An object name can not also be the
+    prefix of a "directory" of other objects
+    """
+
+    def __init__(self, root, name=None, latency=0):
+        super().__init__(name or os.path.basename(root), latency)
+        self.root = root
+        os.makedirs(os.path.join(root, '.meta'), exist_ok=True)
+
+    def _paths(self, name):
+        return os.path.join(self.root, name), os.path.join(self.root, '.meta', name + '.json')
+
+    def _locked(self):
+        lock = open(os.path.join(self.root, '.meta', '.lock'), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock # released when closed
+
+    def _read(self, name, data=True):
+        data_path, meta_path = self._paths(name)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            stored = json.load(f)
+        if data:
+            with open(data_path, 'rb') as f:
+                stored['data'] = f.read()
+        return stored
+
+    def _get(self, name):
+        self._wait()
+        with self._locked():
+            return self._read(name)
+
+    def _put(self, name, data, content_type, content_encoding, metadata, if_generation_match):
+        self._wait()
+        data_path, meta_path = self._paths(name)
+        with self._locked():
+            current = self._read(name)
+            current_generation = 0 if current is None else current['generation']
+            if if_generation_match is not None and if_generation_match != current_generation:
+                raise PreconditionFailed(name)
+            stored = {'content_type': content_type,
+                      'content_encoding': content_encoding,
+                      'metadata': dict(metadata) if metadata else None,
+                      'generation': max(time.time_ns(), current_generation + 1),
+                      'size': len(data)}
+            for path, content in [(data_path, bytes(data)), (meta_path, json.dumps(stored).encode('utf-8'))]:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(content)
+                os.replace(path + '.tmp', path)
+            stored['data'] = bytes(data)
+            return stored
+
+    def _delete(self, name, if_generation_match):
+        self._wait()
+        data_path, meta_path = self._paths(name)
+        with self._locked():
+            current = self._read(name)
+            if current is None:
+                raise NotFound(name)
+            if if_generation_match is not None and if_generation_match != current['generation']:
+                raise PreconditionFailed(name)
+            os.remove(meta_path)
+            os.remove(data_path)
+
+    def _list(self, prefix):
+        self._wait()
+        meta_root = os.path.join(self.root, '.meta')
+        listed = {}
+        with self._locked():
+            for directory, _, files in os.walk(meta_root):
+                for file in files:
+                    if file.endswith('.json'):
+                        name = os.path.relpath(os.path.join(directory, file[:-len('.json')]), meta_root).replace(os.sep, '/')
+                        if name.startswith(prefix):
+                            listed[name] = self._read(name, data=False)
+        return listed
@@ -0,0 +1,191 @@
+import json
+import time
+import base64
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import google_crc32c
+from google.resumable_media import common
+import gcsclient
+import storagebackend
+
+# Uploads of the QC'd files to the bucket, run by background workers so the Streamlit
+# script is not held while the file is transferred. Files are sent in chunks with a
+# GCS resumable upload session: after a failure the upload asks GCS how much was
+# committed and carries on from there. A new session is only started if GCS no longer
+# knows the session (404/410). The CRC32C of the whole file is checked against the
+# one computed by GCS when the last chunk is sent. The local and memory buckets have
+# no resumable uploads, the file is written to them in one go.
+CHUNK_SIZE = 8 * 1024 * 1024 # GCS needs a multiple of 256 KiB
+MAX_RETRIES = 8 # failures in a row before the upload is given up
+UPLOAD_URL = 'https://storage.googleapis.com/upload/storage/v1/b/{bucket}/o?uploadType=resumable'
+TIMEOUT = (61, 60) # connect, read
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='gp2-upload')
+
+
+class _SessionGone(Exception):
+    """GCS no longer knows the upload session, the upload has to start again"""
+
+
+class _GCSUpload:
+    """A GCS resumable upload session, sent chunk by chunk"""
+
+    def __init__(self, bucket, name, data, content_type, chunk_size):
+        self.http = gcsclient.authorized_session()
+        self.name = name
+        self.data = data
+        self.chunk_size = chunk_size
+        self.bytes_uploaded = 0
+        self.finished = False
+        response = self.http.request('POST', UPLOAD_URL.format(bucket=bucket.name),
+                                     data=json.dumps({'name': name, 'contentType': content_type}),
+                                     headers={'content-type': 'application/json; charset=UTF-8',
+                                              'x-upload-content-type': content_type},
+                                     timeout=TIMEOUT)
+        if response.status_code != 200:
+            raise common.InvalidResponse(response, f'Could not start the upload of {name}')
+        self.url = response.headers['location']
+
+    def transmit_next_chunk(self):
+        start = self.bytes_uploaded
+        end = min(start + self.chunk_size, len(self.data))
+        total = len(self.data) if end == len(self.data) else '*'
+        content_range = f'bytes {start}-{end - 1}/{total}' if end > start else f'bytes */{total}'
+        self._process(self.http.request('PUT', self.url, data=self.data[start:end],
+                                        headers={'content-range': content_range}, timeout=TIMEOUT))
+
+    def recover(self):
+        # Asks GCS how much it has committed, the next chunk starts there
+        self._process(self.http.request('PUT', self.url, data=b'',
+                                        headers={'content-range': f'bytes */{len(self.data)}'}, timeout=TIMEOUT))
+
+    def _process(self, response):
+        if response.status_code == 308:
+            committed = response.headers.get('range')
+            self.bytes_uploaded = 0 if committed is None else int(committed.rsplit('-', 1)[1]) + 1
+        elif response.status_code in (200, 201):
+            crc32c = base64.b64encode(google_crc32c.Checksum(self.data).digest()).decode()
+            if response.json().get('crc32c') != crc32c:
+                raise common.DataCorruption(response, f'CRC32C mismatch uploading {self.name}')
+            self.bytes_uploaded = len(self.data)
+            self.finished = True
+        elif response.status_code in (404, 410):
+            raise _SessionGone(f'The upload session of {self.name} expired')
+        else:
+            raise common.InvalidResponse(response, f'Unexpected status {response.status_code} uploading {self.name}')
+
+
+class _BackendUpload:
+    """Same protocol for the local and memory buckets (see storagebackend). They have no
+    resumable uploads: the whole file is written at once, and its CRC32C checked on a read back
+    """
+
+    def __init__(self, bucket, name, data, content_type, chunk_size):
+        self.blob = bucket.blob(name)
+        self.data = data
+        self.content_type = content_type
+        self.bytes_uploaded = 0
+        self.finished = False
+
+    def transmit_next_chunk(self):
+        self.blob.upload_from_string(self.data, content_type=self.content_type)
+        if google_crc32c.value(self.blob.download_as_bytes()) != google_crc32c.value(self.data):
+            raise common.DataCorruption(None, f'CRC32C mismatch uploading {self.blob.name}')
+        self.bytes_uploaded = len(self.data)
+        self.finished = True
+
+    def recover(self):
+        pass
+
+
+def _transient(error):
+    if isinstance(error, common.InvalidResponse):
+        return error.response is not None and error.response.status_code in common.RETRYABLE
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ConnectionError))
+
+
+class UploadJob:
+    """An upload running in the background. state is queued, uploading, retrying, done or failed"""
+
+    def __init__(self, bucket, destination, data, content_type='text/plain', chunk_size=CHUNK_SIZE):
+        self.bucket = bucket
+        self.destination = destination
+        self.data = data
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self.size = len(data)
+        self.uploaded = 0
+        self.state = 'queued'
+        self.error = None
+        self.retries = 0 # failures in a row
+        self.notified = False # for the page, to act once on a finished upload
+        self._done = threading.Event()
+
+    def progress(self):
+        return 1.0 if self.size == 0 else self.uploaded / self.size
+
+    def finished(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _new_session(self):
+        if isinstance(self.bucket, (storagebackend.MemoryBucket, storagebackend.LocalBucket)):
+            return _BackendUpload(self.bucket, self.destination, self.data, self.content_type, self.chunk_size)
+        return _GCSUpload(self.bucket, self.destination, self.data, self.content_type, self.chunk_size)
+
+    def run(self):
+        self.state = 'uploading'
+        session = None
+        recovering = False
+        try:
+            while session is None or not session.finished:
+                try:
+                    if session is None:
+                        session = self._new_session()
+                    if recovering:
+                        session.recover() # where GCS says the upload is, it may be behind the last chunk sent
+                        recovering = False
+                    if not session.finished:
+                        session.transmit_next_chunk()
+                except (common.DataCorruption, _SessionGone) as e:
+                    # The object written does not match the file, or the session expired:
+                    # send it again from the start with a new session
+                    self._fail_once(e)
+                    session = None
+                    recovering = False
+                except Exception as e:
+                    if not _transient(e):
+                        raise
+                    self._fail_once(e)
+                    recovering = session is not None
+                else:
+                    self.retries = 0
+                    self.state = 'uploading'
+                self.uploaded = 0 if session is None else session.bytes_uploaded
+            self.uploaded = self.size
+            self.state = 'done'
+        except Exception as e:
+            self.error = e
+            self.state = 'failed'
+        finally:
+            self.data = None
+            self._done.set()
+
+    def _fail_once(self, error):
+        self.retries += 1
+        if self.retries > MAX_RETRIES:
+            raise error
+        self.state = 'retrying'
+        time.sleep(min(2 ** self.retries, 60) * random.uniform(0.5, 1))
+
+
+def start_upload(bucket_name, data, destination, content_type='text/plain'):
+    """Upload data to destination in the bucket in the background. Returns the UploadJob.
+    The content type defaults to the one of Blob.upload_from_string"""
+    job = UploadJob(storagebackend.get_bucket(bucket_name), destination, data, content_type)
+    _executor.submit(job.run)
+    return job
@@ -4,12 +4,12 @@ import datetime as dt
 from io import BytesIO
 import streamlit as st
 import xlsxwriter
-from google.cloud import storage
+import uploadengine
 from streamlit_gsheets import GSheetsConnection
 import os
 import json
-import smtplib
-from email.mime.text import MIMEText
+import outbox
+import mailer
 
 
 def studycode_callback():
@@ -37,11 +37,11 @@ def get_studycode():
 
 
 def upload_data(bucket_name, data, destination):
-    """Upload a file to the bucket."""
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob = bucket.blob(destination)
-    blob.upload_from_string(data)
+    """Upload a file to the bucket and wait for it (see uploadengine for background uploads)."""
+    job = uploadengine.start_upload(bucket_name, data, destination)
+    job.wait()
+    if job.state == 'failed':
+        raise job.error
     return "File successfully uploaded to GP2 storage system"
 
 def to_excelv2(df,clin, dct):
@@ -84,7 +84,8 @@ def to_excel(df, studycode, mv, datatype):
     return processed_data, filename
 
 
-def email_ellie(studycode, activity):
+def email_text(studycode, activity):
+    """(subject, body) of the email to the team about the activity of a study"""
     if activity == 'qc':
         subject = f'{studycode} has finished QCing the manifest'
         body = 'Hey team, \n Someone has finished QCing the manifest. They should upload to the bucket soon. \n Keep an eye if the don\'t'
@@ -95,22 +96,13 @@ def email_ellie(studycode, activity):
         st.error(f'{activity} not detected')
         st.stop()
 
-    with open(os.environ["GOOGLE_APPLICATION_CREDENTIALS"]) as f:
-        get_json = json.load(f)
-        sender = get_json['email_data']['secrets']['sender']
-        receiver = get_json['email_data']['secrets']['receiver']
-        pwd = get_json['email_data']['secrets']['pwd']
-    
-    msg = MIMEText(body)
-    msg['From'] = sender
-    msg['To'] = ", ".join(receiver)
-    msg['Subject'] = subject
-
-    server = smtplib.SMTP('smtp.gmail.com', 587)
-    server.starttls()
-    server.login(sender, pwd)
-    server.sendmail(sender, receiver, msg.as_string())
-    server.quit()
+    return subject, body
+
+
+def email_ellie(studycode, activity):
+    # Sent in the background by the outbox worker (see mailer)
+    subject, body = email_text(studycode, activity)
+    outbox.enqueue('email', {'subject': subject, 'body': body})
 
 
 def read_file(data_file):